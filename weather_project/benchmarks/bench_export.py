@@ -0,0 +1,75 @@
+"""Export the whole history as CSV and report time, bytes and peak RSS.
+
+``--mode buffered`` reproduces the previous implementation (full model
+instances written into one HttpResponse) for comparison. Peak RSS is per
+process, so run each mode separately. Seed first, e.g.
+``python manage.py seed_history --rows 1000000``.
+
+Usage: python -m benchmarks.bench_export [--mode stream|buffered] [--gzip]
+"""
+
+import argparse
+import csv
+import resource
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+
+from weather.models import WeatherQuery  # noqa: E402
+from weather.views import EXPORT_HEADER, export_csv  # noqa: E402
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def buffered_export():
+    response = HttpResponse(content_type="text/csv")
+    writer = csv.writer(response)
+    writer.writerow(EXPORT_HEADER)
+    for query in WeatherQuery.objects.all().order_by("-timestamp"):
+        writer.writerow(
+            [
+                f"{query.city_name}",
+                f"{query.temperature}",
+                f"{query.weather_description}",
+                f"{query.units}",
+                f"{query.timestamp.strftime('%Y-%m-%d %H:%M:%S')}",
+                f"Served from cache - {query.served_from_cache}",
+            ]
+        )
+    return [response.content]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["stream", "buffered"], default="stream")
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args()
+
+    rows = WeatherQuery.objects.count()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if args.mode == "stream":
+        params = {"gzip": "1"} if args.gzip else {}
+        chunks = export_csv(RequestFactory().get("/history/export/", params))
+        chunks = chunks.streaming_content
+    else:
+        chunks = buffered_export()
+    size = sum(len(chunk) for chunk in chunks)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"mode={args.mode} gzip={args.gzip} rows={rows} bytes={size} "
+        f"elapsed={elapsed:.2f}s rows_per_s={rows / elapsed:.0f} "
+        f"peak_rss={peak_rss_mb():.1f}MB baseline_rss={baseline:.1f}MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""EXPLAIN and time the DB cache fallback and history queries.
+
+Seed first, e.g. ``python manage.py seed_history --rows 1000000``; on
+PostgreSQL the plans are collected with EXPLAIN ANALYZE.
+
+Usage: python -m benchmarks.bench_history_indexes [--city "Seed City 7"]
+"""
+
+import argparse
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.db import connection  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+
+from weather.cache import WeatherCache  # noqa: E402
+from weather.models import WeatherQuery  # noqa: E402
+from weather.views import _filtered_history  # noqa: E402
+
+
+def history(params):
+    return _filtered_history(RequestFactory().get("/history/", params))[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--city", default="Seed City 7")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {WeatherQuery._meta.db_table}")
+    explain_options = {"analyze": True} if connection.vendor == "postgresql" else {}
+
+    scenarios = {
+        "db_cache_fallback": WeatherCache._fresh_queries(args.city)[:1],
+        "history_first_page": history({})[:10],
+        "history_by_city": history({"city": args.city})[:10],
+        "history_by_date_range": history(
+            {"date_from": "2000-01-01", "date_to": "2100-01-01"}
+        )[:10],
+        "history_by_city_and_date": history(
+            {"city": args.city, "date_from": "2000-01-01"}
+        )[:10],
+    }
+
+    print(f"rows={WeatherQuery.objects.count()} vendor={connection.vendor}")
+    for name, queryset in scenarios.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            list(queryset.all())
+        per_query = (time.perf_counter() - start) / args.repeat * 1000
+        print(f"\n== {name}: {per_query:.2f}ms per query")
+        print(queryset.explain(**explain_options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Logging cost per request on the request thread: old vs new setup.
+
+One "request" emits the six INFO lines of a cache miss (view, service,
+cache, client). "before" is the previous configuration: f-strings, and a
+FileHandler plus a stdout StreamHandler writing synchronously. The other
+rows use lazy %-style calls with the handlers behind weather.log's queue
+listener. "drain" is the time the listener needs afterwards to write
+everything out, which no longer blocks requests.
+
+Usage: python -m benchmarks.bench_logging [--requests 20000]
+"""
+
+import argparse
+import logging
+import logging.handlers
+import os
+import queue
+import tempfile
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from weather import log  # noqa: E402
+
+VERBOSE = (
+    "levelname={levelname} timestamp={asctime} module={module} "
+    "request_id={request_id} message={message}"
+)
+
+
+def request_fstring(logger, city, units, ip):
+    logger.info("request_start method=GET path=/api/")
+    logger.info(f"weather_request_start city={city} units={units} ip={ip}")
+    logger.info(f"cache_miss city={city} units={units}")
+    logger.info(f"redis_cache_miss city={city}")
+    logger.info(f"cache_set_success city={city}")
+    logger.info(f"api_response_created city={city}")
+
+
+def request_lazy(logger, city, units, ip):
+    logger.info("request_start method=%s path=%s", "GET", "/api/")
+    logger.info("weather_request_start city=%s units=%s ip=%s", city, units, ip)
+    logger.info("cache_miss city=%s units=%s", city, units)
+    logger.info("redis_cache_miss city=%s", city)
+    logger.info("cache_set_success city=%s", city)
+    logger.info("api_response_created city=%s", city)
+
+
+def build_logger(name, directory, formatter, level=logging.INFO):
+    logger = logging.getLogger(f"bench.{name}")
+    logger.handlers.clear()
+    logger.propagate = False
+    logger.setLevel(level)
+    logger.addFilter(log.RequestIdFilter())
+    logger.addFilter(log.SamplingFilter())
+    file_handler = logging.FileHandler(os.path.join(directory, f"{name}.log"))
+    console = logging.StreamHandler(open(os.devnull, "w"))
+    for handler in (file_handler, console):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+def queue_handlers(logger):
+    handlers = list(logger.handlers)
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(log.LocalQueueHandler(records))
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+
+def measure(label, logger, emit, requests, sample_rate=1.0, listener=None):
+    for i in range(requests):
+        rid = f"req-{i}"
+        tokens = (
+            log.request_id.set(rid),
+            log.sampled.set(log.should_sample(rid, sample_rate)),
+        )
+        if i == 100:
+            start = time.perf_counter()
+        emit(logger, "San Francisco", "metric", "127.0.0.1")
+        log.request_id.reset(tokens[0])
+        log.sampled.reset(tokens[1])
+    elapsed = time.perf_counter() - start
+    drain_start = time.perf_counter()
+    if listener is not None:
+        listener.stop()
+    drain = time.perf_counter() - drain_start
+    for handler in logger.handlers + list(getattr(listener, "handlers", ())):
+        handler.close()
+    per_request = elapsed / (requests - 100) * 1e6
+    print(f"{label:<28} {per_request:7.1f}us/request  drain={drain * 1000:7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20_000)
+    args = parser.parse_args()
+    verbose = logging.Formatter(VERBOSE, style="{")
+    json_formatter = log.JsonFormatter()
+
+    with tempfile.TemporaryDirectory() as directory:
+        logger = build_logger("before", directory, verbose)
+        measure("before (sync, f-strings)", logger, request_fstring, args.requests)
+
+        logger = build_logger("text", directory, verbose)
+        listener = queue_handlers(logger)
+        measure("text, queued", logger, request_lazy, args.requests, 1.0, listener)
+
+        logger = build_logger("json", directory, json_formatter)
+        listener = queue_handlers(logger)
+        measure("json, queued", logger, request_lazy, args.requests, 1.0, listener)
+
+        logger = build_logger("sampled", directory, json_formatter)
+        listener = queue_handlers(logger)
+        measure(
+            "json, queued, 10% sampled",
+            logger,
+            request_lazy,
+            args.requests,
+            0.1,
+            listener,
+        )
+
+        logger = build_logger("off_f", directory, verbose, logging.WARNING)
+        measure("level off, f-strings", logger, request_fstring, args.requests)
+
+        logger = build_logger("off_lazy", directory, verbose, logging.WARNING)
+        measure("level off, lazy", logger, request_lazy, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Bytes needed for raw upstream payloads: inline JSON vs RawPayload.
+
+Generates full-size OpenWeatherMap current-weather responses for
+``--rows`` upstream fetches spread over ``--cities`` cities. A city's
+observation only changes every ``--repeats`` fetches (OpenWeatherMap
+updates roughly every ten minutes, while the cache and the three unit
+systems cause more frequent fetches), so identical bodies recur.
+
+"inline" is what the old ``raw_data`` JSON column held, one copy per row.
+"content-addressed" is one zlib blob per distinct body plus the 64-byte
+digest each row keeps. Encode/decode times are per payload.
+
+Usage: python -m benchmarks.bench_payload_storage [--rows 100000]
+"""
+
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from weather.models import decode_payload, encode_payload  # noqa: E402
+
+DESCRIPTIONS = ["clear sky", "few clouds", "light rain", "overcast clouds", "mist"]
+
+
+def owm_payload(rng, city_id, observation, units):
+    temp = round(rng.uniform(-20, 40), 2)
+    if units == "imperial":
+        temp = round(temp * 9 / 5 + 32, 2)
+    elif units == "standard":
+        temp = round(temp + 273.15, 2)
+    dt = 1_700_000_000 + observation * 600
+    return {
+        "coord": {"lon": rng.uniform(-180, 180), "lat": rng.uniform(-90, 90)},
+        "weather": [
+            {
+                "id": 800,
+                "main": "Clouds",
+                "description": rng.choice(DESCRIPTIONS),
+                "icon": "04d",
+            }
+        ],
+        "base": "stations",
+        "main": {
+            "temp": temp,
+            "feels_like": temp - 1,
+            "temp_min": temp - 2,
+            "temp_max": temp + 2,
+            "pressure": rng.randint(980, 1040),
+            "humidity": rng.randint(10, 100),
+            "sea_level": rng.randint(980, 1040),
+            "grnd_level": rng.randint(950, 1020),
+        },
+        "visibility": 10000,
+        "wind": {
+            "speed": rng.uniform(0, 15),
+            "deg": rng.randint(0, 359),
+            "gust": rng.uniform(0, 20),
+        },
+        "clouds": {"all": rng.randint(0, 100)},
+        "dt": dt,
+        "sys": {
+            "type": 2,
+            "id": 2_000_000 + city_id,
+            "country": "GB",
+            "sunrise": dt - 20_000,
+            "sunset": dt + 20_000,
+        },
+        "timezone": 3600,
+        "id": city_id,
+        "name": f"Seed City {city_id}",
+        "cod": 200,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--cities", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    fetches = {}
+    payloads = []
+    rng = random.Random(args.seed)
+    for _ in range(args.rows):
+        city_id = rng.randrange(args.cities)
+        units = rng.choice(["metric", "metric", "imperial", "standard"])
+        count = fetches[city_id] = fetches.get(city_id, 0) + 1
+        observation = count // args.repeats
+        # Same city, observation and units always give the same body.
+        body_rng = random.Random(f"{args.seed}:{city_id}:{observation}")
+        payloads.append(owm_payload(body_rng, city_id, observation, units))
+
+    inline = sum(len(json.dumps(payload)) for payload in payloads)
+
+    start = time.perf_counter()
+    blobs = dict(encode_payload(payload) for payload in payloads)
+    encode = (time.perf_counter() - start) / len(payloads)
+    stored = sum(len(blob) for blob in blobs.values()) + 64 * len(payloads)
+
+    start = time.perf_counter()
+    for blob in blobs.values():
+        decode_payload(blob)
+    decode = (time.perf_counter() - start) / len(blobs)
+
+    print(f"rows={len(payloads)} distinct={len(blobs)} cities={args.cities}")
+    print(f"inline             {inline / 1e6:8.2f}MB")
+    print(
+        f"content-addressed  {stored / 1e6:8.2f}MB "
+        f"({stored / inline:.0%} of inline)"
+    )
+    print(f"encode {encode * 1e6:.1f}us/payload  decode {decode * 1e6:.1f}us/payload")
+
+
+if __name__ == "__main__":
+    main()
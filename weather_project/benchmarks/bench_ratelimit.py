@@ -0,0 +1,81 @@
+"""Per-request cost of the rate limit check.
+
+Compares django-ratelimit's cache-based check (what the views used before;
+``pip install django-ratelimit``), the GCRA Lua script, and the in-process
+fallback used when Redis is down. Needs Redis from the usual .env settings.
+
+Usage: python -m benchmarks.bench_ratelimit [--requests 5000] [--clients 100]
+"""
+
+import argparse
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.test import RequestFactory  # noqa: E402
+
+from weather.ratelimit import Rate, RateLimiter, rate_limiter  # noqa: E402
+
+RATE = Rate(1_000_000, 60)
+
+
+def requests_for(clients, total):
+    factory = RequestFactory()
+    return [
+        factory.get(
+            "/api/", REMOTE_ADDR=f"10.0.{i % clients // 256}.{i % clients % 256}"
+        )
+        for i in range(total)
+    ]
+
+
+def measure(name, check, requests):
+    start = time.perf_counter()
+    for request in requests:
+        check(request)
+    per_request = (time.perf_counter() - start) / len(requests) * 1e6
+    print(f"{name:<22} {per_request:7.1f}us/request")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=100)
+    args = parser.parse_args()
+    requests = requests_for(args.clients, args.requests)
+
+    try:
+        from django_ratelimit.core import is_ratelimited
+    except ImportError:
+        print("django-ratelimit       not installed, skipped")
+    else:
+        measure(
+            "django-ratelimit",
+            lambda request: is_ratelimited(
+                request=request,
+                group="bench",
+                key="ip",
+                rate="1000000/m",
+                method="GET",
+                increment=True,
+            ),
+            requests,
+        )
+
+    measure(
+        "gcra (redis)",
+        lambda request: rate_limiter.hit(f"bench:{request.META['REMOTE_ADDR']}", RATE),
+        requests,
+    )
+    local = RateLimiter()
+    measure(
+        "gcra (local fallback)",
+        lambda request: local._local_hit(f"bench:{request.META['REMOTE_ADDR']}", RATE),
+        requests,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Serialize/deserialize time and bytes per cache entry: pickle vs weather codec.
+
+The pickle row is what django-redis's default PickleSerializer stores.
+
+Usage: python -m benchmarks.bench_serialization [--iterations 200000]
+"""
+
+import argparse
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.utils import timezone  # noqa: E402
+from django_redis.serializers.pickle import PickleSerializer  # noqa: E402
+
+from weather.codec import WeatherSerializer  # noqa: E402
+
+ENTRY = {
+    "city_name": "San Francisco",
+    "temperature": 17.34,
+    "weather_description": "broken clouds",
+    "units": "metric",
+    "timestamp": timezone.now(),
+}
+
+
+def measure(name, serializer, iterations):
+    payload = serializer.dumps(ENTRY)
+    assert serializer.loads(payload) == ENTRY
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        serializer.dumps(ENTRY)
+    dumps_ns = (time.perf_counter() - start) / iterations * 1e9
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        serializer.loads(payload)
+    loads_ns = (time.perf_counter() - start) / iterations * 1e9
+
+    print(
+        f"{name:<16} bytes={len(payload):<4} "
+        f"dumps={dumps_ns:7.0f}ns loads={loads_ns:7.0f}ns"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    measure("pickle", PickleSerializer({}), args.iterations)
+    measure("codec", WeatherSerializer({}), args.iterations)
+    measure("codec+zlib", WeatherSerializer({"COMPRESS_MIN_BYTES": 1}), args.iterations)
+
+
+if __name__ == "__main__":
+    main()
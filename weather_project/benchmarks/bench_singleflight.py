@@ -0,0 +1,76 @@
+"""Burst of concurrent requests for one cold key, with and without single-flight.
+
+Usage: python -m benchmarks.bench_singleflight [--threads 50] [--latency 0.3]
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from unittest.mock import patch  # noqa: E402
+
+from django.core.cache import cache  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from weather.api_client import WeatherAPIClient  # noqa: E402
+from weather.cache import WeatherCache  # noqa: E402
+from weather.models import WeatherQuery  # noqa: E402
+from weather.services import WeatherService  # noqa: E402
+
+CITY = "Benchville"
+
+
+def run_burst(threads: int, latency: float):
+    upstream_calls = []
+
+    def fake_get_weather(self, city, units="metric"):
+        upstream_calls.append(city)
+        time.sleep(latency)
+        return {
+            "name": CITY,
+            "main": {"temp": 20.0, "humidity": 50, "pressure": 1010},
+            "weather": [{"description": "clear sky"}],
+        }
+
+    cache.delete(WeatherCache.make_key(CITY, "metric"))
+    WeatherQuery.objects.filter(city_name=CITY).delete()
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        WeatherService().get_weather(CITY, "metric")
+
+    with patch.object(WeatherAPIClient, "get_weather", fake_get_weather):
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+
+    WeatherQuery.objects.filter(city_name=CITY).delete()
+    return len(upstream_calls), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.3)
+    args = parser.parse_args()
+
+    for enabled in (False, True):
+        with override_settings(SINGLE_FLIGHT_ENABLED=enabled):
+            calls, elapsed = run_burst(args.threads, args.latency)
+        print(
+            f"single_flight={enabled!s:<5} requests={args.threads} "
+            f"upstream_calls={calls} elapsed={elapsed:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
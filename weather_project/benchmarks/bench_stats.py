@@ -0,0 +1,118 @@
+"""Time /api/stats/ aggregation against the naive way of computing it.
+
+"python" fetches every row of the city and range and aggregates with the
+statistics module, which is what crunching an export amounts to. "db +
+numpy" is weather.stats.compute_stats: one grouped query, then a flat
+float column for the percentiles. "cached" is a repeat request.
+
+Seed a few dense cities first so each has a large share of the rows, e.g.
+``python manage.py seed_history --rows 2000000 --cities 4 --days 30``.
+
+Usage: python -m benchmarks.bench_stats [--city "Seed City 1"] [--bucket hour]
+"""
+
+import argparse
+import statistics
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from benchmarks.common import setup_django
+
+setup_django()
+
+from django.core.cache import cache  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from weather.models import WeatherQuery, normalize_city  # noqa: E402
+from weather.stats import PERCENTILES, city_stats, compute_stats  # noqa: E402
+from weather.units import convert_temperature  # noqa: E402
+
+
+def python_stats(city, start, end, bucket):
+    buckets = defaultdict(list)
+    rows = WeatherQuery.objects.filter(
+        city_key=normalize_city(city), timestamp__gte=start, timestamp__lt=end
+    ).iterator(chunk_size=5000)
+    for row in rows:
+        key = row.timestamp.replace(minute=0, second=0, microsecond=0)
+        if bucket == "day":
+            key = key.replace(hour=0)
+        buckets[key].append(
+            (convert_temperature(row.temperature, row.units, "metric"), row)
+        )
+    result = []
+    for key in sorted(buckets):
+        temperatures = [temperature for temperature, _ in buckets[key]]
+        quantiles = (
+            statistics.quantiles(temperatures, n=100, method="inclusive")
+            if len(temperatures) > 1
+            else temperatures * 99
+        )
+        result.append(
+            {
+                "start": key.isoformat(),
+                "requests": len(temperatures),
+                "cache_hits": sum(row.served_from_cache for _, row in buckets[key]),
+                "min": min(temperatures),
+                "max": max(temperatures),
+                "mean": statistics.fmean(temperatures),
+                **{f"p{p}": quantiles[p - 1] for p in PERCENTILES},
+            }
+        )
+    return result
+
+
+def timed(label, fn, repeat, rows):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(
+        f"{label:<10} {elapsed * 1000:9.1f}ms  buckets={len(result)} "
+        f"rows/s={rows / elapsed:,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--city", default="Seed City 1")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--bucket", choices=["hour", "day"], default="hour")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    end = timezone.now()
+    start = end - timedelta(days=args.days)
+    rows = WeatherQuery.objects.filter(
+        city_key=normalize_city(args.city), timestamp__gte=start
+    ).count()
+    print(
+        f"city={args.city!r} rows={rows} total_rows={WeatherQuery.objects.count()} "
+        f"bucket={args.bucket}"
+    )
+
+    timed(
+        "python",
+        lambda: python_stats(args.city, start, end, args.bucket),
+        args.repeat,
+        rows,
+    )
+    timed(
+        "db + numpy",
+        lambda: compute_stats(args.city, start, end, args.bucket, "metric"),
+        args.repeat,
+        rows,
+    )
+    cache.clear()
+    city_stats(args.city, start, end, args.bucket, "metric")
+    timed(
+        "cached",
+        lambda: city_stats(args.city, start, end, args.bucket, "metric"),
+        args.repeat,
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Throughput of /api/ on cold keys under gunicorn (WSGI) vs uvicorn (ASGI).
+
+Every request asks for a distinct city so each one waits on the (fake,
+slow) upstream. Needs gunicorn and uvicorn (benchmarks/requirements.txt)
+and a migrated database from the usual .env settings.
+
+Usage: python -m benchmarks.bench_wsgi_vs_asgi [--requests 500] [--concurrency 200]
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import latency_summary, start_app_server
+from benchmarks.fake_owm import start_fake_server
+
+
+async def drive(port, total, concurrency):
+    run_id = uuid.uuid4().hex[:8]
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+        async def one(i):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(
+                    f"http://127.0.0.1:{port}/api/",
+                    params={"city": f"bench-{run_id}-{i}"},
+                )
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed, errors
+
+
+def run(mode, args, upstream):
+    with start_app_server(
+        mode, upstream.base_url, workers=args.workers, threads=args.threads
+    ) as port:
+        latencies, elapsed, errors = asyncio.run(
+            drive(port, args.requests, args.concurrency)
+        )
+    print(f"{mode} {latency_summary(latencies, elapsed)} errors={errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    upstream = start_fake_server(latency=args.latency)
+    for mode in ("wsgi", "asgi"):
+        run(mode, args, upstream)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import django
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django():
+    sys.path.insert(0, str(PROJECT_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "weather_project.settings")
+    django.setup()
+
+
+SERVERS = {
+    "wsgi": [
+        "gunicorn",
+        "weather_project.wsgi:application",
+        "--workers",
+        "{workers}",
+        "--threads",
+        "{threads}",
+        "--bind",
+        "127.0.0.1:{port}",
+    ],
+    "asgi": [
+        "uvicorn",
+        "weather_project.asgi:application",
+        "--workers",
+        "{workers}",
+        "--port",
+        "{port}",
+        "--no-access-log",
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+@contextlib.contextmanager
+def start_app_server(mode, upstream_url, workers=1, threads=4, env=None):
+    """Run the app under gunicorn ("wsgi") or uvicorn ("asgi"); yields the port."""
+    port = free_port()
+    command = [
+        part.format(port=port, workers=workers, threads=threads)
+        for part in SERVERS[mode]
+    ]
+    env = dict(
+        os.environ,
+        WEATHER_API_BASE_URL=upstream_url,
+        WEATHER_ASYNC_VIEWS=str(mode == "asgi"),
+        RATELIMIT_ENABLE="False",
+        UPSTREAM_CALLS_PER_MINUTE="0",
+    ) | (env or {})
+    process = subprocess.Popen(
+        command,
+        cwd=PROJECT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_summary(latencies, elapsed):
+    values = sorted(latencies)
+    return (
+        f"requests={len(values)} rps={len(values) / elapsed:.1f} "
+        f"p50={percentile(values, 50) * 1000:.1f}ms "
+        f"p95={percentile(values, 95) * 1000:.1f}ms "
+        f"p99={percentile(values, 99) * 1000:.1f}ms"
+    )
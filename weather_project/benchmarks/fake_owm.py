@@ -0,0 +1,148 @@
+"""Local stand-in for the OpenWeatherMap current weather API.
+
+Run standalone with ``python -m benchmarks.fake_owm --port 8765 --latency 0.2``
+and point ``WEATHER_API_BASE_URL`` at ``http://127.0.0.1:8765/data/2.5/weather``.
+``GET /__stats`` returns the number of upstream calls served so far; a
+``/data/2.5/group?id=1,2,3`` call counts as one.
+Lookups by ``id`` (sent once the city index resolves a name) get a
+synthetic city named after the ID.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WEATHER_PATH = "/data/2.5/weather"
+GROUP_PATH = "/data/2.5/group"
+
+
+def fake_weather(city: str, units: str, city_id: int = None):
+    seed = zlib.crc32(city.strip().lower().encode())
+    temp_c = (seed % 400) / 10 - 5
+    if units == "imperial":
+        temp = temp_c * 9 / 5 + 32
+    elif units == "standard":
+        temp = temp_c + 273.15
+    else:
+        temp = temp_c
+    return {
+        "id": city_id or seed % 10_000_000,
+        "name": city.strip().title(),
+        "main": {
+            "temp": round(temp, 2),
+            "humidity": seed % 100,
+            "pressure": 990 + seed % 40,
+        },
+        "wind": {"speed": (seed % 150) / 10},
+        "weather": [{"description": "scattered clouds"}],
+    }
+
+
+class FakeOWMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.1, error_rate=0.0, seed=None):
+        super().__init__(address, FakeOWMHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{WEATHER_PATH}"
+
+    @property
+    def group_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{GROUP_PATH}"
+
+    def count_call(self):
+        with self.calls_lock:
+            self.calls += 1
+
+    def reset(self):
+        with self.calls_lock:
+            self.calls = 0
+
+
+class FakeOWMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/__stats":
+            return self._send_json(200, {"calls": self.server.calls})
+        if url.path not in (WEATHER_PATH, GROUP_PATH):
+            return self._send_json(404, {"cod": "404", "message": "not found"})
+
+        self.server.count_call()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.random.random() < self.server.error_rate:
+            return self._send_json(503, {"cod": "503", "message": "unavailable"})
+
+        units = params.get("units", "metric")
+        if url.path == GROUP_PATH:
+            # Up to 20 IDs per call, as upstream; every ID is known.
+            ids = [int(i) for i in params.get("id", "").split(",") if i][:20]
+            items = [fake_weather(f"City {i}", units, i) for i in ids]
+            return self._send_json(200, {"cnt": len(items), "list": items})
+
+        if "id" in params:
+            city_id = int(params["id"])
+            return self._send_json(200, fake_weather(f"City {city_id}", units, city_id))
+        city = params.get("q", "")
+        if not city or city.lower().startswith("nowhere"):
+            return self._send_json(404, {"cod": "404", "message": "city not found"})
+        return self._send_json(200, fake_weather(city, units))
+
+
+def start_fake_server(port=0, latency=0.1, error_rate=0.0, seed=None):
+    server = FakeOWMServer(
+        ("127.0.0.1", port), latency=latency, error_rate=error_rate, seed=seed
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeOWMServer(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    print(f"fake OpenWeatherMap listening on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Scripted load scenarios against the real app and a fake upstream.
+
+Starts the fake OpenWeatherMap server in-process and the app under gunicorn
+(``--server asgi`` for uvicorn), optionally seeds a history dataset, then
+runs each scenario over HTTP and reports req/s, latency percentiles,
+errors and the number of upstream calls it caused. Everything runs
+locally; it needs the database and Redis from the usual .env settings
+(migrated) and gunicorn/uvicorn from benchmarks/requirements.txt.
+
+Scenarios:
+  hot_key_burst   many concurrent requests for a handful of cold cities
+  cold_cache      every request for a distinct, uncached city
+  mixed_units     a few cities requested in all three unit systems
+  query_form      the HTML form (POST /) for a set of cities
+  deep_history    clients following "Next" links many pages deep
+  large_export    full CSV export of the history table
+
+Usage: python -m benchmarks.loadtest [--scenario hot_key_burst ...]
+           [--dataset small|medium|large] [--latency 0.2] [--error-rate 0.01]
+           [--json results.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import latency_summary, percentile, setup_django
+from benchmarks.common import start_app_server
+from benchmarks.fake_owm import start_fake_server
+
+# Seeded with manage.py seed_history; rows and distinct cities.
+DATASETS = {
+    "small": (10_000, 100),
+    "medium": (100_000, 500),
+    "large": (1_000_000, 2000),
+}
+UNIT_SYSTEMS = ("metric", "imperial", "standard")
+NEXT_PAGE = re.compile(r'href="\?after=([^"&]+)')
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    async def fetch(self, client, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            return None
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+        self.bytes += len(response.content)
+        if response.status_code != 200:
+            self.errors += 1
+        return response
+
+
+async def gather_limited(concurrency, jobs):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(job):
+        async with semaphore:
+            await job
+
+    await asyncio.gather(*(limited(job) for job in jobs))
+
+
+async def hot_key_burst(client, recorder, args, run_id):
+    cities = [f"hot-{run_id}-{i}" for i in range(args.hot_keys)]
+    await gather_limited(
+        args.concurrency,
+        (
+            recorder.fetch(client, "GET", "/api/", params={"city": city})
+            for city in itertools.islice(itertools.cycle(cities), args.requests)
+        ),
+    )
+
+
+async def cold_cache(client, recorder, args, run_id):
+    await gather_limited(
+        args.concurrency,
+        (
+            recorder.fetch(
+                client, "GET", "/api/", params={"city": f"cold-{run_id}-{i}"}
+            )
+            for i in range(args.requests)
+        ),
+    )
+
+
+async def mixed_units(client, recorder, args, run_id):
+    cities = [f"units-{run_id}-{i}" for i in range(args.hot_keys)]
+    pairs = itertools.cycle(itertools.product(cities, UNIT_SYSTEMS))
+    await gather_limited(
+        args.concurrency,
+        (
+            recorder.fetch(
+                client, "GET", "/api/", params={"city": city, "units": units}
+            )
+            for city, units in itertools.islice(pairs, args.requests)
+        ),
+    )
+
+
+async def query_form(client, recorder, args, run_id):
+    cities = [f"form-{run_id}-{i}" for i in range(args.hot_keys)]
+    await client.get("/")
+    token = client.cookies["csrftoken"]
+    await gather_limited(
+        args.concurrency,
+        (
+            recorder.fetch(
+                client,
+                "POST",
+                "/",
+                data={"city": city, "units": "metric"},
+                headers={"X-CSRFToken": token},
+            )
+            for city in itertools.islice(itertools.cycle(cities), args.requests)
+        ),
+    )
+
+
+async def deep_history(client, recorder, args, run_id):
+    async def walk():
+        params = {}
+        for _ in range(args.pages):
+            response = await recorder.fetch(client, "GET", "/history/", params=params)
+            match = NEXT_PAGE.search(response.text) if response else None
+            if not match:
+                return
+            params = {"after": match.group(1)}
+
+    walkers = max(1, min(args.concurrency, args.requests // args.pages))
+    await gather_limited(walkers, (walk() for _ in range(walkers)))
+
+
+async def large_export(client, recorder, args, run_id):
+    for _ in range(args.exports):
+        await recorder.fetch(client, "GET", "/history/export/")
+
+
+SCENARIOS = {
+    "hot_key_burst": hot_key_burst,
+    "cold_cache": cold_cache,
+    "mixed_units": mixed_units,
+    "query_form": query_form,
+    "deep_history": deep_history,
+    "large_export": large_export,
+}
+
+
+def seed(dataset):
+    setup_django()
+    from django.core.management import call_command
+
+    rows, cities = DATASETS[dataset]
+    call_command("seed_history", rows=rows, cities=cities, seed=42, clear=True)
+
+
+async def run_scenario(name, port, upstream, args):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    recorder = Recorder()
+    upstream.reset()
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=120
+    ) as client:
+        start = time.perf_counter()
+        await SCENARIOS[name](client, recorder, args, uuid.uuid4().hex[:8])
+        elapsed = time.perf_counter() - start
+    values = sorted(recorder.latencies)
+    print(
+        f"{name:<14} {latency_summary(values, elapsed)} errors={recorder.errors} "
+        f"upstream_calls={upstream.calls} mb={recorder.bytes / 1e6:.1f}"
+    )
+    return {
+        "scenario": name,
+        "requests": len(values),
+        "rps": len(values) / elapsed,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "errors": recorder.errors,
+        "upstream_calls": upstream.calls,
+        "bytes": recorder.bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), default=None
+    )
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--hot-keys", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--exports", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--upstream-budget",
+        type=int,
+        default=0,
+        help="UPSTREAM_CALLS_PER_MINUTE for the app; 0 (default) disables it.",
+    )
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default=None)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    if args.dataset:
+        seed(args.dataset)
+    upstream = start_fake_server(
+        latency=args.latency, error_rate=args.error_rate, seed=args.seed
+    )
+    print(
+        f"server={args.server} workers={args.workers} threads={args.threads} "
+        f"upstream_latency={args.latency}s error_rate={args.error_rate} "
+        f"dataset={args.dataset or 'existing'}"
+    )
+    results = []
+    with start_app_server(
+        args.server,
+        upstream.base_url,
+        workers=args.workers,
+        threads=args.threads,
+        env={"UPSTREAM_CALLS_PER_MINUTE": str(args.upstream_budget)},
+    ) as port:
+        for name in args.scenario or SCENARIOS:
+            results.append(asyncio.run(run_scenario(name, port, upstream, args)))
+    upstream.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+# gunicorn -c gunicorn.conf.py weather_project.wsgi
+#
+# With several workers, export PROMETHEUS_MULTIPROC_DIR (an empty directory)
+# so /metrics aggregates samples from every worker.
+import glob
+import os
+
+from prometheus_client import multiprocess
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", "4"))
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be added to the new ones.
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
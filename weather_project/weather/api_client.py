@@ -1,39 +1,371 @@
+import asyncio
 import logging
+import random
+import threading
 import time
+import weakref
 
+import httpx
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from .batching import AsyncGroupBatcher, GroupBatcher
+from .cache import AsyncWeatherCache, WeatherCache
+from .cities import get_city_index
+from .metrics import UPSTREAM_GROUP_SIZE, UPSTREAM_LATENCY, UPSTREAM_REJECTED
+from .resilience import CircuitBreaker, TokenBucket
 
 logger = logging.getLogger("weather")
 
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_async_batchers = weakref.WeakKeyDictionary()
+
+upstream_circuit = CircuitBreaker(
+    "owm",
+    failure_threshold=settings.UPSTREAM_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=settings.UPSTREAM_CIRCUIT_RESET_TIMEOUT,
+)
+upstream_budget = TokenBucket(
+    "owm",
+    rate_per_minute=settings.UPSTREAM_CALLS_PER_MINUTE,
+    capacity=settings.UPSTREAM_BURST,
+)
+
+
+def _build_session():
+    # Only failed connections are retried here, since those never reach
+    # upstream. Retries on RETRY_STATUSES are done by the clients, which
+    # charge each attempt to the upstream budget.
+    retry = Retry(
+        total=settings.WEATHER_API_MAX_RETRIES,
+        connect=settings.WEATHER_API_MAX_RETRIES,
+        read=0,
+        status=0,
+        other=0,
+        allowed_methods=frozenset({"GET"}),
+        backoff_factor=settings.WEATHER_API_BACKOFF_FACTOR,
+        backoff_jitter=settings.WEATHER_API_BACKOFF_JITTER,
+        # Retry-After on 429 would otherwise trigger a retry of its own.
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.WEATHER_API_POOL_SIZE,
+        pool_maxsize=settings.WEATHER_API_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get_async_client():
+    # httpx.AsyncClient is bound to the event loop it was first used on.
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.WEATHER_API_ASYNC_POOL_SIZE,
+                max_keepalive_connections=settings.WEATHER_API_ASYNC_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(
+                settings.WEATHER_API_READ_TIMEOUT,
+                connect=settings.WEATHER_API_CONNECT_TIMEOUT,
+            ),
+            transport=httpx.AsyncHTTPTransport(
+                retries=settings.WEATHER_API_MAX_RETRIES
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def _batch_id(city: str):
+    # Only cities the index knows by ID can go through the group endpoint.
+    if settings.UPSTREAM_BATCH_WINDOW <= 0:
+        return None
+    return get_city_index().resolve(city)
+
+
+def _group_params(city_ids, units: str, api_key: str):
+    UPSTREAM_GROUP_SIZE.observe(len(city_ids))
+    return {"id": ",".join(str(i) for i in city_ids), "units": units, "appid": api_key}
+
+
+def _group_results(data: dict):
+    return {item.get("id"): item for item in data.get("list", [])}
+
+
+def _query_params(city: str, units: str, api_key: str):
+    # Query by ID when the city index knows the city, so upstream returns
+    # the same city we keyed the cache on.
+    city_id = get_city_index().resolve(city)
+    if city_id:
+        return {"id": city_id, "units": units, "appid": api_key}, city_id
+    return {"q": city, "units": units, "appid": api_key}, None
+
+
+def _is_failure(status_code: int):
+    # 404 and other client errors mean upstream is answering fine.
+    return status_code == 429 or status_code >= 500
+
+
+def _rejected(reason: str, city: str):
+    UPSTREAM_REJECTED.labels(reason=reason).inc()
+    logger.warning("upstream_rejected reason=%s city=%s", reason, city)
+    return None
+
+
+def _batch_timeout():
+    attempts = settings.WEATHER_API_MAX_RETRIES + 1
+    per_attempt = (
+        settings.WEATHER_API_CONNECT_TIMEOUT + settings.WEATHER_API_READ_TIMEOUT
+    )
+    return settings.UPSTREAM_BATCH_WINDOW + attempts * per_attempt
+
+
+def _backoff(attempt: int):
+    # Same schedule as the adapter's connection retries.
+    delay = settings.WEATHER_API_BACKOFF_FACTOR * (2 ** (attempt - 1))
+    return delay + random.random() * settings.WEATHER_API_BACKOFF_JITTER
+
 
 class WeatherAPIClient:
     def __init__(self):
-        self.base_url = "https://api.openweathermap.org/data/2.5/weather"
+        self.base_url = settings.WEATHER_API_BASE_URL
         self.api_key = settings.WEATHER_API_KEY
+        self.session = get_session()
+        self.timeout = (
+            settings.WEATHER_API_CONNECT_TIMEOUT,
+            settings.WEATHER_API_READ_TIMEOUT,
+        )
+
+    def _get(self, url: str, params: dict):
+        # The caller took the first attempt's token; each retry takes its own
+        # and stops with the last response once the budget is spent.
+        for attempt in range(settings.WEATHER_API_MAX_RETRIES + 1):
+            if attempt:
+                if not upstream_budget.acquire():
+                    UPSTREAM_REJECTED.labels(reason="budget").inc()
+                    break
+                time.sleep(_backoff(attempt))
+            response = self.session.get(url, params=params, timeout=self.timeout)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        return response
 
     def get_weather(self, city: str, units: str = "metric"):
-        start_time = time.time()
+        city_id = _batch_id(city)
+        if city_id:
+            try:
+                return _group_batcher.submit(city_id, units).result(_batch_timeout())
+            except TimeoutError:
+                logger.error("group_fetch_timeout city=%s", city)
+                return None
+
+        if not upstream_circuit.allow():
+            return _rejected("circuit_open", city)
+        if not upstream_budget.acquire():
+            return _rejected("budget", city)
+
+        start_time = time.perf_counter()
+        outcome = "error"
         try:
-            response = requests.get(
-                self.base_url,
-                params={"q": city, "units": units, "appid": self.api_key},
-                timeout=10,
-            )
+            params, city_id = _query_params(city, units, self.api_key)
+            response = self._get(self.base_url, params)
+            outcome = str(response.status_code)
+            if _is_failure(response.status_code):
+                upstream_circuit.record_failure()
+            else:
+                upstream_circuit.record_success()
 
             if response.status_code == 200:
                 data = response.json()
+                if city_id is None:
+                    get_city_index().learn(city, data.get("id"))
 
                 return data
+            if response.status_code == 404:
+                WeatherCache.set_not_found(city)
+            return None
+
+        except Exception as e:
+            logger.error("error message='%s' city=%s", e, city)
+            upstream_circuit.record_failure()
+            return None
+        finally:
+            UPSTREAM_LATENCY.labels(outcome=outcome).observe(
+                time.perf_counter() - start_time
+            )
+
+    def get_weather_group(self, city_ids, units: str = "metric"):
+        """One upstream call for several city IDs; returns ``{id: payload}``."""
+        if not upstream_circuit.allow():
+            _rejected("circuit_open", city_ids)
+            return {}
+        if not upstream_budget.acquire():
+            _rejected("budget", city_ids)
+            return {}
+
+        start_time = time.perf_counter()
+        outcome = "error"
+        try:
+            response = self._get(
+                settings.WEATHER_API_GROUP_URL,
+                _group_params(city_ids, units, self.api_key),
+            )
+            outcome = str(response.status_code)
+            if _is_failure(response.status_code):
+                upstream_circuit.record_failure()
             else:
+                upstream_circuit.record_success()
+            if response.status_code == 200:
+                return _group_results(response.json())
+            return {}
+
+        except Exception as e:
+            logger.error("error message='%s' ids=%s", e, city_ids)
+            upstream_circuit.record_failure()
+            return {}
+        finally:
+            UPSTREAM_LATENCY.labels(outcome=outcome).observe(
+                time.perf_counter() - start_time
+            )
+
 
+class AsyncWeatherAPIClient:
+    def __init__(self):
+        self.base_url = settings.WEATHER_API_BASE_URL
+        self.api_key = settings.WEATHER_API_KEY
+        self.client = get_async_client()
+
+    async def _get(self, url: str, params: dict):
+        for attempt in range(settings.WEATHER_API_MAX_RETRIES + 1):
+            if attempt:
+                if not await upstream_budget.aacquire():
+                    UPSTREAM_REJECTED.labels(reason="budget").inc()
+                    break
+                await asyncio.sleep(_backoff(attempt))
+            response = await self.client.get(url, params=params)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        return response
+
+    async def get_weather(self, city: str, units: str = "metric"):
+        city_id = _batch_id(city)
+        if city_id:
+            try:
+                return await asyncio.wait_for(
+                    get_async_batcher().fetch(city_id, units), _batch_timeout()
+                )
+            except asyncio.TimeoutError:
+                logger.error("group_fetch_timeout city=%s", city)
                 return None
 
+        if not await upstream_circuit.aallow():
+            return _rejected("circuit_open", city)
+        if not await upstream_budget.aacquire():
+            return _rejected("budget", city)
+
+        start_time = time.perf_counter()
+        outcome = "error"
+        try:
+            params, city_id = _query_params(city, units, self.api_key)
+            response = await self._get(self.base_url, params)
+            outcome = str(response.status_code)
+            if _is_failure(response.status_code):
+                await upstream_circuit.arecord_failure()
+            else:
+                await upstream_circuit.arecord_success()
+
+            if response.status_code == 200:
+                data = response.json()
+                if city_id is None:
+                    get_city_index().learn(city, data.get("id"))
+                return data
+            if response.status_code == 404:
+                await AsyncWeatherCache.set_not_found(city)
+            return None
+
         except Exception as e:
-            logger.error(f"error message='{str(e)}' city={city}")
+            logger.error("error message='%s' city=%s", e, city)
+            await upstream_circuit.arecord_failure()
             return None
         finally:
-            duration = time.time() - start_time
-            logger.info(
-                f"external_api_latency service=openweathermap city={city} duration={duration:.3f}s "
+            UPSTREAM_LATENCY.labels(outcome=outcome).observe(
+                time.perf_counter() - start_time
+            )
+
+    async def get_weather_group(self, city_ids, units: str = "metric"):
+        if not await upstream_circuit.aallow():
+            _rejected("circuit_open", city_ids)
+            return {}
+        if not await upstream_budget.aacquire():
+            _rejected("budget", city_ids)
+            return {}
+
+        start_time = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await self._get(
+                settings.WEATHER_API_GROUP_URL,
+                _group_params(city_ids, units, self.api_key),
+            )
+            outcome = str(response.status_code)
+            if _is_failure(response.status_code):
+                await upstream_circuit.arecord_failure()
+            else:
+                await upstream_circuit.arecord_success()
+            if response.status_code == 200:
+                return _group_results(response.json())
+            return {}
+
+        except Exception as e:
+            logger.error("error message='%s' ids=%s", e, city_ids)
+            await upstream_circuit.arecord_failure()
+            return {}
+        finally:
+            UPSTREAM_LATENCY.labels(outcome=outcome).observe(
+                time.perf_counter() - start_time
             )
+
+
+# Misses for cities with a known ID are collected for UPSTREAM_BATCH_WINDOW
+# seconds and fetched together through the group endpoint.
+_group_batcher = GroupBatcher(
+    lambda city_ids, units: WeatherAPIClient().get_weather_group(city_ids, units),
+    window=settings.UPSTREAM_BATCH_WINDOW,
+    max_size=settings.UPSTREAM_BATCH_MAX,
+)
+
+
+def get_async_batcher():
+    loop = asyncio.get_running_loop()
+    batcher = _async_batchers.get(loop)
+    if batcher is None:
+        batcher = AsyncGroupBatcher(
+            lambda city_ids, units: AsyncWeatherAPIClient().get_weather_group(
+                city_ids, units
+            ),
+            window=settings.UPSTREAM_BATCH_WINDOW,
+            max_size=settings.UPSTREAM_BATCH_MAX,
+        )
+        _async_batchers[loop] = batcher
+    return batcher
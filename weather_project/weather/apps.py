@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class WeatherConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "weather"
+
+    def ready(self):
+        if settings.LOG_QUEUE:
+            from .log import start_queue_listener
+
+            start_queue_listener()
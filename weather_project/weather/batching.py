@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger("weather")
+
+
+def _chunks(waiters: dict, size: int):
+    ids = list(waiters)
+    for start in range(0, len(ids), size):
+        yield {city_id: waiters[city_id] for city_id in ids[start : start + size]}
+
+
+class GroupBatcher:
+    """Coalesces single-city lookups into multi-city upstream calls.
+
+    The first lookup after an idle period opens a ``window``-second batch;
+    everything that arrives meanwhile, up to ``max_size`` distinct IDs per
+    unit system, is resolved by one ``fetch_group(ids, units)`` call, which
+    returns ``{id: payload}``. Callers asking for the same ID share a result.
+    """
+
+    def __init__(self, fetch_group, window: float, max_size: int, workers: int = 4):
+        self.fetch_group = fetch_group
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._opened_at = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._calls = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="weather-group"
+        )
+
+    def submit(self, city_id: int, units: str):
+        future = Future()
+        with self._lock:
+            self._ensure_started()
+            waiters = self._pending.setdefault(units, {})
+            waiters.setdefault(city_id, []).append(future)
+            if self._opened_at is None:
+                self._opened_at = time.monotonic()
+            self._wakeup.notify()
+        return future
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="weather-group-batcher", daemon=True
+            )
+            self._thread.start()
+
+    def _full(self):
+        return any(len(waiters) >= self.max_size for waiters in self._pending.values())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                while not self._full():
+                    remaining = self._opened_at + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                pending, self._pending, self._opened_at = self._pending, {}, None
+            for units, waiters in pending.items():
+                for chunk in _chunks(waiters, self.max_size):
+                    self._calls.submit(self._resolve, units, chunk)
+
+    def _resolve(self, units: str, waiters: dict):
+        try:
+            results = self.fetch_group(list(waiters), units)
+        except Exception as e:
+            logger.error("group_fetch_error ids=%s error='%s'", len(waiters), e)
+            results = {}
+        for city_id, futures in waiters.items():
+            for future in futures:
+                future.set_result(results.get(city_id))
+
+
+class AsyncGroupBatcher:
+    """:class:`GroupBatcher` for one event loop; ``fetch_group`` is a coroutine."""
+
+    def __init__(self, fetch_group, window: float, max_size: int):
+        self.fetch_group = fetch_group
+        self.window = window
+        self.max_size = max_size
+        self._pending = {}
+        self._timers = {}
+        self._tasks = set()
+
+    async def fetch(self, city_id: int, units: str):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiters = self._pending.setdefault(units, {})
+        waiters.setdefault(city_id, []).append(future)
+        if len(waiters) >= self.max_size:
+            self._flush(units)
+        elif units not in self._timers:
+            self._timers[units] = loop.call_later(self.window, self._flush, units)
+        return await future
+
+    def _flush(self, units: str):
+        timer = self._timers.pop(units, None)
+        if timer is not None:
+            timer.cancel()
+        waiters = self._pending.pop(units, None)
+        if not waiters:
+            return
+        task = asyncio.ensure_future(self._resolve(units, waiters))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, units: str, waiters: dict):
+        try:
+            results = await self.fetch_group(list(waiters), units)
+        except Exception as e:
+            logger.error("group_fetch_error ids=%s error='%s'", len(waiters), e)
+            results = {}
+        for city_id, futures in waiters.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(city_id))
@@ -0,0 +1,108 @@
+import hashlib
+import math
+import threading
+import time
+
+# Sets every bit in one round trip; the TTL is only set when the bitmap is
+# created, so the whole filter starts over once per ``ttl``.
+BLOOM_ADD = """
+for i = 1, #ARGV - 1 do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+end
+if redis.call('PTTL', KEYS[1]) < 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[#ARGV])
+end
+return 1
+"""
+
+
+class BloomFilter:
+    """Bloom filter kept in a Redis bitmap and checked against a local copy.
+
+    Adds go to Redis, so all workers share the filter. Lookups read a
+    snapshot of the bitmap fetched at most every ``refresh_interval``
+    seconds, so checking costs no round trip; an item another worker added
+    shows up here after the next refresh. Callers pass the Redis client, and
+    when Redis is unavailable the filter keeps working on the local copy.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        capacity: int,
+        error_rate: float,
+        refresh_interval: float,
+        ttl: float,
+    ):
+        self.key = key
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self._bits = bytearray(self.size // 8 + 1)
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, client, item: str):
+        positions = self.positions(item)
+        self._set_local(positions)
+        client.register_script(BLOOM_ADD)(
+            keys=[self.key], args=[*positions, int(self.ttl * 1000)]
+        )
+
+    async def aadd(self, client, item: str):
+        positions = self.positions(item)
+        self._set_local(positions)
+        await client.register_script(BLOOM_ADD)(
+            keys=[self.key], args=[*positions, int(self.ttl * 1000)]
+        )
+
+    def contains(self, client, item: str):
+        if self._needs_refresh():
+            self._load(client.get(self.key))
+        return self._check(item)
+
+    async def acontains(self, client, item: str):
+        if self._needs_refresh():
+            self._load(await client.get(self.key))
+        return self._check(item)
+
+    def clear_local(self):
+        self._bits = bytearray(self.size // 8 + 1)
+        self._refreshed_at = 0.0
+
+    def _needs_refresh(self):
+        if time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return False
+        # One caller refreshes; the rest keep using the current snapshot.
+        if not self._lock.acquire(blocking=False):
+            return False
+        self._refreshed_at = time.monotonic()
+        self._lock.release()
+        return True
+
+    def _load(self, raw):
+        bits = bytearray(raw or b"")
+        bits.extend(bytes(self.size // 8 + 1 - len(bits)))
+        self._bits = bits
+
+    def _set_local(self, positions):
+        bits = self._bits
+        for position in positions:
+            bits[position >> 3] |= 0x80 >> (position & 7)
+
+    def _check(self, item: str):
+        bits = self._bits
+        # Redis numbers bits from the most significant bit of each byte.
+        return all(
+            bits[position >> 3] & (0x80 >> (position & 7))
+            for position in self.positions(item)
+        )
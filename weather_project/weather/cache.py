@@ -1,84 +1,524 @@
+import asyncio
 import logging
+import weakref
+from contextlib import asynccontextmanager, contextmanager
 from datetime import timedelta
 
+import redis.asyncio
+from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
+from django_redis import get_redis_connection
 from redis.exceptions import ConnectionError as RedisConnectionError
 
-from .models import WeatherQuery
+from .bloom import BloomFilter
+from .cities import get_city_index
+from .local_cache import LocalCache
+from .metrics import CACHE_LATENCY, CACHE_LOOKUPS
+from .models import WeatherQuery, normalize_city
+from .units import CANONICAL_UNITS, convert_temperature
 
 logger = logging.getLogger("weather")
 
+# Entries are fresh for the soft TTL; after that they may still be served,
+# flagged as stale, until the hard TTL drops them from Redis.
+FRESHNESS_WINDOW = timedelta(seconds=settings.WEATHER_CACHE_SOFT_TTL)
+STALE_WINDOW = timedelta(seconds=settings.WEATHER_CACHE_HARD_TTL)
+
+_async_redis = weakref.WeakKeyDictionary()
+_local_cache = LocalCache(
+    max_entries=settings.WEATHER_L1_MAX_ENTRIES,
+    max_bytes=settings.WEATHER_L1_MAX_BYTES,
+)
+# Names upstream answered 404 for. Only a hit here costs a Redis lookup of
+# the short-lived negative entry, which also covers false positives.
+unknown_cities = BloomFilter(
+    cache.make_key("unknown_cities"),
+    capacity=settings.CITY_BLOOM_CAPACITY,
+    error_rate=settings.CITY_BLOOM_ERROR_RATE,
+    refresh_interval=settings.CITY_BLOOM_REFRESH_INTERVAL,
+    ttl=settings.CITY_BLOOM_TTL,
+)
+
+
+def get_async_redis():
+    # django-redis has no asyncio client, so async code talks to the same
+    # Redis directly and reuses the cache backend's key and value encoding.
+    loop = asyncio.get_running_loop()
+    client = _async_redis.get(loop)
+    if client is None:
+        client = redis.asyncio.from_url(settings.CACHES["default"]["LOCATION"])
+        _async_redis[loop] = client
+    return client
+
 
 class WeatherCache:
+    @staticmethod
+    def make_key(city: str, units: str):
+        # Spellings that resolve to the same city share one key.
+        city_id = get_city_index().resolve(city)
+        if city_id:
+            return f"weather_id{city_id}_{units}"
+        return f"weather_{normalize_city(city)}_{units}"
+
     @staticmethod
     def get_cached_weather(city: str, units: str):
 
+        local_data = WeatherCache._get_from_local(city, units)
+        if local_data:
+            return local_data
+
         redis_data = WeatherCache._get_from_redis(city, units)
         if redis_data:
+            WeatherCache._set_to_local(city, units, redis_data)
             return redis_data
 
         return WeatherCache._get_from_db(city, units)
 
+    @staticmethod
+    def age(data):
+        timestamp = (
+            data.get("timestamp")
+            if isinstance(data, dict)
+            else getattr(data, "timestamp", None)
+        )
+        if timestamp is None:
+            return None
+        return timezone.now() - timestamp
+
+    @staticmethod
+    def is_stale(data):
+        age = WeatherCache.age(data)
+        return age is not None and age >= FRESHNESS_WINDOW
+
+    @staticmethod
+    def get_stale_from_db(city: str, units: str):
+        # Last resort when upstream fails: the newest row within the hard TTL.
+        try:
+            result = WeatherCache._fresh_queries(city, STALE_WINDOW).first()
+            if result:
+                CACHE_LOOKUPS.labels(tier="db_stale", result="hit").inc()
+            return result
+        except Exception as e:
+            logger.error("db_cache_error error='%s'", e)
+            return None
+
+    @staticmethod
+    def get_many_cached(cities, units: str):
+        # One MGET for the whole batch. Returns None when Redis is down so
+        # callers can fall back to per-city lookups (which include the DB).
+        found = {}
+        for city in cities:
+            local_data = WeatherCache._get_from_local(city, units)
+            if local_data:
+                found[city] = local_data
+        try:
+            keys = {
+                WeatherCache.make_key(city, units): city
+                for city in cities
+                if city not in found
+            }
+            redis_data = {}
+            if keys:
+                with CACHE_LATENCY.labels(tier="redis", operation="get_many").time():
+                    redis_data = cache.get_many(list(keys))
+            for key, value in redis_data.items():
+                if value:
+                    found[keys[key]] = value
+                    WeatherCache._set_to_local(keys[key], units, value)
+            CACHE_LOOKUPS.labels(tier="redis", result="hit").inc(len(redis_data))
+            CACHE_LOOKUPS.labels(tier="redis", result="miss").inc(
+                len(keys) - len(redis_data)
+            )
+            logger.info("redis_cache_batch hits=%s keys=%s", len(redis_data), len(keys))
+            return found
+        except RedisConnectionError:
+            logger.warning("redis_unavailable_fallback_to_db")
+            return None
+        except Exception as e:
+            logger.error("redis_error error='%s'", e)
+            return None
+
     @staticmethod
     def _get_from_redis(city: str, units: str):
         try:
-            cache_key = f"weather_{city.lower()}_{units}"
-            cached_data = cache.get(cache_key)
+            cache_key = WeatherCache.make_key(city, units)
+            with CACHE_LATENCY.labels(tier="redis", operation="get").time():
+                cached_data = cache.get(cache_key)
             if cached_data:
-                logger.info(f"redis_cache_hit city={city}")
+                CACHE_LOOKUPS.labels(tier="redis", result="hit").inc()
+                logger.info("redis_cache_hit city=%s", city)
                 return cached_data
+            CACHE_LOOKUPS.labels(tier="redis", result="miss").inc()
             return None
         except RedisConnectionError:
             logger.warning("redis_unavailable_fallback_to_db")
             return None
         except Exception as e:
-            logger.error(f"redis_error error='{str(e)}'")
+            logger.error("redis_error error='%s'", e)
+            return None
+
+    @staticmethod
+    def _get_from_local(city: str, units: str):
+        if not settings.WEATHER_L1_ENABLED:
             return None
+        cached_data = _local_cache.get(WeatherCache.make_key(city, units))
+        if cached_data:
+            CACHE_LOOKUPS.labels(tier="l1", result="hit").inc()
+            logger.debug("l1_cache_hit city=%s", city)
+            return cached_data
+        CACHE_LOOKUPS.labels(tier="l1", result="miss").inc()
+        return None
+
+    @staticmethod
+    def _set_to_local(city: str, units: str, data):
+        if not settings.WEATHER_L1_ENABLED:
+            return
+        ttl = settings.WEATHER_L1_TTL
+        timestamp = data.get("timestamp") if isinstance(data, dict) else None
+        if timestamp:
+            # L1 stops at the soft TTL, so a stale entry is always read from
+            # Redis and goes through the stale-serving and revalidation path.
+            remaining = timestamp + FRESHNESS_WINDOW - timezone.now()
+            ttl = min(ttl, remaining.total_seconds())
+        _local_cache.set(WeatherCache.make_key(city, units), data, ttl)
+
+    @staticmethod
+    def clear_local():
+        _local_cache.clear()
+
+    @staticmethod
+    def history_key(city: str):
+        # History rows are keyed by the name upstream answered with, so a
+        # spelling the index resolves is looked up under that city's name.
+        index = get_city_index()
+        city_id = index.resolve(city)
+        known = index.get(city_id) if city_id else None
+        return normalize_city(known.name if known else city.split(",")[0])
+
+    @staticmethod
+    def _fresh_queries(city: str, window: timedelta = FRESHNESS_WINDOW):
+        # Any unit system will do; rows are converted when they are served.
+        return WeatherQuery.objects.filter(
+            city_key=WeatherCache.history_key(city),
+            timestamp__gte=timezone.now() - window,
+            served_from_cache=False,
+        ).order_by("-timestamp")
 
     @staticmethod
     def _get_from_db(city: str, units: str):
         try:
-            five_min_ago = timezone.now() - timedelta(minutes=5)
-
-            result = WeatherQuery.objects.filter(
-                city_name__iexact=city,
-                units=units,
-                timestamp__gte=five_min_ago,
-                served_from_cache=False,
-            ).first()
+            with CACHE_LATENCY.labels(tier="db", operation="get").time():
+                result = WeatherCache._fresh_queries(city).first()
 
             if result:
-                logger.info(f"db_cache_hit city={city}")
+                CACHE_LOOKUPS.labels(tier="db", result="hit").inc()
+                logger.info("db_cache_hit city=%s", city)
 
                 WeatherCache._set_to_redis(city, units, result)
+            else:
+                CACHE_LOOKUPS.labels(tier="db", result="miss").inc()
 
             return result
         except Exception as e:
-            logger.error(f"db_cache_error error='{str(e)}'")
+            logger.error("db_cache_error error='%s'", e)
             return None
 
     @staticmethod
-    def set_cached_weather(city: str, units: str, data, timeout: int = 300):
+    def get_many_from_db(cities, units: str):
+        # Batch counterpart of _get_from_db: one query for all the cities,
+        # newest rows first, keeping the first row seen per history key.
+        try:
+            waiting = {}
+            for city in cities:
+                waiting.setdefault(WeatherCache.history_key(city), []).append(city)
+            found = {}
+            with CACHE_LATENCY.labels(tier="db", operation="get_many").time():
+                rows = WeatherQuery.objects.filter(
+                    city_key__in=list(waiting),
+                    timestamp__gte=timezone.now() - FRESHNESS_WINDOW,
+                    served_from_cache=False,
+                ).order_by("-timestamp")
+                for row in rows.iterator():
+                    for city in waiting.pop(row.city_key, ()):
+                        found[city] = row
+                    if not waiting:
+                        break
+            for city, row in found.items():
+                WeatherCache._set_to_redis(city, units, row)
+            CACHE_LOOKUPS.labels(tier="db", result="hit").inc(len(found))
+            CACHE_LOOKUPS.labels(tier="db", result="miss").inc(len(cities) - len(found))
+            logger.info("db_cache_batch hits=%s keys=%s", len(found), len(cities))
+            return found
+        except Exception as e:
+            logger.error("db_cache_error error='%s'", e)
+            return {}
+
+    @staticmethod
+    def set_cached_weather(city: str, units: str, data, timeout: int = None):
+        WeatherCache._set_to_local(city, units, data)
         try:
-            cache_key = f"weather_{city.lower()}_{units}"
-            cache.set(cache_key, data, timeout)
-            logger.debug(f"cache_set_redis city={city}")
+            cache_key = WeatherCache.make_key(city, units)
+            with CACHE_LATENCY.labels(tier="redis", operation="set").time():
+                cache.set(cache_key, data, WeatherCache._redis_timeout(data, timeout))
+            logger.debug("cache_set_redis city=%s", city)
         except RedisConnectionError:
             logger.warning("redis_unavailable_cannot_set")
         except Exception as e:
-            logger.error(f"cache_set_error error='{str(e)}'")
+            logger.error("cache_set_error error='%s'", e)
+
+    @staticmethod
+    def _not_found_key(city: str):
+        return cache.make_key(f"notfound_{normalize_city(city)}")
 
     @staticmethod
-    def _set_to_redis(city: str, units: str, weather_query, timeout: int = 300):
+    def set_not_found(city: str):
+        # Only for a definite 404; errors and rejected calls are not cached.
+        if not settings.NEGATIVE_CACHE_TTL:
+            return
         try:
-            cache_data = {
-                "city_name": weather_query.city_name,
-                "temperature": weather_query.temperature,
-                "weather_description": weather_query.weather_description,
-                "units": weather_query.units,
-                "timestamp": weather_query.timestamp,
-            }
+            client = get_redis_connection("default")
+            client.set(
+                WeatherCache._not_found_key(city), 1, ex=settings.NEGATIVE_CACHE_TTL
+            )
+            unknown_cities.add(client, normalize_city(city))
+        except Exception as e:
+            logger.warning("negative_cache_set_error city=%s error='%s'", city, e)
+
+    @staticmethod
+    def is_not_found(city: str):
+        if not settings.NEGATIVE_CACHE_TTL:
+            return False
+        try:
+            client = get_redis_connection("default")
+            if not unknown_cities.contains(client, normalize_city(city)):
+                return False
+            found = bool(client.exists(WeatherCache._not_found_key(city)))
+        except Exception as e:
+            logger.warning("negative_cache_error city=%s error='%s'", city, e)
+            return False
+        CACHE_LOOKUPS.labels(tier="negative", result="hit" if found else "miss").inc()
+        return found
+
+    @staticmethod
+    def _redis_timeout(data, timeout: int = None):
+        # Keep entries until the hard TTL, counted from when they were fetched.
+        if timeout is not None:
+            return timeout
+        age = WeatherCache.age(data)
+        if age is None:
+            return settings.WEATHER_CACHE_HARD_TTL
+        return max(1, int((STALE_WINDOW - age).total_seconds()))
+
+    @staticmethod
+    def ttl(city: str, units: str):
+        # Seconds until the entry goes stale; 0 when it is stale or missing.
+        ttl = cache.ttl(WeatherCache.make_key(city, units))
+        if ttl is None:
+            return None
+        return max(0, ttl - (STALE_WINDOW - FRESHNESS_WINDOW).total_seconds())
+
+    @staticmethod
+    @contextmanager
+    def fetch_lock(city: str, units: str):
+        # Cross-process guard so only one worker refills an expired key.
+        # Yields True when another worker held the lock and we had to wait,
+        # meaning the key has likely been refilled in the meantime.
+        lock = None
+        contended = False
+        try:
+            lock = cache.lock(
+                f"lock_{WeatherCache.make_key(city, units)}",
+                timeout=settings.SINGLE_FLIGHT_LOCK_TIMEOUT,
+            )
+            if not lock.acquire(blocking=False):
+                contended = True
+                logger.info("fetch_lock_wait city=%s units=%s", city, units)
+                if not lock.acquire(
+                    blocking_timeout=settings.SINGLE_FLIGHT_WAIT_TIMEOUT
+                ):
+                    logger.warning("fetch_lock_timeout city=%s units=%s", city, units)
+                    lock = None
+        except RedisConnectionError:
+            logger.warning("redis_unavailable_no_fetch_lock")
+            lock = None
+        except Exception as e:
+            logger.error("fetch_lock_error error='%s'", e)
+            lock = None
+
+        try:
+            yield contended
+        finally:
+            if lock is not None:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logger.warning("fetch_lock_release_error error='%s'", e)
+
+    @staticmethod
+    def _query_to_cache_data(weather_query):
+        return {
+            "city_name": weather_query.city_name,
+            "temperature": convert_temperature(
+                weather_query.temperature, weather_query.units, CANONICAL_UNITS
+            ),
+            "weather_description": weather_query.weather_description,
+            "units": CANONICAL_UNITS,
+            "timestamp": weather_query.timestamp,
+        }
+
+    @staticmethod
+    def _set_to_redis(city: str, units: str, weather_query, timeout: int = None):
+        try:
+            cache_data = WeatherCache._query_to_cache_data(weather_query)
             WeatherCache.set_cached_weather(city, units, cache_data, timeout)
         except Exception as e:
-            logger.error(f"redis_set_conversion_error error='{str(e)}'")
+            logger.error("redis_set_conversion_error error='%s'", e)
+
+
+class AsyncWeatherCache:
+    @staticmethod
+    async def get_cached_weather(city: str, units: str):
+
+        local_data = WeatherCache._get_from_local(city, units)
+        if local_data:
+            return local_data
+
+        redis_data = await AsyncWeatherCache._get_from_redis(city, units)
+        if redis_data:
+            WeatherCache._set_to_local(city, units, redis_data)
+            return redis_data
+
+        return await AsyncWeatherCache._get_from_db(city, units)
+
+    @staticmethod
+    async def _get_from_redis(city: str, units: str):
+        try:
+            cache_key = cache.make_key(WeatherCache.make_key(city, units))
+            with CACHE_LATENCY.labels(tier="redis", operation="get").time():
+                cached_data = await get_async_redis().get(cache_key)
+            if cached_data is not None:
+                CACHE_LOOKUPS.labels(tier="redis", result="hit").inc()
+                logger.info("redis_cache_hit city=%s", city)
+                return cache.client.decode(cached_data)
+            CACHE_LOOKUPS.labels(tier="redis", result="miss").inc()
+            return None
+        except RedisConnectionError:
+            logger.warning("redis_unavailable_fallback_to_db")
+            return None
+        except Exception as e:
+            logger.error("redis_error error='%s'", e)
+            return None
+
+    @staticmethod
+    async def _get_from_db(city: str, units: str):
+        try:
+            with CACHE_LATENCY.labels(tier="db", operation="get").time():
+                result = await WeatherCache._fresh_queries(city).afirst()
+
+            if result:
+                CACHE_LOOKUPS.labels(tier="db", result="hit").inc()
+                logger.info("db_cache_hit city=%s", city)
+
+                await AsyncWeatherCache.set_cached_weather(
+                    city, units, WeatherCache._query_to_cache_data(result)
+                )
+            else:
+                CACHE_LOOKUPS.labels(tier="db", result="miss").inc()
+
+            return result
+        except Exception as e:
+            logger.error("db_cache_error error='%s'", e)
+            return None
+
+    @staticmethod
+    async def get_stale_from_db(city: str, units: str):
+        try:
+            result = await WeatherCache._fresh_queries(city, STALE_WINDOW).afirst()
+            if result:
+                CACHE_LOOKUPS.labels(tier="db_stale", result="hit").inc()
+            return result
+        except Exception as e:
+            logger.error("db_cache_error error='%s'", e)
+            return None
+
+    @staticmethod
+    async def set_cached_weather(city: str, units: str, data, timeout: int = None):
+        WeatherCache._set_to_local(city, units, data)
+        try:
+            cache_key = cache.make_key(WeatherCache.make_key(city, units))
+            with CACHE_LATENCY.labels(tier="redis", operation="set").time():
+                await get_async_redis().set(
+                    cache_key,
+                    cache.client.encode(data),
+                    ex=WeatherCache._redis_timeout(data, timeout),
+                )
+            logger.debug("cache_set_redis city=%s", city)
+        except RedisConnectionError:
+            logger.warning("redis_unavailable_cannot_set")
+        except Exception as e:
+            logger.error("cache_set_error error='%s'", e)
+
+    @staticmethod
+    async def set_not_found(city: str):
+        if not settings.NEGATIVE_CACHE_TTL:
+            return
+        try:
+            client = get_async_redis()
+            await client.set(
+                WeatherCache._not_found_key(city), 1, ex=settings.NEGATIVE_CACHE_TTL
+            )
+            await unknown_cities.aadd(client, normalize_city(city))
+        except Exception as e:
+            logger.warning("negative_cache_set_error city=%s error='%s'", city, e)
+
+    @staticmethod
+    async def is_not_found(city: str):
+        if not settings.NEGATIVE_CACHE_TTL:
+            return False
+        try:
+            client = get_async_redis()
+            if not await unknown_cities.acontains(client, normalize_city(city)):
+                return False
+            found = bool(await client.exists(WeatherCache._not_found_key(city)))
+        except Exception as e:
+            logger.warning("negative_cache_error city=%s error='%s'", city, e)
+            return False
+        CACHE_LOOKUPS.labels(tier="negative", result="hit" if found else "miss").inc()
+        return found
+
+    @staticmethod
+    @asynccontextmanager
+    async def fetch_lock(city: str, units: str):
+        # Same lock key as WeatherCache.fetch_lock, so sync and async
+        # workers coalesce with each other.
+        lock = None
+        contended = False
+        try:
+            lock = get_async_redis().lock(
+                cache.make_key(f"lock_{WeatherCache.make_key(city, units)}"),
+                timeout=settings.SINGLE_FLIGHT_LOCK_TIMEOUT,
+            )
+            if not await lock.acquire(blocking=False):
+                contended = True
+                logger.info("fetch_lock_wait city=%s units=%s", city, units)
+                if not await lock.acquire(
+                    blocking_timeout=settings.SINGLE_FLIGHT_WAIT_TIMEOUT
+                ):
+                    logger.warning("fetch_lock_timeout city=%s units=%s", city, units)
+                    lock = None
+        except RedisConnectionError:
+            logger.warning("redis_unavailable_no_fetch_lock")
+            lock = None
+        except Exception as e:
+            logger.error("fetch_lock_error error='%s'", e)
+            lock = None
+
+        try:
+            yield contended
+        finally:
+            if lock is not None:
+                try:
+                    await lock.release()
+                except Exception as e:
+                    logger.warning("fetch_lock_release_error error='%s'", e)
@@ -0,0 +1,197 @@
+import bisect
+import difflib
+import functools
+import gzip
+import json
+import logging
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass
+
+from django.conf import settings
+
+logger = logging.getLogger("weather")
+
+
+@dataclass(frozen=True)
+class City:
+    id: int
+    name: str
+    country: str
+    lat: float
+    lon: float
+
+
+def fold(text: str):
+    """Case-, accent- and whitespace-insensitive form used for lookups."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+class CityIndex:
+    """In-memory index of OpenWeatherMap cities for resolving user input to an ID.
+
+    Names map to city IDs ordered by preference: population when the list
+    carries it, otherwise the lowest ID, which for OpenWeatherMap's list is
+    the long-established entry (London, GB before London, CA). Queries that
+    the list cannot resolve are learned from upstream responses.
+
+    A request resolves its input several times (cache key, history key,
+    hot keys), so the last ``resolve_cache_size`` answers are memoized;
+    learning an alias clears them.
+    """
+
+    def __init__(
+        self,
+        cities=(),
+        fuzzy_cutoff: float = 0.0,
+        max_aliases: int = 0,
+        resolve_cache_size: int = 4096,
+    ):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.max_aliases = max_aliases
+        self.resolve = functools.lru_cache(maxsize=resolve_cache_size)(self._resolve)
+        self._cities = {}
+        ranked = {}
+        for city, population in cities:
+            self._cities[city.id] = city
+            ranked.setdefault(fold(city.name), []).append((-population, city.id))
+        self._by_name = {
+            name: tuple(city_id for _, city_id in sorted(ids))
+            for name, ids in ranked.items()
+        }
+        self._names = sorted(self._by_name)
+        self._aliases = {}
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        """Load OpenWeatherMap's bulk ``city.list.json`` (optionally gzipped)."""
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            raw = json.load(f)
+        cities = (
+            (
+                City(
+                    id=entry["id"],
+                    name=entry["name"],
+                    country=entry.get("country", ""),
+                    lat=entry["coord"]["lat"],
+                    lon=entry["coord"]["lon"],
+                ),
+                entry.get("population", 0),
+            )
+            for entry in raw
+        )
+        return cls(cities, **kwargs)
+
+    def __len__(self):
+        return len(self._cities)
+
+    def get(self, city_id: int):
+        return self._cities.get(city_id)
+
+    def _resolve(self, query: str):
+        """Return the city ID for ``"name"`` or ``"name,CC"``, or None."""
+        folded = fold(query)
+        if not folded:
+            return None
+        if folded in self._aliases:
+            return self._aliases[folded]
+
+        name, _, rest = folded.partition(",")
+        name = name.strip()
+        country = rest.rsplit(",", 1)[-1].strip().upper()
+        ids = self._by_name.get(name)
+        if ids is None:
+            match = self._closest(name)
+            if match is None:
+                return None
+            ids = self._by_name[match]
+        if country:
+            ids = [i for i in ids if self._cities[i].country == country]
+        return ids[0] if ids else None
+
+    def search(self, prefix: str, limit: int = 10):
+        """Cities whose name starts with ``prefix``, preferred entry first."""
+        folded = fold(prefix)
+        if not folded:
+            return []
+        results = []
+        start = bisect.bisect_left(self._names, folded)
+        for name in self._names[start:]:
+            if not name.startswith(folded) or len(results) >= limit:
+                break
+            for city_id in self._by_name[name]:
+                results.append(self._cities[city_id])
+                if len(results) >= limit:
+                    break
+        return results
+
+    def learn(self, query: str, city_id):
+        if not city_id or len(self._aliases) >= self.max_aliases:
+            return
+        folded = fold(query)
+        if folded and self.resolve(query) is None:
+            self._aliases[folded] = city_id
+            self.resolve.cache_clear()
+
+    def _closest(self, name: str):
+        # Only compare against names sharing the first two characters, which
+        # keeps a typo lookup to a few hundred candidates on the full list.
+        if not self.fuzzy_cutoff or len(name) < 4:
+            return None
+        start = bisect.bisect_left(self._names, name[:2])
+        end = bisect.bisect_left(self._names, name[:2] + "\uffff")
+        matches = difflib.get_close_matches(
+            name, self._names[start:end], n=1, cutoff=self.fuzzy_cutoff
+        )
+        return matches[0] if matches else None
+
+
+_city_index = None
+_empty_index = CityIndex()
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_city_index():
+    """Process-wide index; empty when CITY_LIST_PATH is unset.
+
+    The full list takes seconds to parse, so it is loaded on a background
+    thread. Until then lookups fall back to name-based keys.
+    """
+    global _loader
+    if _city_index is not None:
+        return _city_index
+    if settings.CITY_LIST_PATH and _loader is None:
+        with _loader_lock:
+            if _loader is None:
+                _loader = threading.Thread(
+                    target=_load_city_index, name="weather-city-index", daemon=True
+                )
+                _loader.start()
+    return _empty_index
+
+
+def _load_city_index():
+    global _city_index
+    path = settings.CITY_LIST_PATH
+    start_time = time.perf_counter()
+    try:
+        index = CityIndex.from_file(
+            path,
+            fuzzy_cutoff=settings.CITY_FUZZY_CUTOFF,
+            max_aliases=settings.CITY_MAX_ALIASES,
+            resolve_cache_size=settings.CITY_RESOLVE_CACHE_SIZE,
+        )
+    except (OSError, ValueError, KeyError) as e:
+        logger.error("city_index_load_error path=%s error='%s'", path, e)
+        return
+    _city_index = index
+    logger.info(
+        "city_index_loaded cities=%s duration_ms=%.0f",
+        len(index),
+        (time.perf_counter() - start_time) * 1000,
+    )
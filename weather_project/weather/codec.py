@@ -0,0 +1,109 @@
+import pickle
+import zlib
+from datetime import datetime, timezone
+
+import msgpack
+from django_redis.serializers.base import BaseSerializer
+
+# Weather entries are stored as a msgpack array of these fields, with the
+# timestamp as integer microseconds since the epoch:
+#
+#   b"W" | header | msgpack([city_name, temperature, description, units, ts])
+#
+# The header byte carries the format version in its low bits and a zlib flag
+# in the high bit. Every other value, and entries written before this format
+# existed, are plain pickles, which always start with b"\x80".
+WEATHER_FIELDS = (
+    "city_name",
+    "temperature",
+    "weather_description",
+    "units",
+    "timestamp",
+)
+WEATHER_TAG = b"W"
+FORMAT_VERSION = 1
+COMPRESSED = 0x80
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_micros(timestamp: datetime):
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _from_micros(micros: int):
+    seconds, micros = divmod(micros, 1_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=micros)
+
+
+def is_weather_entry(value):
+    return (
+        isinstance(value, dict)
+        and value.keys() == set(WEATHER_FIELDS)
+        and isinstance(value["timestamp"], datetime)
+        and value["timestamp"].tzinfo is not None
+    )
+
+
+def encode_weather(value: dict, compress_min_bytes: int = 0):
+    body = msgpack.packb(
+        [
+            value["city_name"],
+            value["temperature"],
+            value["weather_description"],
+            value["units"],
+            _to_micros(value["timestamp"]),
+        ],
+        use_bin_type=True,
+    )
+    header = FORMAT_VERSION
+    if compress_min_bytes and len(body) >= compress_min_bytes:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            header |= COMPRESSED
+    return WEATHER_TAG + bytes([header]) + body
+
+
+def decode_weather(payload: bytes):
+    header = payload[1]
+    version = header & ~COMPRESSED
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported weather cache format version {version}")
+    body = payload[2:]
+    if header & COMPRESSED:
+        body = zlib.decompress(body)
+    city_name, temperature, description, units, micros = msgpack.unpackb(
+        body, raw=False
+    )
+    return {
+        "city_name": city_name,
+        "temperature": temperature,
+        "weather_description": description,
+        "units": units,
+        "timestamp": _from_micros(micros),
+    }
+
+
+class WeatherSerializer(BaseSerializer):
+    """django-redis serializer: compact format for weather entries, pickle otherwise.
+
+    Configure the compression threshold with the ``COMPRESS_MIN_BYTES`` cache
+    option (0 disables compression).
+    """
+
+    def __init__(self, options):
+        super().__init__(options=options)
+        self.compress_min_bytes = options.get("COMPRESS_MIN_BYTES", 0)
+
+    def dumps(self, value):
+        if is_weather_entry(value):
+            return encode_weather(value, self.compress_min_bytes)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, value):
+        if value[:1] == WEATHER_TAG:
+            return decode_weather(value)
+        return pickle.loads(value)
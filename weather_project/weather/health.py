@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+import redis
+import requests
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from .api_client import upstream_budget, upstream_circuit
+
+logger = logging.getLogger("weather")
+
+# Readiness only depends on our own backing services; an upstream outage is
+# reported but still lets the instance serve cached data.
+CRITICAL_CHECKS = ("database", "redis")
+
+
+_probe_redis = None
+
+
+def check_database():
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            timeout = int(settings.HEALTH_PROBE_TIMEOUT * 1000)
+            cursor.execute("SET LOCAL statement_timeout = %s", [timeout])
+        cursor.execute("SELECT 1")
+
+
+def check_redis():
+    # A client of its own with socket timeouts, so a hung Redis fails the
+    # check instead of blocking the prober (or a first readiness request).
+    global _probe_redis
+    if _probe_redis is None:
+        _probe_redis = redis.Redis.from_url(
+            settings.CACHES["default"]["LOCATION"],
+            socket_timeout=settings.HEALTH_PROBE_TIMEOUT,
+            socket_connect_timeout=settings.HEALTH_PROBE_TIMEOUT,
+        )
+    _probe_redis.ping()
+
+
+def check_upstream():
+    # Any answer below 500 (typically 401 without a city) means the API is
+    # reachable; no weather is fetched and no history row is written.
+    response = requests.get(
+        settings.WEATHER_API_BASE_URL, timeout=settings.HEALTH_PROBE_TIMEOUT
+    )
+    if response.status_code >= 500:
+        raise RuntimeError(f"upstream returned {response.status_code}")
+
+
+def check_upstream_guard():
+    details = {
+        "circuit": upstream_circuit.state(),
+        "budget_tokens": upstream_budget.tokens(),
+    }
+    if details["circuit"]["state"] == "open":
+        raise RuntimeError("upstream circuit is open")
+    return details
+
+
+class HealthProber:
+    """Runs dependency checks on a background thread and keeps the results.
+
+    Health endpoints read :meth:`snapshot` and never touch the dependencies
+    themselves, so a probe costs microseconds regardless of their state.
+    """
+
+    def __init__(self, checks: dict, interval: float):
+        self.checks = checks
+        self.interval = interval
+        self._results = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._first_probe_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def probe(self, names=None):
+        for name, check in self.checks.items():
+            if names is not None and name not in names:
+                continue
+            start_time = time.perf_counter()
+            error = None
+            details = None
+            try:
+                outcome = check()
+                if isinstance(outcome, dict):
+                    details = outcome
+            except Exception as e:
+                error = str(e)
+                logger.warning("health_check_failed check=%s error='%s'", name, error)
+            result = {
+                "healthy": error is None,
+                "latency_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                "checked_at": timezone.now(),
+                "error": error,
+                "details": details,
+            }
+            with self._lock:
+                self._results[name] = result
+
+    def snapshot(self, required=()):
+        """Latest results; ``required`` checks never run yet are run inline.
+
+        This only happens before the background thread's first pass, e.g.
+        on a worker's first readiness probe.
+        """
+        self._ensure_started()
+        if self._missing(required):
+            with self._first_probe_lock:
+                missing = self._missing(required)
+                if missing:
+                    self.probe(missing)
+        with self._lock:
+            return {name: dict(result) for name, result in self._results.items()}
+
+    def _missing(self, names):
+        with self._lock:
+            return [name for name in names if name not in self._results]
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="weather-health-prober", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.probe()
+            finally:
+                connections.close_all()
+            self._stopping.wait(self.interval)
+
+
+def readiness(results: dict):
+    """Return ``(ready, checks)`` for a :meth:`HealthProber.snapshot`."""
+    now = timezone.now()
+    checks = {}
+    ready = True
+    for name in CRITICAL_CHECKS:
+        result = results.get(name)
+        if result is None:
+            ready = False
+            continue
+        age = (now - result["checked_at"]).total_seconds()
+        if not result["healthy"] or age > settings.HEALTH_STALE_AFTER:
+            ready = False
+    for name, result in results.items():
+        checks[name] = {
+            "status": "healthy" if result["healthy"] else "unhealthy",
+            "latency_ms": result["latency_ms"],
+            "checked_at": result["checked_at"].isoformat(),
+            "error": result["error"],
+        }
+        if result.get("details") is not None:
+            checks[name]["details"] = result["details"]
+    return ready, checks
+
+
+health_prober = HealthProber(
+    checks={
+        "database": check_database,
+        "redis": check_redis,
+        "upstream": check_upstream,
+        "upstream_guard": check_upstream_guard,
+    },
+    interval=settings.HEALTH_PROBE_INTERVAL,
+)
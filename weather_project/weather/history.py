@@ -0,0 +1,338 @@
+import atexit
+import base64
+import hashlib
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, connections
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from .cache import get_async_redis
+from .metrics import DB_WRITE_LATENCY, DB_WRITES, HISTORY_DROPPED
+from .models import WeatherQuery, normalize_city
+
+logger = logging.getLogger("weather")
+
+
+class HistoryWriter:
+    """Write-behind buffer for WeatherQuery rows.
+
+    Rows are queued by the request path and inserted with ``bulk_create``
+    by a daemon thread once ``batch_size`` rows are waiting or
+    ``flush_interval`` seconds have passed. When the queue is full the row
+    is written synchronously instead of being dropped. A failed insert is
+    retried once after ``retry_delay`` seconds.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval: float,
+        max_queue_size: int,
+        retry_delay: float = 0.5,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def submit(self, weather_query):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(weather_query)
+        except queue.Full:
+            logger.warning("history_queue_full writing_synchronously")
+            self._write([weather_query])
+
+    async def asubmit(self, weather_query):
+        # The ORM cannot run on the event loop, so the overflow write is
+        # handed to a thread.
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(weather_query)
+        except queue.Full:
+            logger.warning("history_queue_full writing_synchronously")
+            await sync_to_async(self._write)([weather_query])
+
+    def submit_many(self, weather_queries):
+        for weather_query in weather_queries:
+            self.submit(weather_query)
+
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start : start + self.batch_size])
+        return len(batch)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        drained = self.flush()
+        if drained:
+            logger.info("history_drain rows=%s", drained)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="weather-history-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                batch = self._collect()
+                if batch:
+                    self._write(batch)
+        finally:
+            connections.close_all()
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # One retry rides out a brief database blip; after that the batch is
+        # dropped and counted, since the requests were answered long ago.
+        for attempt in range(2):
+            if attempt:
+                time.sleep(self.retry_delay)
+                if not connection.in_atomic_block:
+                    connection.close_if_unusable_or_obsolete()
+            try:
+                with DB_WRITE_LATENCY.labels(mode="write_behind").time():
+                    WeatherQuery.objects.bulk_create(batch)
+                DB_WRITES.labels(mode="write_behind").inc(len(batch))
+                logger.info("history_flush rows=%s", len(batch))
+                return
+            except Exception as e:
+                logger.warning(
+                    "history_flush_error rows=%s attempt=%s error='%s'",
+                    len(batch),
+                    attempt + 1,
+                    e,
+                )
+        HISTORY_DROPPED.inc(len(batch))
+        logger.error("history_flush_dropped rows=%s", len(batch))
+
+
+history_writer = HistoryWriter(
+    batch_size=settings.HISTORY_BATCH_SIZE,
+    flush_interval=settings.HISTORY_FLUSH_INTERVAL,
+    max_queue_size=settings.HISTORY_QUEUE_SIZE,
+    retry_delay=settings.HISTORY_RETRY_DELAY,
+)
+atexit.register(history_writer.stop)
+
+
+@dataclass
+class HistoryPage:
+    rows: list
+    has_next: bool
+    has_previous: bool
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.rows[-1]) if self.rows else ""
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.rows[0]) if self.rows else ""
+
+
+def encode_cursor(weather_query):
+    raw = f"{weather_query.timestamp.isoformat()}|{weather_query.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def keyset_page(queries, page_size: int, after: str = "", before: str = ""):
+    """Page through ``queries`` (newest first) on (timestamp, id).
+
+    ``after`` continues past the last row of the previous page and
+    ``before`` goes back from the first row of the next one, so every page
+    is a bounded index range scan with no COUNT and no OFFSET.
+    """
+    queries = queries.order_by("-timestamp", "-pk")
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+
+    if before_key:
+        timestamp, pk = before_key
+        newer = queries.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+        ).order_by("timestamp", "pk")
+        rows = list(newer[: page_size + 1])
+        has_previous = len(rows) > page_size
+        return HistoryPage(list(reversed(rows[:page_size])), True, has_previous)
+
+    if after_key:
+        timestamp, pk = after_key
+        queries = queries.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+        )
+    rows = list(queries[: page_size + 1])
+    return HistoryPage(rows[:page_size], len(rows) > page_size, after_key is not None)
+
+
+def approximate_count(queries, filters: dict):
+    """Row count for the history header, cached per filter combination.
+
+    Unfiltered counts on PostgreSQL come from the planner's estimate, which
+    avoids a full scan of a large table.
+    """
+    digest = hashlib.md5(repr(sorted(filters.items())).encode()).hexdigest()
+    cache_key = f"weather_history_count_{digest}"
+    try:
+        count = cache.get(cache_key)
+    except Exception as e:
+        logger.warning("history_count_cache_error error='%s'", e)
+        count = None
+    if count is not None:
+        return count
+
+    count = None
+    if not any(filters.values()) and connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [WeatherQuery._meta.db_table],
+            )
+            row = cursor.fetchone()
+        if row and row[0] > 0:
+            count = row[0]
+    if count is None:
+        count = queries.count()
+
+    try:
+        cache.set(cache_key, count, settings.HISTORY_COUNT_CACHE_TTL)
+    except Exception as e:
+        logger.warning("history_count_cache_error error='%s'", e)
+    return count
+
+
+class CityFacets:
+    """Distinct city names for the history filter, kept in a Redis set.
+
+    New names are added with SADD as rows are written; each worker
+    remembers which names it already added so the common case costs no
+    Redis call. The set is rebuilt from the table when it is missing.
+    """
+
+    key = "weather_history_cities"
+
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        return get_redis_connection("default")
+
+    def record(self, city_name: str):
+        city_key = normalize_city(city_name)
+        if city_key in self._known:
+            return
+        try:
+            redis_client = self._redis()
+            redis_key = cache.make_key(self.key)
+            if redis_client.exists(redis_key):
+                redis_client.sadd(redis_key, city_name.strip())
+            with self._lock:
+                self._known.add(city_key)
+        except Exception as e:
+            logger.warning("city_facets_record_error error='%s'", e)
+
+    async def arecord(self, city_name: str):
+        city_key = normalize_city(city_name)
+        if city_key in self._known:
+            return
+        try:
+            redis_client = get_async_redis()
+            redis_key = cache.make_key(self.key)
+            if await redis_client.exists(redis_key):
+                await redis_client.sadd(redis_key, city_name.strip())
+            with self._lock:
+                self._known.add(city_key)
+        except Exception as e:
+            logger.warning("city_facets_record_error error='%s'", e)
+
+    def record_many(self, weather_queries):
+        for weather_query in weather_queries:
+            self.record(weather_query.city_name)
+
+    def all(self):
+        try:
+            redis_client = self._redis()
+            redis_key = cache.make_key(self.key)
+            names = redis_client.smembers(redis_key)
+            if names:
+                return sorted({n.decode() for n in names}, key=str.lower)
+            names = self._rebuild(redis_client, redis_key)
+        except Exception as e:
+            logger.warning("city_facets_error error='%s'", e)
+            names = self._from_db()
+        return sorted(names, key=str.lower)
+
+    def _rebuild(self, redis_client, redis_key):
+        names = self._from_db()
+        if names:
+            pipeline = redis_client.pipeline()
+            pipeline.sadd(redis_key, *names)
+            pipeline.expire(redis_key, settings.HISTORY_FACETS_TTL)
+            pipeline.execute()
+        logger.info("city_facets_rebuilt count=%s", len(names))
+        return names
+
+    def _from_db(self):
+        return set(
+            WeatherQuery.objects.order_by()
+            .values_list("city_name", flat=True)
+            .distinct()
+        )
+
+    def reset_local(self):
+        with self._lock:
+            self._known.clear()
+
+
+city_facets = CityFacets()
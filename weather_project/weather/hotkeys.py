@@ -0,0 +1,101 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .cache import get_async_redis
+from .models import WeatherQuery, normalize_city
+from .units import CANONICAL_UNITS
+
+logger = logging.getLogger("weather")
+
+
+class HotKeys:
+    """Request frequency per (city, units), kept in a Redis sorted set.
+
+    Every successful request bumps its member with ZINCRBY; the refresher
+    decays all scores on each run so the ranking follows recent traffic.
+    Each write also trims the set to HOT_CITIES_MAX_TRACKED members, so it
+    stays bounded when the refresher is not scheduled.
+    """
+
+    key = "weather_hot_keys"
+
+    def _redis_key(self):
+        return cache.make_key(self.key)
+
+    @staticmethod
+    def _member(city: str, units: str):
+        return f"{units}:{normalize_city(city)}"
+
+    def _trim(self, pipeline):
+        # Drops the coldest members beyond the cap; a no-op below it.
+        pipeline.zremrangebyrank(
+            self._redis_key(), 0, -settings.HOT_CITIES_MAX_TRACKED - 1
+        )
+
+    def record(self, city: str, units: str):
+        self.record_many([city], units)
+
+    async def arecord(self, city: str, units: str):
+        if not settings.HOT_CITIES_TRACKING:
+            return
+        try:
+            pipeline = get_async_redis().pipeline(transaction=False)
+            pipeline.zincrby(self._redis_key(), 1, self._member(city, units))
+            self._trim(pipeline)
+            await pipeline.execute()
+        except Exception as e:
+            logger.warning("hot_keys_record_error error='%s'", e)
+
+    def record_many(self, cities, units: str):
+        if not settings.HOT_CITIES_TRACKING or not cities:
+            return
+        try:
+            pipeline = get_redis_connection("default").pipeline(transaction=False)
+            for city in cities:
+                pipeline.zincrby(self._redis_key(), 1, self._member(city, units))
+            self._trim(pipeline)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning("hot_keys_record_error error='%s'", e)
+
+    def top(self, limit: int):
+        """Return up to ``limit`` ``(city, units, score)`` tuples, hottest first."""
+        members = get_redis_connection("default").zrevrange(
+            self._redis_key(), 0, limit - 1, withscores=True
+        )
+        result = []
+        for member, score in members:
+            units, city = member.decode().split(":", 1)
+            result.append((city, units, score))
+        return result
+
+    def decay(self, factor: float, floor: float = 0.5):
+        redis_client = get_redis_connection("default")
+        redis_key = self._redis_key()
+        pipeline = redis_client.pipeline()
+        pipeline.zunionstore(redis_key, {redis_key: factor})
+        pipeline.zremrangebyscore(redis_key, "-inf", f"({floor}")
+        pipeline.execute()
+
+    @staticmethod
+    def from_history(limit: int, window: timedelta):
+        # Cold start: rank by recent history rows until the counter fills up.
+        # Requests in every unit system are served from the canonical entry,
+        # so that is the one to refresh.
+        since = timezone.now() - window
+        rows = (
+            WeatherQuery.objects.filter(timestamp__gte=since)
+            .values("city_key")
+            .annotate(requests=Count("id"))
+            .order_by("-requests")[:limit]
+        )
+        return [(row["city_key"], CANONICAL_UNITS, row["requests"]) for row in rows]
+
+
+hot_keys = HotKeys()
@@ -0,0 +1,142 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+# Set per request by RequestIdMiddleware; background work logs with "-".
+request_id = contextvars.ContextVar("request_id", default="-")
+sampled = contextvars.ContextVar("sampled", default=True)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_listener = None
+
+
+def new_request_id(header: str = None):
+    """Reuse a well-formed incoming ``X-Request-ID``, else mint one."""
+    if header and REQUEST_ID_PATTERN.match(header):
+        return header
+    return uuid.uuid4().hex
+
+
+def in_request_context(fn):
+    """Wrap ``fn`` so worker threads log with the caller's request ID."""
+    context = contextvars.copy_context()
+    # A context can only be entered by one thread at a time, so every call
+    # runs in its own copy.
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def should_sample(rid: str, rate: float):
+    # Decided from the ID rather than at random so every service that sees
+    # the same request ID keeps or drops it together.
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    return zlib.crc32(rid.encode()) % 10_000 < rate * 10_000
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps records with the current request ID.
+
+    Installed on the logger so it runs on the calling thread, where the
+    context variable is visible, before records are queued.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Drops INFO and below for requests that were not sampled.
+
+    Warnings and errors are always kept, as is anything logged outside a
+    request.
+    """
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``event`` is the first word of the message."""
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec="milliseconds")
+            .replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "request_id": getattr(record, "request_id", "-"),
+            "event": str(record.msg).split(" ", 1)[0],
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted.
+
+    The stock ``prepare`` formats the message on the calling thread so the
+    record can be pickled; the listener here lives in the same process, so
+    all formatting is left to it.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def start_queue_listener(logger_name: str = "weather"):
+    """Move ``logger_name``'s handlers behind a queue drained by a thread.
+
+    Request threads only pay for an enqueue; file and stream writes happen
+    on the listener thread. Call once per process, after logging is
+    configured (and after forking, under a pre-fork server).
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    logger = logging.getLogger(logger_name)
+    handlers = [h for h in logger.handlers if not isinstance(h, LocalQueueHandler)]
+    if not handlers:
+        return None
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(LocalQueueHandler(records))
+    _listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    _listener.logger = logger
+    _listener.start()
+    return _listener
+
+
+def stop_queue_listener():
+    """Flush queued records and give the handlers back to their logger."""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+    logger = listener.logger
+    for handler in list(logger.handlers):
+        if isinstance(handler, LocalQueueHandler):
+            logger.removeHandler(handler)
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+
+
+atexit.register(stop_queue_listener)
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from weather.retention import prune, purge_archive, roll_up
+
+
+class Command(BaseCommand):
+    help = (
+        "Move WeatherQuery rows older than the retention period to the archive "
+        "table (or delete them), in small batches, after rolling them up, and "
+        "drop archived rows older than the archive retention period."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.HISTORY_RETENTION_DAYS)
+        parser.add_argument(
+            "--archive-days",
+            type=int,
+            default=settings.ARCHIVE_RETENTION_DAYS,
+            help="Days of archived rows to keep; 0 keeps them indefinitely.",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.HISTORY_RETENTION_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0.05,
+            help="Seconds to sleep between batches.",
+        )
+        archive = parser.add_mutually_exclusive_group()
+        archive.add_argument(
+            "--archive", dest="archive", action="store_true", default=None
+        )
+        archive.add_argument("--delete", dest="archive", action="store_false")
+
+    def handle(self, *args, **options):
+        archive = (
+            settings.HISTORY_ARCHIVE
+            if options["archive"] is None
+            else options["archive"]
+        )
+        rolled = roll_up(options["pause"])
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        pruned = prune(cutoff, options["batch_size"], archive, options["pause"])
+        self.stdout.write(
+            f"Rolled up {rolled} rows, {'archived' if archive else 'deleted'} "
+            f"{pruned} rows older than {cutoff:%Y-%m-%d %H:%M}"
+        )
+        if options["archive_days"] > 0:
+            archive_cutoff = timezone.now() - timedelta(days=options["archive_days"])
+            purged = purge_archive(
+                archive_cutoff, options["batch_size"], options["pause"]
+            )
+            self.stdout.write(
+                f"Deleted {purged} archived rows older than "
+                f"{archive_cutoff:%Y-%m-%d %H:%M}"
+            )
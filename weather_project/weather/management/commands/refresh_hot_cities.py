@@ -0,0 +1,99 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+from weather.hotkeys import hot_keys
+from weather.services import WeatherService
+
+logger = logging.getLogger("weather")
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-fetch the most requested (city, units) pairs shortly before their "
+        "cache entry goes stale, within an upstream call budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=settings.HOT_CITIES_TOP)
+        parser.add_argument(
+            "--refresh-ahead",
+            type=int,
+            default=settings.HOT_CITIES_REFRESH_AHEAD,
+            help="Refresh keys with fewer than this many seconds left.",
+        )
+        parser.add_argument(
+            "--budget",
+            type=int,
+            default=settings.HOT_CITIES_REFRESH_BUDGET,
+            help="Maximum upstream calls per run.",
+        )
+        parser.add_argument("--decay", type=float, default=settings.HOT_CITIES_DECAY)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running, one pass every N seconds (0 runs once).",
+        )
+
+    def handle(self, *args, **options):
+        service = WeatherService()
+        while True:
+            started = time.monotonic()
+            self.run_once(service, options)
+            if not options["interval"]:
+                break
+            time.sleep(max(0, options["interval"] - (time.monotonic() - started)))
+
+    def run_once(self, service, options):
+        candidates = hot_keys.top(options["top"])
+        if not candidates:
+            candidates = hot_keys.from_history(options["top"], timedelta(hours=1))
+
+        refreshed = skipped = failed = 0
+        for city, units, score in candidates:
+            if refreshed + failed >= options["budget"]:
+                break
+            try:
+                ttl = service.cache.ttl(city, units)
+            except (RedisError, ConnectionInterrupted) as e:
+                logger.warning(
+                    "hot_city_ttl_error city=%s units=%s error='%s'", city, units, e
+                )
+                skipped += 1
+                continue
+            if ttl is None or ttl > options["refresh_ahead"]:
+                skipped += 1
+                continue
+            if service.refresh(city, units):
+                refreshed += 1
+            else:
+                failed += 1
+            logger.info(
+                "hot_city_refresh city=%s units=%s score=%s ttl=%s",
+                city,
+                units,
+                score,
+                ttl,
+            )
+
+        try:
+            hot_keys.decay(options["decay"])
+        except (RedisError, ConnectionInterrupted) as e:
+            logger.warning("hot_city_decay_error error='%s'", e)
+        logger.info(
+            "hot_city_refresh_done candidates=%s refreshed=%s skipped=%s failed=%s",
+            len(candidates),
+            refreshed,
+            skipped,
+            failed,
+        )
+        self.stdout.write(
+            f"Refreshed {refreshed}, skipped {skipped}, failed {failed} "
+            f"of {len(candidates)} hot keys"
+        )
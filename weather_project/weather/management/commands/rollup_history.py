@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from weather.retention import roll_up
+
+
+class Command(BaseCommand):
+    help = "Roll up WeatherQuery rows of every closed hour not yet rolled up."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between hours.",
+        )
+
+    def handle(self, *args, **options):
+        rolled = roll_up(options["pause"])
+        self.stdout.write(f"Rolled up {rolled} rows")
@@ -0,0 +1,77 @@
+import random
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from weather.models import WeatherQuery
+
+SEED_PREFIX = "Seed City"
+DESCRIPTIONS = ["clear sky", "few clouds", "light rain", "overcast clouds", "mist"]
+UNITS = ["metric", "metric", "metric", "imperial", "standard"]
+
+
+class Command(BaseCommand):
+    help = "Insert synthetic WeatherQuery rows for benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100_000)
+        parser.add_argument("--cities", type=int, default=500)
+        parser.add_argument("--days", type=int, default=30)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--cache-ratio", type=float, default=0.8)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument(
+            "--clear", action="store_true", help="Delete previously seeded rows first."
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        if options["clear"]:
+            deleted, _ = WeatherQuery.objects.filter(
+                city_name__startswith=SEED_PREFIX
+            ).delete()
+            self.stdout.write(f"Deleted {deleted} seeded rows")
+
+        now = timezone.now()
+        span = options["days"] * 24 * 3600
+        cities = [f"{SEED_PREFIX} {i}" for i in range(options["cities"])]
+        remaining = options["rows"]
+        written = 0
+        while remaining > 0:
+            batch = []
+            for _ in range(min(options["batch_size"], remaining)):
+                city = rng.choice(cities)
+                temperature = round(rng.uniform(-20, 40), 2)
+                served_from_cache = rng.random() < options["cache_ratio"]
+                description = rng.choice(DESCRIPTIONS)
+                batch.append(
+                    WeatherQuery(
+                        city_name=city,
+                        timestamp=now - timedelta(seconds=rng.uniform(0, span)),
+                        temperature=temperature,
+                        weather_description=description,
+                        units=rng.choice(UNITS),
+                        served_from_cache=served_from_cache,
+                        ip_address=f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                        raw_data=(
+                            {}
+                            if served_from_cache
+                            else {
+                                "name": city,
+                                "main": {
+                                    "temp": temperature,
+                                    "humidity": rng.randint(10, 100),
+                                    "pressure": rng.randint(980, 1040),
+                                },
+                                "weather": [{"description": description}],
+                            }
+                        ),
+                    )
+                )
+            WeatherQuery.objects.bulk_create(batch)
+            remaining -= len(batch)
+            written += len(batch)
+            self.stdout.write(f"Inserted {written}/{options['rows']} rows")
+
+        self.stdout.write(self.style.SUCCESS(f"Seeded {written} rows"))
@@ -0,0 +1,117 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+# the workers; every process then writes its samples there and /metrics
+# aggregates them (see gunicorn.conf.py for the worker exit hook).
+
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+UPSTREAM_LATENCY = Histogram(
+    "weather_upstream_request_seconds",
+    "Latency of OpenWeatherMap requests, including retries",
+    ["outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+CACHE_LOOKUPS = Counter(
+    "weather_cache_lookups_total",
+    "Weather cache lookups by tier and result",
+    ["tier", "result"],
+)
+
+CACHE_EVICTIONS = Counter(
+    "weather_cache_evictions_total",
+    "Entries evicted from a bounded cache tier",
+    ["tier"],
+)
+
+STALE_SERVES = Counter(
+    "weather_stale_serves_total",
+    "Responses served from an entry past its soft TTL",
+    ["reason"],
+)
+
+UPSTREAM_GROUP_SIZE = Histogram(
+    "weather_upstream_group_size",
+    "Cities resolved per OpenWeatherMap group call",
+    buckets=(1, 2, 5, 10, 15, 20),
+)
+
+UPSTREAM_REJECTED = Counter(
+    "weather_upstream_rejected_total",
+    "Upstream calls not made because the circuit was open or the budget spent",
+    ["reason"],
+)
+
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "weather_upstream_circuit_open",
+    "1 while the upstream circuit breaker rejects calls",
+    multiprocess_mode="livemax",
+)
+
+UPSTREAM_BUDGET_TOKENS = Gauge(
+    "weather_upstream_budget_tokens",
+    "Upstream calls left in the token bucket at the last check",
+    multiprocess_mode="livemostrecent",
+)
+
+CACHE_LATENCY = Histogram(
+    "weather_cache_operation_seconds",
+    "Latency of cache tier operations",
+    ["tier", "operation"],
+    buckets=FAST_BUCKETS,
+)
+
+DB_WRITES = Counter(
+    "weather_db_writes_total",
+    "WeatherQuery rows written, by write path",
+    ["mode"],
+)
+
+HISTORY_DROPPED = Counter(
+    "weather_history_dropped_total",
+    "Write-behind history rows lost after the insert and its retry failed",
+)
+
+DB_WRITE_LATENCY = Histogram(
+    "weather_db_write_seconds",
+    "Latency of one WeatherQuery insert or bulk insert",
+    ["mode"],
+    buckets=FAST_BUCKETS,
+)
+
+RATE_LIMITED = Counter(
+    "weather_ratelimited_total",
+    "Requests rejected by the rate limiter",
+    ["view"],
+)
+
+VIEW_LATENCY = Histogram(
+    "weather_http_request_seconds",
+    "Request latency by view, method and status",
+    ["view", "method", "status"],
+    buckets=REQUEST_BUCKETS,
+)
+
+
+def render_metrics():
+    """Return ``(body, content_type)`` for the Prometheus scrape endpoint."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,170 @@
+import math
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+from . import log
+from .metrics import RATE_LIMITED, VIEW_LATENCY
+from .ratelimit import limit_for, rate_limiter
+from .views import get_client_ip
+
+
+class MetricsMiddleware:
+    """Records per-view latency and rate-limit rejections.
+
+    Views are labelled by URL name rather than path to keep label
+    cardinality bounded. Works in front of both sync and async views
+    without forcing a thread switch.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start_time = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, time.perf_counter() - start_time)
+        return response
+
+    async def __acall__(self, request):
+        start_time = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, time.perf_counter() - start_time)
+        return response
+
+    @staticmethod
+    def _observe(request, response, elapsed):
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unmatched"
+        VIEW_LATENCY.labels(
+            view=view, method=request.method, status=str(response.status_code)
+        ).observe(elapsed)
+        if getattr(request, "limited", False):
+            RATE_LIMITED.labels(view=view).inc()
+
+
+class RequestIdMiddleware:
+    """Tags everything logged while handling a request with one request ID.
+
+    The ID comes from ``X-Request-ID`` when the caller sends a usable one and
+    is echoed back on the response. The per-request sampling decision for
+    INFO lines is made here too.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        tokens = self._enter(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self._exit(tokens)
+        response["X-Request-ID"] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        tokens = self._enter(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._exit(tokens)
+        response["X-Request-ID"] = request.request_id
+        return response
+
+    @staticmethod
+    def _enter(request):
+        rid = log.new_request_id(request.headers.get("X-Request-ID"))
+        request.request_id = rid
+        return (
+            log.request_id.set(rid),
+            log.sampled.set(log.should_sample(rid, settings.LOG_SAMPLE_RATE)),
+        )
+
+    @staticmethod
+    def _exit(tokens):
+        rid_token, sampled_token = tokens
+        log.request_id.reset(rid_token)
+        log.sampled.reset(sampled_token)
+
+
+class RateLimitMiddleware:
+    """Applies the GCRA limits from :mod:`weather.ratelimit`.
+
+    Over-limit requests still reach the view with ``request.limited`` set,
+    so each view keeps answering in its own format (429 JSON or the form
+    with an error). Checked responses carry ``X-RateLimit-*`` headers and
+    rejected ones ``Retry-After``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        limit = self._limit_for(request)
+        if limit is None:
+            return self.get_response(request)
+        bucket, rate = limit
+        decision = rate_limiter.hit(bucket, rate)
+        self._mark(request, rate, decision)
+        return self._add_headers(self.get_response(request), rate, decision)
+
+    async def __acall__(self, request):
+        limit = self._limit_for(request)
+        if limit is None:
+            return await self.get_response(request)
+        bucket, rate = limit
+        decision = await rate_limiter.ahit(bucket, rate)
+        self._mark(request, rate, decision)
+        return self._add_headers(await self.get_response(request), rate, decision)
+
+    @staticmethod
+    def _limit_for(request):
+        if not settings.RATELIMIT_ENABLE:
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        return limit_for(
+            match.view_name,
+            request.method,
+            request.headers.get("X-API-Key", ""),
+            get_client_ip(request),
+        )
+
+    @staticmethod
+    def _mark(request, rate, decision):
+        request.limited = not decision.allowed or getattr(request, "limited", False)
+        request.rate_limit = rate
+
+    @staticmethod
+    def _add_headers(response, rate, decision):
+        response["X-RateLimit-Limit"] = str(rate.requests)
+        response["X-RateLimit-Remaining"] = str(decision.remaining)
+        if not decision.allowed:
+            response["Retry-After"] = str(math.ceil(decision.retry_after))
+        return response
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="WeatherQuery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("city_name", models.CharField(max_length=100)),
+                ("timestamp", models.DateTimeField(auto_now_add=True)),
+                ("temperature", models.FloatField()),
+                ("weather_description", models.CharField(max_length=250)),
+                ("units", models.CharField(max_length=10)),
+                ("served_from_cache", models.BooleanField(default=False)),
+                ("ip_address", models.GenericIPAddressField(blank=True, null=True)),
+                ("raw_data", models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+    ]
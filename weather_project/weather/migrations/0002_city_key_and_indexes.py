@@ -0,0 +1,87 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:25
+
+import django.utils.timezone
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+from django.db.models.functions import Lower, Trim
+
+BATCH_SIZE = 10000
+
+
+class AddIndexIfPossibleConcurrently(AddIndexConcurrently):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL, a plain AddIndex elsewhere."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_forwards(
+                self, app_label, schema_editor, from_state, to_state
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+        else:
+            migrations.AddIndex.database_backwards(
+                self, app_label, schema_editor, from_state, to_state
+            )
+
+
+def populate_city_key(apps, schema_editor):
+    WeatherQuery = apps.get_model("weather", "WeatherQuery")
+    last_id = 0
+    while True:
+        ids = list(
+            WeatherQuery.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:BATCH_SIZE]
+        )
+        if not ids:
+            break
+        WeatherQuery.objects.filter(id__gte=ids[0], id__lte=ids[-1]).update(
+            city_key=Lower(Trim("city_name"))
+        )
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    # The history table is large and live: each backfill batch commits on
+    # its own, and the indexes are built without blocking writes.
+    atomic = False
+
+    dependencies = [
+        ("weather", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weatherquery",
+            name="city_key",
+            field=models.CharField(default="", editable=False, max_length=100),
+        ),
+        migrations.RunPython(populate_city_key, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="weatherquery",
+            name="timestamp",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        AddIndexIfPossibleConcurrently(
+            model_name="weatherquery",
+            index=models.Index(
+                condition=models.Q(("served_from_cache", False)),
+                fields=["city_key", "timestamp"],
+                name="weather_upstream_city_ts_idx",
+            ),
+        ),
+        AddIndexIfPossibleConcurrently(
+            model_name="weatherquery",
+            index=models.Index(
+                fields=["city_key", "timestamp", "id"], name="weather_city_ts_id_idx"
+            ),
+        ),
+        AddIndexIfPossibleConcurrently(
+            model_name="weatherquery",
+            index=models.Index(fields=["timestamp", "id"], name="weather_ts_id_idx"),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.1.5 on 2026-10-18 19:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0002_city_key_and_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedWeatherQuery",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("city_name", models.CharField(max_length=100)),
+                ("city_key", models.CharField(default="", max_length=100)),
+                ("timestamp", models.DateTimeField(db_index=True)),
+                ("temperature", models.FloatField()),
+                ("weather_description", models.CharField(max_length=250)),
+                ("units", models.CharField(max_length=10)),
+                ("served_from_cache", models.BooleanField(default=False)),
+                ("ip_address", models.GenericIPAddressField(blank=True, null=True)),
+                ("raw_data", models.JSONField(blank=True, default=dict)),
+                (
+                    "archived_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RollupCheckpoint",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=50, primary_key=True, serialize=False),
+                ),
+                ("last_id", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="HourlyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("city_key", models.CharField(max_length=100)),
+                ("city_name", models.CharField(max_length=100)),
+                ("units", models.CharField(max_length=10)),
+                ("hour", models.DateTimeField()),
+                ("requests", models.PositiveIntegerField(default=0)),
+                ("cache_hits", models.PositiveIntegerField(default=0)),
+                ("temperature_min", models.FloatField()),
+                ("temperature_max", models.FloatField()),
+                ("temperature_sum", models.FloatField(default=0)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["hour"], name="weather_rollup_hour_idx")
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("city_key", "units", "hour"), name="weather_rollup_key"
+                    )
+                ],
+            },
+        ),
+    ]
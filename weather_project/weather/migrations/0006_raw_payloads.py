@@ -0,0 +1,48 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0005_history_retention_and_rollups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RawPayload",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="archivedweatherquery",
+            name="payload",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="weather.rawpayload",
+            ),
+        ),
+        migrations.AddField(
+            model_name="weatherquery",
+            name="payload",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="weather.rawpayload",
+            ),
+        ),
+    ]
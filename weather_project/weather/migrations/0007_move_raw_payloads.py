@@ -0,0 +1,78 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:00
+
+import hashlib
+import json
+import zlib
+
+from django.db import migrations
+
+BATCH_SIZE = 2000
+MODELS = ("WeatherQuery", "ArchivedWeatherQuery")
+
+
+# Frozen copies of weather.models.encode_payload/decode_payload.
+def encode_payload(payload):
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(body).hexdigest(), zlib.compress(body, 6)
+
+
+def decode_payload(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+def move_to_payloads(apps, schema_editor):
+    RawPayload = apps.get_model("weather", "RawPayload")
+    for name in MODELS:
+        Model = apps.get_model("weather", name)
+        last_id = 0
+        while True:
+            rows = list(
+                Model.objects.filter(id__gt=last_id)
+                .exclude(raw_data={})
+                .order_by("id")
+                .only("id", "raw_data")[:BATCH_SIZE]
+            )
+            if not rows:
+                break
+            blobs = {}
+            for row in rows:
+                digest, blob = encode_payload(row.raw_data)
+                blobs[digest] = blob
+                row.payload_id = digest
+            RawPayload.objects.bulk_create(
+                [RawPayload(digest=d, data=b) for d, b in blobs.items()],
+                ignore_conflicts=True,
+            )
+            Model.objects.bulk_update(rows, ["payload"])
+            last_id = rows[-1].id
+
+
+def restore_raw_data(apps, schema_editor):
+    RawPayload = apps.get_model("weather", "RawPayload")
+    for name in MODELS:
+        Model = apps.get_model("weather", name)
+        last_id = 0
+        while True:
+            rows = list(
+                Model.objects.filter(id__gt=last_id, payload__isnull=False)
+                .order_by("id")
+                .only("id", "payload_id")[:BATCH_SIZE]
+            )
+            if not rows:
+                break
+            payloads = RawPayload.objects.in_bulk({row.payload_id for row in rows})
+            for row in rows:
+                row.raw_data = decode_payload(payloads[row.payload_id].data)
+            Model.objects.bulk_update(rows, ["raw_data"])
+            last_id = rows[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0006_raw_payloads"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_to_payloads, restore_raw_data),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-18 20:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0007_move_raw_payloads"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="archivedweatherquery",
+            name="raw_data",
+        ),
+        migrations.RemoveField(
+            model_name="weatherquery",
+            name="raw_data",
+        ),
+    ]
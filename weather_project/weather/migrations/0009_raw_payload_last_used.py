@@ -0,0 +1,41 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0008_remove_raw_data"),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="rawpayload",
+            old_name="created_at",
+            new_name="last_used_at",
+        ),
+        migrations.AlterField(
+            model_name="archivedweatherquery",
+            name="payload",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="weather.rawpayload",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="weatherquery",
+            name="payload",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="weather.rawpayload",
+            ),
+        ),
+    ]
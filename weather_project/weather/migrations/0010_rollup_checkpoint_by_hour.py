@@ -0,0 +1,22 @@
+# Generated by Django 5.1.5 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("weather", "0009_raw_payload_last_used"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="rollupcheckpoint",
+            name="last_id",
+        ),
+        migrations.AddField(
+            model_name="rollupcheckpoint",
+            name="rolled_up_to",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
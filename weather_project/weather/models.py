@@ -1,15 +1,212 @@
+import hashlib
+import json
+import zlib
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+
+def normalize_city(city: str):
+    return city.strip().lower()
+
+
+def encode_payload(payload: dict):
+    """Return ``(digest, blob)``: the SHA-256 of the canonical JSON and its zlib."""
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(body).hexdigest(), zlib.compress(body, 6)
+
+
+def decode_payload(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+class RawPayload(models.Model):
+    """Upstream JSON response, stored once per distinct body and compressed."""
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    # Refreshed whenever a new row points at the payload, so cleanup can
+    # leave alone payloads a writer may be about to reference.
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    def decode(self):
+        return decode_payload(self.data)
 
+    @classmethod
+    def store(cls, objs):
+        """Point ``payload`` of each row at its deduplicated ``raw_data``."""
+        blobs = {}
+        pending = []
+        for obj in objs:
+            if obj.payload_id is None and obj._raw_data:
+                digest, blob = encode_payload(obj._raw_data)
+                blobs[digest] = blob
+                pending.append((obj, digest))
+        if blobs:
+            cls.objects.bulk_create(
+                [cls(digest=digest, data=blob) for digest, blob in blobs.items()],
+                update_conflicts=True,
+                unique_fields=["digest"],
+                update_fields=["last_used_at"],
+            )
+        # Only once stored, so a retried insert stores a failed batch again.
+        for obj, digest in pending:
+            obj.payload_id = digest
 
-class WeatherQuery(models.Model):
+    @classmethod
+    def delete_unreferenced(cls, digests, grace: timedelta):
+        """Delete those of ``digests`` that no row uses, in one statement.
+
+        Payloads used within ``grace`` are kept: a writer stores the payload
+        before inserting the row that points at it. The foreign keys are
+        plain database constraints, so the check and the delete are a
+        single ``DELETE ... WHERE NOT EXISTS``.
+        """
+        digests = set(digests) - {None}
+        if not digests:
+            return 0
+        deleted, _ = (
+            cls.objects.filter(pk__in=digests, last_used_at__lt=timezone.now() - grace)
+            .exclude(Exists(WeatherQuery.objects.filter(payload=OuterRef("pk"))))
+            .exclude(
+                Exists(ArchivedWeatherQuery.objects.filter(payload=OuterRef("pk")))
+            )
+            .delete()
+        )
+        return deleted
+
+
+class RawDataMixin:
+    # The payload is only read when ``raw_data`` is accessed; history and
+    # export queries never touch it.
+    _raw_data = None
+
+    @property
+    def raw_data(self):
+        if self._raw_data is None:
+            self._raw_data = self.payload.decode() if self.payload_id else {}
+        return self._raw_data
+
+    @raw_data.setter
+    def raw_data(self, value):
+        self._raw_data = value
+
+
+class WeatherQueryQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.city_key = normalize_city(obj.city_name)
+        RawPayload.store(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+class WeatherQuery(RawDataMixin, models.Model):
     city_name = models.CharField(max_length=100)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    city_key = models.CharField(max_length=100, default="", editable=False)
+    timestamp = models.DateTimeField(default=timezone.now)
     temperature = models.FloatField()
     weather_description = models.CharField(max_length=250)
     units = models.CharField(max_length=10)
     served_from_cache = models.BooleanField(default=False)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
-    raw_data = models.JSONField(default=dict, blank=True)
+    payload = models.ForeignKey(
+        RawPayload,
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        related_name="+",
+    )
+
+    objects = WeatherQueryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # DB cache fallback: newest upstream row for a city, in any units.
+            models.Index(
+                fields=["city_key", "timestamp"],
+                name="weather_upstream_city_ts_idx",
+                condition=models.Q(served_from_cache=False),
+            ),
+            # History filtered by city, newest first, with (timestamp, id)
+            # as the keyset pagination key.
+            models.Index(
+                fields=["city_key", "timestamp", "id"], name="weather_city_ts_id_idx"
+            ),
+            # Unfiltered history and date ranges.
+            models.Index(fields=["timestamp", "id"], name="weather_ts_id_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.city_key = normalize_city(self.city_name)
+        RawPayload.store([self])
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.city_name} - {self.temperature}"
+
+
+class ArchivedWeatherQuery(RawDataMixin, models.Model):
+    """WeatherQuery rows moved out of the live table by ``prune_history``.
+
+    Keeps the original id; only indexed by time, which is how it is read
+    back and how ``prune_history`` drops rows past ARCHIVE_RETENTION_DAYS.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    city_name = models.CharField(max_length=100)
+    city_key = models.CharField(max_length=100, default="")
+    timestamp = models.DateTimeField(db_index=True)
+    temperature = models.FloatField()
+    weather_description = models.CharField(max_length=250)
+    units = models.CharField(max_length=10)
+    served_from_cache = models.BooleanField(default=False)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    payload = models.ForeignKey(
+        RawPayload,
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        related_name="+",
+    )
+    archived_at = models.DateTimeField(default=timezone.now)
+
+
+class HourlyRollup(models.Model):
+    """Per city, unit system and hour: request count, cache hits, temperatures."""
+
+    city_key = models.CharField(max_length=100)
+    city_name = models.CharField(max_length=100)
+    units = models.CharField(max_length=10)
+    hour = models.DateTimeField()
+    requests = models.PositiveIntegerField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    temperature_min = models.FloatField()
+    temperature_max = models.FloatField()
+    temperature_sum = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["city_key", "units", "hour"], name="weather_rollup_key"
+            )
+        ]
+        indexes = [models.Index(fields=["hour"], name="weather_rollup_hour_idx")]
+
+    @property
+    def temperature_avg(self):
+        return self.temperature_sum / self.requests if self.requests else None
+
+    @property
+    def cache_hit_ratio(self):
+        return self.cache_hits / self.requests if self.requests else None
+
+
+class RollupCheckpoint(models.Model):
+    """End of the last hour already rolled up into :class:`HourlyRollup`."""
+
+    name = models.CharField(max_length=50, primary_key=True)
+    rolled_up_to = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from .cache import get_async_redis
+
+logger = logging.getLogger("weather")
+
+# GCRA: the key holds the "theoretical arrival time" (TAT) of the next
+# request in ms. Each request pushes it forward by window/requests; a
+# request is rejected when that would put the TAT more than one window
+# ahead of now. One key, one round trip, no per-request list or counter.
+GCRA = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + t[2] / 1000
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+local new_tat = tat + interval
+if new_tat - now > window then
+    return {0, 0, tostring(new_tat - now - window)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil(new_tat - now))
+return {1, math.floor((window - (new_tat - now)) / interval), '0'}
+"""
+
+
+@dataclass(frozen=True)
+class Rate:
+    requests: int
+    window: int
+
+    @classmethod
+    def parse(cls, value: str):
+        """``"30/60"`` is 30 requests per 60 seconds."""
+        requests, _, window = value.partition("/")
+        return cls(int(requests), int(window or 60))
+
+    @property
+    def interval_ms(self):
+        return self.window * 1000 / self.requests
+
+
+@dataclass(frozen=True)
+class Decision:
+    allowed: bool
+    remaining: int
+    retry_after: float
+
+
+class RateLimiter:
+    """GCRA limiter shared by all workers through Redis.
+
+    ``rate.requests`` calls are allowed per ``rate.window`` seconds per key,
+    all of them at once if the key has been idle. When Redis is unreachable
+    each process limits on its own, tracking at most ``max_local_keys``
+    keys.
+    """
+
+    def __init__(self, max_local_keys: int = 10_000):
+        self.max_local_keys = max_local_keys
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+
+    @staticmethod
+    def _key(key: str):
+        return cache.make_key(f"rl_{key}")
+
+    @staticmethod
+    def _args(rate: Rate):
+        return [rate.interval_ms, rate.window * 1000]
+
+    def hit(self, key: str, rate: Rate):
+        try:
+            result = get_redis_connection("default").register_script(GCRA)(
+                keys=[self._key(key)], args=self._args(rate)
+            )
+        except Exception as e:
+            logger.warning("ratelimit_redis_error error='%s'", e)
+            result = self._local_hit(key, rate)
+        return self._decision(result)
+
+    async def ahit(self, key: str, rate: Rate):
+        try:
+            result = await get_async_redis().register_script(GCRA)(
+                keys=[self._key(key)], args=self._args(rate)
+            )
+        except Exception as e:
+            logger.warning("ratelimit_redis_error error='%s'", e)
+            result = self._local_hit(key, rate)
+        return self._decision(result)
+
+    @staticmethod
+    def _decision(result):
+        allowed, remaining, retry_after_ms = result
+        return Decision(bool(allowed), int(remaining), float(retry_after_ms) / 1000)
+
+    def _local_hit(self, key: str, rate: Rate):
+        now = time.time() * 1000
+        window = rate.window * 1000
+        with self._lock:
+            tat = max(self._local.pop(key, 0), now)
+            new_tat = tat + rate.interval_ms
+            if new_tat - now > window:
+                self._local[key] = tat
+                return 0, 0, new_tat - now - window
+            self._local[key] = new_tat
+            while len(self._local) > self.max_local_keys:
+                self._local.popitem(last=False)
+            return 1, math.floor((window - (new_tat - now)) / rate.interval_ms), 0
+
+
+def limit_for(view_name: str, method: str, api_key: str, ip: str):
+    """Return ``(bucket, rate)`` for a request, or ``None`` if it is not limited.
+
+    Requests carrying a key listed in ``RATE_LIMIT_API_KEYS`` are limited per
+    key at their tier's rate; everything else per client IP, at the
+    endpoint's rate from ``RATE_LIMIT_ENDPOINTS`` or the global default.
+    """
+    methods = settings.RATE_LIMITED_VIEWS.get(view_name)
+    if not methods or method not in methods:
+        return None
+    tier = settings.RATE_LIMIT_API_KEYS.get(api_key) if api_key else None
+    if tier in settings.RATE_LIMIT_TIERS:
+        digest = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        return (
+            f"{view_name}:key:{digest}",
+            Rate.parse(settings.RATE_LIMIT_TIERS[tier]),
+        )
+    configured = settings.RATE_LIMIT_ENDPOINTS.get(view_name)
+    rate = (
+        Rate.parse(configured)
+        if configured
+        else Rate(settings.RATE_LIMIT_REQUESTS, settings.RATE_LIMIT_WINDOW)
+    )
+    return f"{view_name}:ip:{ip}", rate
+
+
+rate_limiter = RateLimiter()
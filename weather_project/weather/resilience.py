@@ -0,0 +1,301 @@
+import contextvars
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from .cache import get_async_redis
+from .metrics import UPSTREAM_BUDGET_TOKENS, UPSTREAM_CIRCUIT_OPEN
+
+logger = logging.getLogger("weather")
+
+# Both scripts use the Redis server clock so all workers agree on time.
+CIRCUIT_ALLOW = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 3 end
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local opened = tonumber(redis.call('HGET', KEYS[1], 'opened_at') or '0')
+if opened == 0 then return 1 end
+local reset_ms = tonumber(ARGV[1])
+if now - opened < reset_ms then return 0 end
+local trial = tonumber(redis.call('HGET', KEYS[1], 'trial_at') or '0')
+if now - trial < reset_ms then return 0 end
+redis.call('HSET', KEYS[1], 'trial_at', now)
+return 2
+"""
+
+CIRCUIT_FAILURE = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+local opened = tonumber(redis.call('HGET', KEYS[1], 'opened_at') or '0')
+if failures >= tonumber(ARGV[1]) or opened > 0 then
+    redis.call('HSET', KEYS[1], 'opened_at', now)
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return failures
+"""
+
+TOKEN_BUCKET = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate) + 1000)
+return {allowed, tostring(tokens)}
+"""
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker shared by all workers through Redis.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls
+    are rejected for ``reset_timeout`` seconds; then one trial call is let
+    through, and its outcome closes or re-opens the circuit. When Redis is
+    unreachable the same logic runs on per-process state.
+
+    :meth:`allow` notes whether it found no failures at all, in which case
+    the following :meth:`record_success` has nothing to clear in Redis.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_at = 0.0
+        self._clean = contextvars.ContextVar(f"circuit_{name}_clean", default=False)
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def _key(self):
+        return cache.make_key(f"circuit_{self.name}")
+
+    def _ttl_ms(self):
+        return int(self.reset_timeout * 10 * 1000)
+
+    def allow(self):
+        if not self.enabled:
+            return True
+        try:
+            result = get_redis_connection("default").register_script(CIRCUIT_ALLOW)(
+                keys=[self._key()], args=[int(self.reset_timeout * 1000)]
+            )
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+            result = self._local_allow()
+        return self._observe(result)
+
+    async def aallow(self):
+        if not self.enabled:
+            return True
+        try:
+            result = await get_async_redis().register_script(CIRCUIT_ALLOW)(
+                keys=[self._key()], args=[int(self.reset_timeout * 1000)]
+            )
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+            result = self._local_allow()
+        return self._observe(result)
+
+    def record_success(self):
+        if not self.enabled:
+            return
+        self._local_success()
+        if self._clean.get():
+            return
+        try:
+            get_redis_connection("default").delete(self._key())
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+
+    async def arecord_success(self):
+        if not self.enabled:
+            return
+        self._local_success()
+        if self._clean.get():
+            return
+        try:
+            await get_async_redis().delete(self._key())
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        try:
+            failures = get_redis_connection("default").register_script(CIRCUIT_FAILURE)(
+                keys=[self._key()], args=[self.failure_threshold, self._ttl_ms()]
+            )
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+            failures = self._local_failure()
+        self._log_failure(failures)
+
+    async def arecord_failure(self):
+        if not self.enabled:
+            return
+        try:
+            failures = await get_async_redis().register_script(CIRCUIT_FAILURE)(
+                keys=[self._key()], args=[self.failure_threshold, self._ttl_ms()]
+            )
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+            failures = self._local_failure()
+        self._log_failure(failures)
+
+    def state(self):
+        if not self.enabled:
+            return {"state": "disabled", "failures": 0}
+        try:
+            raw = get_redis_connection("default").hgetall(self._key())
+            failures = int(raw.get(b"failures", 0))
+            opened_at = int(raw.get(b"opened_at", 0)) / 1000
+        except Exception as e:
+            logger.warning("circuit_redis_error name=%s error='%s'", self.name, e)
+            with self._lock:
+                failures, opened_at = self._failures, self._opened_at
+        if not opened_at:
+            state = CLOSED
+        elif time.time() - opened_at < self.reset_timeout:
+            state = OPEN
+        else:
+            state = HALF_OPEN
+        UPSTREAM_CIRCUIT_OPEN.set(1 if state == OPEN else 0)
+        return {"state": state, "failures": failures}
+
+    def _observe(self, result):
+        # 3: no circuit state in Redis. The flag is per thread or task, the
+        # same one that reports the call's outcome.
+        self._clean.set(result == 3)
+        allowed = bool(result)
+        UPSTREAM_CIRCUIT_OPEN.set(0 if allowed else 1)
+        if result == 2:
+            logger.info("circuit_half_open_trial name=%s", self.name)
+        return allowed
+
+    def _log_failure(self, failures):
+        if failures == self.failure_threshold:
+            logger.error("circuit_opened name=%s failures=%s", self.name, failures)
+
+    def _local_allow(self):
+        now = time.time()
+        with self._lock:
+            if not self._opened_at:
+                return 1
+            if now - self._opened_at < self.reset_timeout:
+                return 0
+            if now - self._trial_at < self.reset_timeout:
+                return 0
+            self._trial_at = now
+            return 2
+
+    def _local_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = 0.0
+            self._trial_at = 0.0
+
+    def _local_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold or self._opened_at:
+                self._opened_at = time.time()
+            return self._failures
+
+
+class TokenBucket:
+    """Global budget of ``rate_per_minute`` calls with bursts up to ``capacity``.
+
+    The bucket lives in Redis so the budget holds across workers; without
+    Redis each process falls back to its own bucket of the same size.
+    """
+
+    def __init__(self, name: str, rate_per_minute: float, capacity: int):
+        self.name = name
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.rate_per_minute > 0
+
+    def _key(self):
+        return cache.make_key(f"bucket_{self.name}")
+
+    def _args(self):
+        return [self.rate_per_minute / 60_000, self.capacity]
+
+    def acquire(self):
+        if not self.enabled:
+            return True
+        try:
+            allowed, tokens = get_redis_connection("default").register_script(
+                TOKEN_BUCKET
+            )(keys=[self._key()], args=self._args())
+        except Exception as e:
+            logger.warning("bucket_redis_error name=%s error='%s'", self.name, e)
+            allowed, tokens = self._local_acquire()
+        UPSTREAM_BUDGET_TOKENS.set(float(tokens))
+        return bool(allowed)
+
+    async def aacquire(self):
+        if not self.enabled:
+            return True
+        try:
+            allowed, tokens = await get_async_redis().register_script(TOKEN_BUCKET)(
+                keys=[self._key()], args=self._args()
+            )
+        except Exception as e:
+            logger.warning("bucket_redis_error name=%s error='%s'", self.name, e)
+            allowed, tokens = self._local_acquire()
+        UPSTREAM_BUDGET_TOKENS.set(float(tokens))
+        return bool(allowed)
+
+    def tokens(self):
+        if not self.enabled:
+            return None
+        try:
+            raw = get_redis_connection("default").hmget(self._key(), "tokens", "ts")
+            if raw[0] is None:
+                return float(self.capacity)
+            elapsed_ms = max(0, time.time() * 1000 - int(raw[1]))
+            return min(self.capacity, float(raw[0]) + elapsed_ms * self._args()[0])
+        except Exception as e:
+            logger.warning("bucket_redis_error name=%s error='%s'", self.name, e)
+            with self._lock:
+                return self._tokens
+
+    def _local_acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate_per_minute / 60,
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 1, self._tokens
+            return 0, self._tokens
@@ -0,0 +1,194 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+
+from .models import (
+    ArchivedWeatherQuery,
+    HourlyRollup,
+    RawPayload,
+    RollupCheckpoint,
+    WeatherQuery,
+)
+
+logger = logging.getLogger("weather")
+
+CHECKPOINT = "hourly"
+ARCHIVED_FIELDS = [
+    "id",
+    "city_name",
+    "city_key",
+    "timestamp",
+    "temperature",
+    "weather_description",
+    "units",
+    "served_from_cache",
+    "ip_address",
+    "payload_id",
+]
+
+
+def _hour(value):
+    return timezone.localtime(value).replace(minute=0, second=0, microsecond=0)
+
+
+def closed_until():
+    """Start of the newest hour whose rows can all be assumed written.
+
+    An hour is rolled up once it has been over for HISTORY_ROLLUP_LAG
+    seconds, which must cover the write-behind flush interval and any
+    in-flight transaction; rows arriving for an hour after that are not
+    counted.
+    """
+    return _hour(timezone.now() - timedelta(seconds=settings.HISTORY_ROLLUP_LAG))
+
+
+def rollups_until():
+    """Start of the hours that can be read from the live table in full.
+
+    Pruning removes rows oldest first and only from hours already rolled
+    up, so earlier hours (including the oldest live row's, which may be
+    partly pruned) are only complete in :class:`HourlyRollup`. ``None``
+    before anything has been rolled up.
+    """
+    checkpoint = RollupCheckpoint.objects.filter(name=CHECKPOINT).first()
+    if checkpoint is None or checkpoint.rolled_up_to is None:
+        return None
+    oldest = WeatherQuery.objects.order_by("timestamp").values_list(
+        "timestamp", flat=True
+    )
+    oldest = oldest.first()
+    if oldest is None:
+        return checkpoint.rolled_up_to
+    return min(_hour(oldest) + timedelta(hours=1), checkpoint.rolled_up_to)
+
+
+def roll_up_hour():
+    """Roll up the next closed hour after the checkpoint that has rows.
+
+    The hour's rollups are rebuilt from its rows and the checkpoint moves
+    past it in the same transaction. Returns the number of rows rolled up,
+    or ``None`` when no closed hour is left.
+    """
+    until = closed_until()
+    with transaction.atomic():
+        checkpoint, _ = RollupCheckpoint.objects.select_for_update().get_or_create(
+            name=CHECKPOINT
+        )
+        pending = WeatherQuery.objects.filter(timestamp__lt=until)
+        if checkpoint.rolled_up_to:
+            pending = pending.filter(timestamp__gte=checkpoint.rolled_up_to)
+        first = pending.order_by("timestamp").values_list("timestamp", flat=True)
+        first = first.first()
+        if first is None:
+            if checkpoint.rolled_up_to is None or checkpoint.rolled_up_to < until:
+                checkpoint.rolled_up_to = until
+                checkpoint.save()
+            return None
+        hour = _hour(first)
+        rows = (
+            WeatherQuery.objects.filter(
+                timestamp__gte=hour, timestamp__lt=hour + timedelta(hours=1)
+            )
+            .values("city_key", "units")
+            .annotate(
+                city_name=Max("city_name"),
+                requests=Count("pk"),
+                cache_hits=Count("pk", filter=Q(served_from_cache=True)),
+                temperature_min=Min("temperature"),
+                temperature_max=Max("temperature"),
+                temperature_sum=Sum("temperature"),
+            )
+            .order_by()
+        )
+        rollups = [HourlyRollup(hour=hour, **row) for row in rows]
+        HourlyRollup.objects.filter(hour=hour).delete()
+        HourlyRollup.objects.bulk_create(rollups)
+        checkpoint.rolled_up_to = hour + timedelta(hours=1)
+        checkpoint.save()
+    rolled = sum(rollup.requests for rollup in rollups)
+    logger.info("history_rollup hour=%s rows=%s", hour.isoformat(), rolled)
+    return rolled
+
+
+def roll_up(pause: float = 0):
+    total = 0
+    while (rolled := roll_up_hour()) is not None:
+        total += rolled
+        time.sleep(pause)
+    return total
+
+
+def prune_batch(cutoff, batch_size: int, archive: bool):
+    """Archive or delete up to ``batch_size`` rows older than ``cutoff``.
+
+    Only rows from hours already rolled up are touched. Each batch is its
+    own short transaction keyed by primary key, so no lock is held across
+    the whole table. Deleting also drops payloads no row uses any more.
+    """
+    with transaction.atomic():
+        checkpoint = RollupCheckpoint.objects.filter(name=CHECKPOINT).first()
+        if checkpoint is None or checkpoint.rolled_up_to is None:
+            return 0
+        ids = list(
+            WeatherQuery.objects.filter(
+                timestamp__lt=min(cutoff, checkpoint.rolled_up_to)
+            )
+            .order_by("timestamp", "pk")
+            .values_list("pk", flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0
+        rows = WeatherQuery.objects.filter(pk__in=ids).values(*ARCHIVED_FIELDS)
+        if archive:
+            ArchivedWeatherQuery.objects.bulk_create(
+                ArchivedWeatherQuery(**row) for row in rows
+            )
+            WeatherQuery.objects.filter(pk__in=ids).delete()
+        else:
+            payloads = {row["payload_id"] for row in rows}
+            WeatherQuery.objects.filter(pk__in=ids).delete()
+            RawPayload.delete_unreferenced(
+                payloads, timedelta(seconds=settings.RAW_PAYLOAD_GRACE_PERIOD)
+            )
+    logger.info("history_prune rows=%s archived=%s", len(ids), archive)
+    return len(ids)
+
+
+def prune(cutoff, batch_size: int, archive: bool, pause: float = 0):
+    total = 0
+    while pruned := prune_batch(cutoff, batch_size, archive):
+        total += pruned
+        time.sleep(pause)
+    return total
+
+
+def purge_archive_batch(cutoff, batch_size: int):
+    """Delete up to ``batch_size`` archived rows older than ``cutoff``."""
+    with transaction.atomic():
+        rows = list(
+            ArchivedWeatherQuery.objects.filter(timestamp__lt=cutoff)
+            .order_by("timestamp", "pk")
+            .values_list("pk", "payload_id")[:batch_size]
+        )
+        if not rows:
+            return 0
+        ArchivedWeatherQuery.objects.filter(pk__in=[pk for pk, _ in rows]).delete()
+        RawPayload.delete_unreferenced(
+            {payload for _, payload in rows},
+            timedelta(seconds=settings.RAW_PAYLOAD_GRACE_PERIOD),
+        )
+    logger.info("archive_purge rows=%s", len(rows))
+    return len(rows)
+
+
+def purge_archive(cutoff, batch_size: int, pause: float = 0):
+    total = 0
+    while purged := purge_archive_batch(cutoff, batch_size):
+        total += purged
+        time.sleep(pause)
+    return total
@@ -1,13 +1,36 @@
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
+from django.db import connections
 from django.utils import timezone
 
-from .api_client import WeatherAPIClient
-from .cache import WeatherCache
+from .api_client import AsyncWeatherAPIClient, WeatherAPIClient
+from .cache import AsyncWeatherCache, WeatherCache
+from .history import city_facets, history_writer
+from .hotkeys import hot_keys
+from .log import in_request_context
+from .metrics import DB_WRITE_LATENCY, DB_WRITES, STALE_SERVES
 from .models import WeatherQuery
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .units import CANONICAL_UNITS, convert_payload, convert_temperature
 
 logger = logging.getLogger("weather")
 
+_inflight = SingleFlight()
+_async_inflight = AsyncSingleFlight()
+
+# Background refreshes for entries served past their soft TTL.
+_revalidator = ThreadPoolExecutor(
+    max_workers=settings.WEATHER_REVALIDATE_WORKERS,
+    thread_name_prefix="weather-revalidate",
+)
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+_async_revalidating = {}
+
 
 class WeatherService:
     def __init__(self):
@@ -15,99 +38,511 @@ class WeatherService:
         self.cache = WeatherCache()
 
     def get_weather(self, city: str, units: str, ip_address: str = None):
-        logger.info(f"weather_request_start city={city} units={units} ip={ip_address}")
+        result = self._get_weather(city, units, ip_address)
+        if result:
+            # Only input that produced weather is ranked, so unknown or junk
+            # city strings never reach the hot-key set.
+            hot_keys.record(city, CANONICAL_UNITS)
+        return result
+
+    def _get_weather(self, city: str, units: str, ip_address: str = None):
+        logger.info(
+            "weather_request_start city=%s units=%s ip=%s", city, units, ip_address
+        )
+        # Cache and upstream work in one unit system; the response is
+        # converted to the requested one.
+        if self.cache.is_not_found(city):
+            logger.info("negative_cache_hit city=%s", city)
+            return None
+        base = CANONICAL_UNITS
+
+        cached_data = self.cache.get_cached_weather(city, base)
+
+        if cached_data:
+            stale = self.cache.is_stale(cached_data)
+            if stale:
+                logger.info("cache_stale city=%s units=%s", city, units)
+                STALE_SERVES.labels(reason="revalidate").inc()
+                self._revalidate(city, base)
+            else:
+                logger.info("cache_hit city=%s units=%s", city, units)
+            return self._create_cached_response(
+                cached_data, ip_address, city, units, stale=stale
+            )
 
-        cached_data = self.cache.get_cached_weather(city, units)
+        logger.info("cache_miss city=%s units=%s", city, units)
+        cached_data, api_data = self._resolve_miss(city, base)
 
+        if api_data:
+            return self._create_api_response(api_data, units, ip_address)
         if cached_data:
-            logger.info(f"cache_hit city={city} units={units}")
             return self._create_cached_response(cached_data, ip_address, city, units)
 
-        logger.info(f"cache_miss city={city} units={units}")
-        api_data = self.api_client.get_weather(city, units)
+        stale_data = self.cache.get_stale_from_db(city, base)
+        if stale_data:
+            logger.warning("serving_stale_on_error city=%s units=%s", city, units)
+            STALE_SERVES.labels(reason="error").inc()
+            return self._create_cached_response(
+                stale_data, ip_address, city, units, stale=True
+            )
+
+        logger.error("api_request_failed city=%s units=%s", city, units)
+        return None
+
+    def get_weather_batch(self, cities, units: str, ip_address: str = None):
+        logger.info(
+            "weather_batch_start cities=%s units=%s ip=%s",
+            len(cities),
+            units,
+            ip_address,
+        )
+        unknown = {city for city in cities if self.cache.is_not_found(city)}
+        known = [city for city in cities if city not in unknown]
+        base = CANONICAL_UNITS
+        cached = self.cache.get_many_cached(known, base)
+        if cached is None:
+            cached = {}
+            for city in known:
+                cached_data = self.cache.get_cached_weather(city, base)
+                if cached_data:
+                    cached[city] = cached_data
+        else:
+            # Same DB tier get_weather falls back to, in one query.
+            missing = [city for city in known if city not in cached]
+            if missing:
+                cached.update(self.cache.get_many_from_db(missing, base))
+
+        stale = {city for city, data in cached.items() if self.cache.is_stale(data)}
+        for city in stale:
+            STALE_SERVES.labels(reason="revalidate").inc()
+            self._revalidate(city, base)
+
+        misses = [city for city in known if city not in cached]
+        logger.info(
+            "weather_batch_lookup hits=%s stale=%s misses=%s unknown=%s",
+            len(cached),
+            len(stale),
+            len(misses),
+            len(unknown),
+        )
+        resolved = {}
+        if misses:
+            workers = min(settings.BATCH_MAX_WORKERS, len(misses))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for city, outcome in zip(
+                    misses,
+                    pool.map(
+                        in_request_context(self._resolve_miss_in_thread),
+                        misses,
+                        [base] * len(misses),
+                    ),
+                ):
+                    resolved[city] = outcome
+
+        entries = []
+        for city in cities:
+            if city in unknown:
+                entries.append((city, None, None))
+                continue
+            cached_data, api_data = (
+                (cached[city], None) if city in cached else resolved[city]
+            )
+            if not cached_data and not api_data:
+                cached_data = self.cache.get_stale_from_db(city, base)
+                if cached_data:
+                    logger.warning(
+                        "serving_stale_on_error city=%s units=%s", city, units
+                    )
+                    STALE_SERVES.labels(reason="error").inc()
+                    stale.add(city)
+            try:
+                if api_data:
+                    query = self._api_query(api_data, units, ip_address)
+                elif cached_data:
+                    query = self._cached_query(cached_data, ip_address, units)
+                else:
+                    query = None
+            except Exception as e:
+                logger.error("batch_entry_error city=%s error='%s'", city, e)
+                query = None
+            entries.append((city, query, api_data))
+
+        queries = [query for _, query, _ in entries if query is not None]
+        try:
+            self._persist_many(queries)
+        except Exception as e:
+            logger.error("batch_persist_error count=%s error='%s'", len(queries), e)
 
+        results = []
+        for city, query, api_data in entries:
+            if query is None:
+                results.append({"city": city, "error": "City not found or API error"})
+            elif api_data:
+                results.append(
+                    {"city": city, "data": self._api_result(query, api_data)}
+                )
+            else:
+                results.append(
+                    {
+                        "city": city,
+                        "data": self._cached_result(query, stale=city in stale),
+                    }
+                )
+        hot_keys.record_many(
+            [result["city"] for result in results if "data" in result], base
+        )
+        return results
+
+    def _resolve_miss(self, city: str, units: str):
+        # Returns (cached_data, api_data); api_data is only set for the
+        # caller that actually went upstream.
+        if settings.SINGLE_FLIGHT_ENABLED:
+            (cached_data, api_data), shared = _inflight.do(
+                self.cache.make_key(city, units), self._fetch_on_miss, city, units
+            )
+        else:
+            cached_data, api_data, shared = None, self._fetch(city, units), False
+
+        if api_data and shared:
+            logger.info("single_flight_shared city=%s units=%s", city, units)
+            try:
+                return self._build_cache_data(api_data, units), None
+            except (KeyError, IndexError, TypeError) as e:
+                logger.error("shared_response_error city=%s error='%s'", city, e)
+                return None, None
+        return cached_data, api_data
+
+    def _revalidate(self, city: str, units: str):
+        key = self.cache.make_key(city, units)
+        with _revalidating_lock:
+            if key in _revalidating:
+                return
+            _revalidating.add(key)
+
+        def run():
+            try:
+                self.refresh(city, units)
+            except Exception as e:
+                logger.error("revalidate_error city=%s error='%s'", city, e)
+            finally:
+                with _revalidating_lock:
+                    _revalidating.discard(key)
+
+        _revalidator.submit(in_request_context(run))
+
+    def _resolve_miss_in_thread(self, city: str, units: str):
+        try:
+            return self._resolve_miss(city, units)
+        finally:
+            connections.close_all()
+
+    def _fetch_on_miss(self, city: str, units: str):
+        with self.cache.fetch_lock(city, units) as contended:
+            if contended:
+                cached_data = self.cache.get_cached_weather(city, units)
+                if cached_data:
+                    return cached_data, None
+            return None, self._fetch(city, units)
+
+    def refresh(self, city: str, units: str):
+        """Re-fetch a city into the cache ahead of expiry without writing history.
+
+        Returns None without calling upstream when another worker is already
+        fetching the same key.
+        """
+        with self.cache.fetch_lock(city, units) as contended:
+            if contended:
+                return None
+            return self._fetch(city, units)
+
+    def _fetch(self, city: str, units: str):
+        api_data = self.api_client.get_weather(city, units)
         if api_data:
-            result = self._create_api_response(api_data, units, ip_address)
             self._save_to_cache(city, units, api_data)
-            return result
-        else:
-            logger.error(f"api_request_failed city={city} units={units}")
-            return None
+        return api_data
+
+    @staticmethod
+    def _build_cache_data(api_data: dict, units: str):
+        return {
+            "city_name": api_data["name"],
+            "temperature": api_data["main"]["temp"],
+            "weather_description": api_data["weather"][0]["description"],
+            "units": units,
+            "timestamp": timezone.now(),
+        }
 
     def _save_to_cache(self, city: str, units: str, api_data: dict):
 
         try:
-            cache_data = {
-                "city_name": api_data["name"],
-                "temperature": api_data["main"]["temp"],
-                "weather_description": api_data["weather"][0]["description"],
-                "units": units,
-                "timestamp": timezone.now(),
-            }
+            cache_data = self._build_cache_data(api_data, units)
             self.cache.set_cached_weather(city, units, cache_data)
-            logger.info(f"cache_set_success city={city}")
+            logger.info("cache_set_success city=%s", city)
         except Exception as e:
-            logger.warning(f"cache_set_failed city={city} error='{str(e)}'")
+            logger.warning("cache_set_failed city=%s error='%s'", city, e)
+
+    @staticmethod
+    def _cached_query(cached_data, ip_address, units):
+        if isinstance(cached_data, dict):
+            return WeatherQuery(
+                city_name=cached_data["city_name"],
+                temperature=convert_temperature(
+                    cached_data["temperature"], cached_data["units"], units
+                ),
+                weather_description=cached_data["weather_description"],
+                units=units,
+                served_from_cache=True,
+                ip_address=ip_address,
+            )
+        return WeatherQuery(
+            city_name=cached_data.city_name,
+            temperature=convert_temperature(
+                cached_data.temperature, cached_data.units, units
+            ),
+            weather_description=cached_data.weather_description,
+            units=units,
+            served_from_cache=True,
+            ip_address=ip_address,
+        )
+
+    @staticmethod
+    def _cached_result(weather_query, stale: bool = False):
+        return {
+            "temperature": weather_query.temperature,
+            "weather_description": weather_query.weather_description,
+            "city": weather_query.city_name,
+            "served_from_cache": True,
+            "stale": stale,
+        }
+
+    @staticmethod
+    def _api_query(api_data, units, ip_address):
+        # api_data is always in CANONICAL_UNITS; history keeps the
+        # payload as the caller saw it.
+        payload = convert_payload(api_data, CANONICAL_UNITS, units)
+        return WeatherQuery(
+            city_name=payload["name"],
+            temperature=payload["main"]["temp"],
+            weather_description=payload["weather"][0]["description"],
+            units=units,
+            served_from_cache=False,
+            ip_address=ip_address,
+            raw_data=payload,
+        )
 
-    def _create_cached_response(self, cached_data, ip_address, city, units):
+    @staticmethod
+    def _api_result(weather_query, api_data):
+        return {
+            "temperature": weather_query.temperature,
+            "weather_description": weather_query.weather_description,
+            "city": weather_query.city_name,
+            "humidity": api_data["main"]["humidity"],
+            "pressure": api_data["main"]["pressure"],
+            "served_from_cache": False,
+            "stale": False,
+        }
+
+    @staticmethod
+    def _persist(weather_query):
+        if settings.HISTORY_WRITE_BEHIND:
+            history_writer.submit(weather_query)
+        else:
+            with DB_WRITE_LATENCY.labels(mode="save").time():
+                weather_query.save()
+            DB_WRITES.labels(mode="save").inc()
+        city_facets.record(weather_query.city_name)
+
+    @staticmethod
+    def _persist_many(weather_queries):
+        if settings.HISTORY_WRITE_BEHIND:
+            history_writer.submit_many(weather_queries)
+        elif weather_queries:
+            with DB_WRITE_LATENCY.labels(mode="bulk").time():
+                WeatherQuery.objects.bulk_create(weather_queries)
+            DB_WRITES.labels(mode="bulk").inc(len(weather_queries))
+        city_facets.record_many(weather_queries)
+
+    def _create_cached_response(
+        self, cached_data, ip_address, city, units, stale: bool = False
+    ):
         try:
-            if isinstance(cached_data, dict):
-                new_query = WeatherQuery.objects.create(
-                    city_name=cached_data["city_name"],
-                    temperature=cached_data["temperature"],
-                    weather_description=cached_data["weather_description"],
-                    units=cached_data["units"],
-                    served_from_cache=True,
-                    ip_address=ip_address,
-                )
-            else:
-                new_query = WeatherQuery.objects.create(
-                    city_name=cached_data.city_name,
-                    temperature=cached_data.temperature,
-                    weather_description=cached_data.weather_description,
-                    units=cached_data.units,
-                    served_from_cache=True,
-                    ip_address=ip_address,
-                )
+            new_query = self._cached_query(cached_data, ip_address, units)
+            self._persist(new_query)
 
-            result = {
-                "temperature": new_query.temperature,
-                "weather_description": new_query.weather_description,
-                "city": new_query.city_name,
-                "served_from_cache": True,
-            }
+            result = self._cached_result(new_query, stale=stale)
 
-            logger.info(f"cache_response_created city={new_query.city_name}")
+            logger.info("cache_response_created city=%s", new_query.city_name)
             return result
 
         except Exception as e:
-            logger.error(f"cache_response_error error='{str(e)}'")
+            logger.error("cache_response_error error='%s'", e)
             return None
 
     def _create_api_response(self, api_data, units, ip_address):
         try:
-            weather_query = WeatherQuery.objects.create(
-                city_name=api_data["name"],
-                temperature=api_data["main"]["temp"],
-                weather_description=api_data["weather"][0]["description"],
-                units=units,
-                served_from_cache=False,
-                ip_address=ip_address,
-                raw_data=api_data,
+            weather_query = self._api_query(api_data, units, ip_address)
+            self._persist(weather_query)
+
+            result = self._api_result(weather_query, api_data)
+
+            logger.info("api_response_created city=%s", weather_query.city_name)
+            return result
+
+        except Exception as e:
+            logger.error("api_response_error error='%s'", e)
+            return None
+
+
+class AsyncWeatherService:
+    def __init__(self):
+        self.api_client = AsyncWeatherAPIClient()
+        self.cache = AsyncWeatherCache()
+
+    async def get_weather(self, city: str, units: str, ip_address: str = None):
+        result = await self._get_weather(city, units, ip_address)
+        if result:
+            await hot_keys.arecord(city, CANONICAL_UNITS)
+        return result
+
+    async def _get_weather(self, city: str, units: str, ip_address: str = None):
+        logger.info(
+            "weather_request_start city=%s units=%s ip=%s", city, units, ip_address
+        )
+        if await self.cache.is_not_found(city):
+            logger.info("negative_cache_hit city=%s", city)
+            return None
+        base = CANONICAL_UNITS
+
+        cached_data = await self.cache.get_cached_weather(city, base)
+
+        if cached_data:
+            stale = WeatherCache.is_stale(cached_data)
+            if stale:
+                logger.info("cache_stale city=%s units=%s", city, units)
+                STALE_SERVES.labels(reason="revalidate").inc()
+                self._revalidate(city, base)
+            else:
+                logger.info("cache_hit city=%s units=%s", city, units)
+            return await self._create_cached_response(
+                cached_data, ip_address, city, units, stale=stale
+            )
+
+        logger.info("cache_miss city=%s units=%s", city, units)
+        cached_data, api_data = await self._resolve_miss(city, base)
+
+        if api_data:
+            return await self._create_api_response(api_data, units, ip_address)
+        if cached_data:
+            return await self._create_cached_response(
+                cached_data, ip_address, city, units
             )
 
-            result = {
-                "temperature": weather_query.temperature,
-                "weather_description": weather_query.weather_description,
-                "city": weather_query.city_name,
-                "humidity": api_data["main"]["humidity"],
-                "pressure": api_data["main"]["pressure"],
-                "served_from_cache": False,
-            }
+        stale_data = await self.cache.get_stale_from_db(city, base)
+        if stale_data:
+            logger.warning("serving_stale_on_error city=%s units=%s", city, units)
+            STALE_SERVES.labels(reason="error").inc()
+            return await self._create_cached_response(
+                stale_data, ip_address, city, units, stale=True
+            )
+
+        logger.error("api_request_failed city=%s units=%s", city, units)
+        return None
+
+    async def _resolve_miss(self, city: str, units: str):
+        if settings.SINGLE_FLIGHT_ENABLED:
+            (cached_data, api_data), shared = await _async_inflight.do(
+                WeatherCache.make_key(city, units), self._fetch_on_miss, city, units
+            )
+        else:
+            cached_data, api_data, shared = None, await self._fetch(city, units), False
+
+        if api_data and shared:
+            logger.info("single_flight_shared city=%s units=%s", city, units)
+            try:
+                return WeatherService._build_cache_data(api_data, units), None
+            except (KeyError, IndexError, TypeError) as e:
+                logger.error("shared_response_error city=%s error='%s'", city, e)
+                return None, None
+        return cached_data, api_data
+
+    def _revalidate(self, city: str, units: str):
+        # Tasks are held in _async_revalidating until done so they are not
+        # garbage collected mid-flight.
+        key = (id(asyncio.get_running_loop()), WeatherCache.make_key(city, units))
+        if key in _async_revalidating:
+            return
+        task = asyncio.create_task(self.refresh(city, units))
+        _async_revalidating[key] = task
+        task.add_done_callback(lambda _: _async_revalidating.pop(key, None))
+
+    async def refresh(self, city: str, units: str):
+        try:
+            async with self.cache.fetch_lock(city, units) as contended:
+                if contended:
+                    return None
+                return await self._fetch(city, units)
+        except Exception as e:
+            logger.error("revalidate_error city=%s error='%s'", city, e)
+            return None
+
+    async def _fetch_on_miss(self, city: str, units: str):
+        async with self.cache.fetch_lock(city, units) as contended:
+            if contended:
+                cached_data = await self.cache.get_cached_weather(city, units)
+                if cached_data:
+                    return cached_data, None
+            return None, await self._fetch(city, units)
+
+    async def _fetch(self, city: str, units: str):
+        api_data = await self.api_client.get_weather(city, units)
+        if api_data:
+            await self._save_to_cache(city, units, api_data)
+        return api_data
+
+    async def _save_to_cache(self, city: str, units: str, api_data: dict):
+
+        try:
+            cache_data = WeatherService._build_cache_data(api_data, units)
+            await self.cache.set_cached_weather(city, units, cache_data)
+            logger.info("cache_set_success city=%s", city)
+        except Exception as e:
+            logger.warning("cache_set_failed city=%s error='%s'", city, e)
+
+    @staticmethod
+    async def _persist(weather_query):
+        if settings.HISTORY_WRITE_BEHIND:
+            await history_writer.asubmit(weather_query)
+        else:
+            with DB_WRITE_LATENCY.labels(mode="save").time():
+                await weather_query.asave()
+            DB_WRITES.labels(mode="save").inc()
+        await city_facets.arecord(weather_query.city_name)
+
+    async def _create_cached_response(
+        self, cached_data, ip_address, city, units, stale: bool = False
+    ):
+        try:
+            new_query = WeatherService._cached_query(cached_data, ip_address, units)
+            await self._persist(new_query)
+
+            result = WeatherService._cached_result(new_query, stale=stale)
+
+            logger.info("cache_response_created city=%s", new_query.city_name)
+            return result
+
+        except Exception as e:
+            logger.error("cache_response_error error='%s'", e)
+            return None
+
+    async def _create_api_response(self, api_data, units, ip_address):
+        try:
+            weather_query = WeatherService._api_query(api_data, units, ip_address)
+            await self._persist(weather_query)
+
+            result = WeatherService._api_result(weather_query, api_data)
 
-            logger.info(f"api_response_created city={weather_query.city_name}")
+            logger.info("api_response_created city=%s", weather_query.city_name)
             return result
 
         except Exception as e:
-            logger.error(f"api_response_error error='{str(e)}'")
+            logger.error("api_response_error error='%s'", e)
             return None
@@ -0,0 +1,232 @@
+import hashlib
+import logging
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, F, FloatField, Max, Min, Q, Sum, When
+from django.db.models.functions import TruncDay, TruncHour
+
+from .cache import WeatherCache
+from .models import HourlyRollup, WeatherQuery
+from .retention import rollups_until
+from .units import convert_temperature
+
+logger = logging.getLogger("weather")
+
+BUCKETS = {
+    "hour": (TruncHour, timedelta(hours=1)),
+    "day": (TruncDay, timedelta(days=1)),
+}
+PERCENTILES = (50, 90, 95, 99)
+
+# History rows keep the temperature in the unit system that was requested;
+# everything is aggregated in Celsius and converted at the end.
+CELSIUS = Case(
+    When(units="metric", then=F("temperature")),
+    When(units="imperial", then=(F("temperature") - 32) * 5 / 9),
+    default=F("temperature") - 273.15,
+    output_field=FloatField(),
+)
+
+
+def _celsius(value, units: str):
+    # Same conversion as CELSIUS, for values read back from HourlyRollup.
+    if units == "metric":
+        return value
+    if units == "imperial":
+        return (value - 32) * 5 / 9
+    return value - 273.15
+
+
+def bucket_percentiles(values, counts, percentiles=PERCENTILES):
+    """Percentiles of consecutive segments of ``values``, one row per segment.
+
+    ``values`` holds every bucket's samples back to back and ``counts`` the
+    length of each (all non-zero). Each segment is sorted in one lexsort
+    and the percentiles are interpolated linearly, like ``np.percentile``.
+    """
+    counts = np.asarray(counts)
+    segments = np.repeat(np.arange(len(counts)), counts)
+    ordered = values[np.lexsort((values, segments))]
+    offsets = np.cumsum(counts) - counts
+    positions = offsets[:, None] + np.asarray(percentiles) / 100 * (counts[:, None] - 1)
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    return ordered[low] + (ordered[high] - ordered[low]) * (positions - low)
+
+
+def _live_buckets(city_key: str, queries, trunc):
+    """Grouped counts and temperatures, plus percentiles, from live rows."""
+    rows = list(
+        queries.annotate(bucket=trunc("timestamp"))
+        .values("bucket")
+        .annotate(
+            requests=Count("pk"),
+            cache_hits=Count("pk", filter=Q(served_from_cache=True)),
+            temperature_min=Min(CELSIUS),
+            temperature_max=Max(CELSIUS),
+            temperature_sum=Sum(CELSIUS),
+            last_id=Max("pk"),
+        )
+        .order_by("bucket")
+    )
+    if not rows:
+        return []
+    # Rows written after the grouped query would shift every bucket
+    # boundary, so the second query stops at the same ids.
+    temperatures = queries.filter(pk__lte=max(row["last_id"] for row in rows))
+    temperatures = np.fromiter(
+        temperatures.order_by("timestamp", "pk")
+        .annotate(celsius=CELSIUS)
+        .values_list("celsius", flat=True),
+        dtype=np.float64,
+    )
+    counts = [row["requests"] for row in rows]
+    if len(temperatures) == sum(counts):
+        percentiles = bucket_percentiles(temperatures, counts)
+    else:
+        logger.warning(
+            "stats_rows_changed city=%s expected=%s got=%s",
+            city_key,
+            sum(counts),
+            len(temperatures),
+        )
+        percentiles = np.full((len(rows), len(PERCENTILES)), np.nan)
+    for row, values in zip(rows, percentiles):
+        row["percentiles"] = values
+    return rows
+
+
+def _rollup_buckets(city_key: str, start, end, trunc):
+    """The same figures for hours only kept in :class:`HourlyRollup`.
+
+    Rollups are per unit system, so they are converted to Celsius and
+    merged here; they carry no samples, hence no percentiles.
+    """
+    rollups = (
+        HourlyRollup.objects.filter(city_key=city_key, hour__gte=start, hour__lt=end)
+        .annotate(bucket=trunc("hour"))
+        .order_by("bucket")
+    )
+    buckets = {}
+    for rollup in rollups:
+        row = buckets.setdefault(
+            rollup.bucket,
+            {
+                "bucket": rollup.bucket,
+                "requests": 0,
+                "cache_hits": 0,
+                "temperature_min": None,
+                "temperature_max": None,
+                "temperature_sum": 0.0,
+                "percentiles": None,
+            },
+        )
+        _merge(
+            row,
+            {
+                "requests": rollup.requests,
+                "cache_hits": rollup.cache_hits,
+                "temperature_min": _celsius(rollup.temperature_min, rollup.units),
+                "temperature_max": _celsius(rollup.temperature_max, rollup.units),
+                # The conversions are linear, so the mean converts as is.
+                "temperature_sum": _celsius(rollup.temperature_avg, rollup.units)
+                * rollup.requests,
+            },
+        )
+    return list(buckets.values())
+
+
+def _merge(row, other):
+    row["requests"] += other["requests"]
+    row["cache_hits"] += other["cache_hits"]
+    row["temperature_sum"] += other["temperature_sum"]
+    for key, pick in (("temperature_min", min), ("temperature_max", max)):
+        values = [v for v in (row[key], other[key]) if v is not None]
+        row[key] = pick(values) if values else None
+
+
+def compute_stats(city: str, start, end, bucket: str, units: str):
+    """Per-bucket temperature and request statistics for one city.
+
+    Counts, min, max and mean come from one grouped query. Percentiles need
+    every sample, so the temperatures alone are fetched as a flat float
+    column in timestamp order, which keeps each bucket's rows together.
+
+    Hours that retention may already have pruned are read from the hourly
+    rollups instead. Those buckets are marked ``from_rollups`` and have no
+    percentiles.
+    """
+    trunc, _ = BUCKETS[bucket]
+    city_key = WeatherCache.history_key(city)
+    boundary = rollups_until()
+    live_start = max(start, boundary) if boundary else start
+    rows = {}
+    if boundary and start < boundary:
+        for row in _rollup_buckets(city_key, start, min(end, boundary), trunc):
+            rows[row["bucket"]] = row
+    if live_start < end:
+        queries = WeatherQuery.objects.filter(
+            city_key=city_key, timestamp__gte=live_start, timestamp__lt=end
+        )
+        for row in _live_buckets(city_key, queries, trunc):
+            if row["bucket"] in rows:
+                # A day split by the boundary: no percentiles for the mix.
+                _merge(rows[row["bucket"]], row)
+            else:
+                rows[row["bucket"]] = row
+
+    def temperature(value):
+        if value is None or np.isnan(value):
+            return None
+        return convert_temperature(round(float(value), 2), "metric", units)
+
+    result = []
+    for key in sorted(rows):
+        row = rows[key]
+        percentiles = row["percentiles"]
+        if percentiles is None:
+            percentiles = [None] * len(PERCENTILES)
+        result.append(
+            {
+                "start": key.isoformat(),
+                "requests": row["requests"],
+                "cache_hit_ratio": round(row["cache_hits"] / row["requests"], 4),
+                "from_rollups": row["percentiles"] is None,
+                "temperature": {
+                    "min": temperature(row["temperature_min"]),
+                    "max": temperature(row["temperature_max"]),
+                    "mean": temperature(row["temperature_sum"] / row["requests"]),
+                    **{
+                        f"p{p}": temperature(value)
+                        for p, value in zip(PERCENTILES, percentiles)
+                    },
+                },
+            }
+        )
+    return result
+
+
+def city_stats(city: str, start, end, bucket: str, units: str):
+    """:func:`compute_stats`, cached per (city, range, bucket, units)."""
+    raw = (
+        f"{WeatherCache.history_key(city)}|{start.isoformat()}|{end.isoformat()}|"
+        f"{bucket}|{units}"
+    )
+    cache_key = f"weather_stats_{hashlib.md5(raw.encode()).hexdigest()}"
+    try:
+        stats = cache.get(cache_key)
+    except Exception as e:
+        logger.warning("stats_cache_error error='%s'", e)
+        stats = None
+    if stats is not None:
+        return stats
+
+    stats = compute_stats(city, start, end, bucket, units)
+    try:
+        cache.set(cache_key, stats, settings.STATS_CACHE_TTL)
+    except Exception as e:
+        logger.warning("stats_cache_error error='%s'", e)
+    return stats
@@ -1,15 +1,66 @@
+import asyncio
+import gzip
 import json
+import logging
+import pickle
+import socket
+import tempfile
+import threading
+import time
 from datetime import timedelta
 from unittest.mock import Mock, patch
 
+import httpx
+import numpy as np
 import pytest
-from django.test import Client, RequestFactory, TestCase
+import requests
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import (
+    Client,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.http import JsonResponse
 from django.utils import timezone
+from django_redis import get_redis_connection
 from datetime import datetime
-from weather.api_client import WeatherAPIClient
-from weather.models import WeatherQuery
-from weather.services import WeatherService
-from weather.views import weather_api
+from prometheus_client import REGISTRY
+from redis.exceptions import RedisError
+from benchmarks.fake_owm import start_fake_server
+from weather import log
+from weather import api_client
+from weather.api_client import AsyncWeatherAPIClient, WeatherAPIClient, get_session
+from weather.models import (
+    ArchivedWeatherQuery,
+    HourlyRollup,
+    RawPayload,
+    RollupCheckpoint,
+    WeatherQuery,
+)
+from weather.batching import GroupBatcher
+from weather.bloom import BloomFilter
+from weather.cache import WeatherCache, unknown_cities
+from weather.cities import City, CityIndex
+from weather.codec import WeatherSerializer
+from weather.health import HealthProber, check_database, check_redis
+from weather.history import HistoryWriter, city_facets
+from weather.hotkeys import hot_keys
+from weather.local_cache import LocalCache
+from weather.middleware import MetricsMiddleware
+from weather.ratelimit import Rate, RateLimiter, rate_limiter
+from weather.resilience import CircuitBreaker, TokenBucket
+from weather.services import AsyncWeatherService, WeatherService
+from weather.singleflight import SingleFlight
+from weather.stats import PERCENTILES, bucket_percentiles
+from weather.units import convert_payload, convert_speed, convert_temperature
+from weather.views import weather_api, weather_api_async
 from django.test import Client
 
 
@@ -17,6 +68,7 @@ from django.test import Client
 class TestWeatherService(TestCase):
     def setUp(self):
         WeatherQuery.objects.all().delete()
+        cache.clear()
 
     @patch("weather.services.WeatherAPIClient")
     def test_cache_reuse_within_5_minutes(self, MockAPIClient):
@@ -104,8 +156,9 @@ class TestWeatherService(TestCase):
 
         assert response.status_code == 200
 
-    @patch("weather.api_client.requests.get")
-    def test_api_client_success(self, mock_get):
+    @patch("weather.api_client.get_session")
+    def test_api_client_success(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -123,8 +176,9 @@ class TestWeatherService(TestCase):
         assert result["main"]["temp"] == 15.5
         mock_get.assert_called_once()
 
-    @patch("weather.api_client.requests.get")
-    def test_api_client_failure(self, mock_get):
+    @patch("weather.api_client.get_session")
+    def test_api_client_failure(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
         mock_response = Mock()
         mock_response.status_code = 404
         mock_get.return_value = mock_response
@@ -173,3 +227,1830 @@ class TestWeatherService(TestCase):
 
         response = client.get("/history/?page=2")
         self.assertEqual(len(response.context["queries"]), 5)
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return "sunny"
+
+        def worker():
+            results.append(flight.do("london_metric", fetch))
+
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r[0] for r in results], ["sunny"] * 10)
+        self.assertEqual(sum(1 for r in results if not r[1]), 1)
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_waits_for_other_worker_instead_of_fetching(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        lock = cache.lock(
+            f"lock_{WeatherCache.make_key('London', 'metric')}", thread_local=False
+        )
+        lock.acquire()
+        WeatherCache.set_cached_weather(
+            "London",
+            "metric",
+            {
+                "city_name": "London",
+                "temperature": 12.0,
+                "weather_description": "rain",
+                "units": "metric",
+                "timestamp": timezone.now(),
+            },
+        )
+        threading.Timer(0.2, lock.release).start()
+
+        cached_data, api_data = WeatherService()._fetch_on_miss(" london ", "metric")
+
+        mock_client.get_weather.assert_not_called()
+        self.assertIsNone(api_data)
+        self.assertEqual(cached_data["temperature"], 12.0)
+
+
+class TestWeatherAPIClient(TestCase):
+    def test_clients_share_pooled_session(self):
+        session = get_session()
+        adapter = session.get_adapter("https://api.openweathermap.org")
+
+        self.assertIs(WeatherAPIClient().session, session)
+        self.assertIs(WeatherAPIClient().session, session)
+        # Status retries are the client's, so each one is charged to the budget.
+        self.assertEqual(adapter.max_retries.status, 0)
+        self.assertEqual(adapter.max_retries.connect, settings.WEATHER_API_MAX_RETRIES)
+
+    @patch("weather.api_client._backoff", return_value=0)
+    @patch("weather.api_client.get_session")
+    def test_every_attempt_takes_a_budget_token(self, mock_get_session, _):
+        mock_get = mock_get_session.return_value.get
+        mock_get.side_effect = [
+            Mock(status_code=503),
+            Mock(status_code=503),
+            Mock(status_code=200, json=Mock(return_value={"name": "London"})),
+        ]
+
+        with patch.object(
+            api_client.upstream_budget, "acquire", return_value=True
+        ) as acquire:
+            data = WeatherAPIClient().get_weather("London", "metric")
+
+        self.assertEqual(data, {"name": "London"})
+        self.assertEqual(acquire.call_count, 3)
+
+    @patch("weather.api_client._backoff", return_value=0)
+    @patch("weather.api_client.get_session")
+    def test_retries_stop_when_the_budget_is_spent(self, mock_get_session, _):
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value = Mock(status_code=503)
+
+        with patch.object(
+            api_client.upstream_budget, "acquire", side_effect=[True, False]
+        ):
+            data = WeatherAPIClient().get_weather("London", "metric")
+
+        self.assertIsNone(data)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch("weather.api_client.get_session")
+    def test_latency_recorded_by_status(self, mock_get_session):
+        mock_get_session.return_value.get.return_value = Mock(status_code=404)
+        sample = "weather_upstream_request_seconds_count"
+        before = REGISTRY.get_sample_value(sample, {"outcome": "404"}) or 0
+
+        WeatherAPIClient().get_weather("Nowhere", "metric")
+
+        self.assertEqual(
+            REGISTRY.get_sample_value(sample, {"outcome": "404"}), before + 1
+        )
+
+
+class TestAsyncWeatherService(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.upstream_calls = []
+
+    def _mock_client(self):
+        async def handler(request):
+            self.upstream_calls.append(request.url.params["q"])
+            await asyncio.sleep(0.05)
+            return httpx.Response(
+                200,
+                json={
+                    "name": "London",
+                    "main": {"temp": 18.0, "humidity": 70, "pressure": 1008},
+                    "weather": [{"description": "overcast clouds"}],
+                },
+            )
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    def test_concurrent_misses_fetch_once(self):
+        async def burst():
+            with patch(
+                "weather.api_client.get_async_client", return_value=self._mock_client()
+            ):
+                return await asyncio.gather(
+                    *(
+                        AsyncWeatherService().get_weather("London", "metric")
+                        for _ in range(20)
+                    )
+                )
+
+        results = async_to_sync(burst)()
+
+        self.assertEqual(len(self.upstream_calls), 1)
+        self.assertEqual(sum(1 for r in results if not r["served_from_cache"]), 1)
+        self.assertTrue(all(r["temperature"] == 18.0 for r in results))
+        self.assertEqual(WeatherQuery.objects.count(), 20)
+
+    def test_second_request_served_from_redis(self):
+        async def twice():
+            with patch(
+                "weather.api_client.get_async_client", return_value=self._mock_client()
+            ):
+                await AsyncWeatherService().get_weather("London", "metric")
+                return await AsyncWeatherService().get_weather("London", "metric")
+
+        result = async_to_sync(twice)()
+
+        self.assertEqual(len(self.upstream_calls), 1)
+        self.assertTrue(result["served_from_cache"])
+        self.assertEqual(
+            WeatherCache._get_from_redis("london", "metric")["temperature"], 18.0
+        )
+
+    def test_async_api_view_rate_limited(self):
+        request = RequestFactory().get("/api/", {"city": "London"})
+        request.limited = True
+
+        response = async_to_sync(weather_api_async)(request)
+
+        self.assertEqual(response.status_code, 429)
+
+
+class TestWeatherBatchAPI(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_batch_fetches_only_misses(self, MockAPIClient):
+        def fake_get_weather(city, units):
+            if city == "Atlantis":
+                return None
+            return {
+                "name": city,
+                "main": {"temp": 21.0, "humidity": 40, "pressure": 1015},
+                "weather": [{"description": "clear sky"}],
+            }
+
+        MockAPIClient.return_value.get_weather.side_effect = fake_get_weather
+        WeatherCache.set_cached_weather(
+            "London",
+            "metric",
+            {
+                "city_name": "London",
+                "temperature": 12.0,
+                "weather_description": "rain",
+                "units": "metric",
+                "timestamp": timezone.now(),
+            },
+        )
+
+        response = Client().get(
+            "/api/batch/",
+            {"city": ["London", "Paris", "paris", "Atlantis"], "units": "metric"},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["city"] for r in results], ["London", "Paris", "Atlantis"])
+        self.assertTrue(results[0]["data"]["served_from_cache"])
+        self.assertFalse(results[1]["data"]["served_from_cache"])
+        self.assertIn("error", results[2])
+        called = sorted(
+            c.args[0] for c in MockAPIClient.return_value.get_weather.call_args_list
+        )
+        self.assertEqual(called, ["Atlantis", "Paris"])
+        self.assertEqual(WeatherQuery.objects.count(), 2)
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_batch_serves_recent_history_before_going_upstream(self, MockAPIClient):
+        MockAPIClient.return_value.get_weather.return_value = None
+        for city in ["Paris", "Oslo"]:
+            WeatherQuery.objects.create(
+                city_name=city,
+                temperature=15.0,
+                weather_description="clear sky",
+                units="metric",
+                timestamp=timezone.now() - timedelta(minutes=2),
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            results = WeatherService().get_weather_batch(
+                ["Paris", "oslo", "Berlin"], "metric"
+            )
+
+        self.assertEqual([r["data"]["temperature"] for r in results[:2]], [15.0, 15.0])
+        MockAPIClient.return_value.get_weather.assert_called_once_with(
+            "Berlin", "metric"
+        )
+        history_reads = [
+            q
+            for q in queries
+            if q["sql"].startswith("SELECT") and "city_key" in q["sql"]
+        ]
+        # One lookup for the whole batch, then Berlin's stale fallback.
+        self.assertEqual(len(history_reads), 2)
+        self.assertEqual(
+            WeatherCache._get_from_redis("paris", "metric")["temperature"], 15.0
+        )
+
+    def test_batch_post_requires_cities(self):
+        response = Client().post(
+            "/api/batch/",
+            data=json.dumps({"units": "metric"}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestLocalCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        WeatherCache.clear_local()
+
+    def tearDown(self):
+        WeatherCache.clear_local()
+
+    def test_lru_eviction_and_ttl(self):
+        local = LocalCache(max_entries=2, max_bytes=1024 * 1024)
+        local.set("a", 1, ttl=60)
+        local.set("b", 2, ttl=60)
+        local.get("a")
+        local.set("c", 3, ttl=60)
+        local.set("d", 4, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertEqual(local.get("a"), None)
+        self.assertEqual(local.get("c"), 3)
+        self.assertEqual(local.get("b"), None)
+        self.assertEqual(local.get("d"), None)
+
+    def test_byte_cap(self):
+        local = LocalCache(max_entries=100, max_bytes=200)
+        local.set("big", "x" * 500, ttl=60)
+        local.set("small", "y", ttl=60)
+
+        self.assertIsNone(local.get("big"))
+        self.assertEqual(local.get("small"), "y")
+
+    @override_settings(WEATHER_L1_ENABLED=True)
+    def test_hit_served_without_redis_round_trip(self):
+        data = {
+            "city_name": "London",
+            "temperature": 12.0,
+            "weather_description": "rain",
+            "units": "metric",
+            "timestamp": timezone.now(),
+        }
+        WeatherCache.set_cached_weather("London", "metric", data)
+        cache.delete(WeatherCache.make_key("London", "metric"))
+
+        with patch("weather.cache.cache.get") as redis_get:
+            self.assertEqual(WeatherCache.get_cached_weather("London", "metric"), data)
+            redis_get.assert_not_called()
+
+    @override_settings(WEATHER_L1_ENABLED=True)
+    def test_entry_does_not_outlive_freshness_window(self):
+        data = {
+            "city_name": "London",
+            "temperature": 12.0,
+            "weather_description": "rain",
+            "units": "metric",
+            "timestamp": timezone.now() - timedelta(minutes=5),
+        }
+        WeatherCache._set_to_local("London", "metric", data)
+
+        self.assertIsNone(WeatherCache._get_from_local("London", "metric"))
+
+
+class TestHistoryWriter(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_rows_written_in_batches_and_drained_on_stop(self):
+        writer = HistoryWriter(batch_size=3, flush_interval=0.05, max_queue_size=100)
+        for i in range(7):
+            writer.submit(
+                WeatherQuery(
+                    city_name=f"City{i}",
+                    temperature=10.0,
+                    weather_description="test",
+                    units="metric",
+                )
+            )
+
+        writer.stop()
+
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(WeatherQuery.objects.count(), 7)
+
+    def _failing_bulk_create(self, failures, model=WeatherQuery):
+        bulk_create = model.objects.bulk_create
+        calls = []
+
+        def flaky(objs, *args, **kwargs):
+            calls.append(len(objs))
+            if len(calls) <= failures:
+                raise OperationalError("connection reset")
+            return bulk_create(objs, *args, **kwargs)
+
+        return patch.object(model.objects, "bulk_create", flaky), calls
+
+    def _rows(self, count):
+        return [
+            WeatherQuery(
+                city_name=f"City{i}",
+                temperature=10.0,
+                weather_description="test",
+                units="metric",
+                raw_data={"name": f"City{i}"},
+            )
+            for i in range(count)
+        ]
+
+    def test_failed_flush_is_retried(self):
+        writer = HistoryWriter(
+            batch_size=10, flush_interval=60, max_queue_size=10, retry_delay=0
+        )
+        # Fails while storing the payloads, before any row is inserted.
+        patcher, calls = self._failing_bulk_create(failures=1, model=RawPayload)
+
+        with patcher:
+            writer._write(self._rows(3))
+
+        self.assertEqual(calls, [3, 3])
+        self.assertEqual(WeatherQuery.objects.count(), 3)
+        self.assertEqual(WeatherQuery.objects.first().raw_data["name"], "City0")
+
+    def test_batch_dropped_after_retry_is_counted(self):
+        writer = HistoryWriter(
+            batch_size=10, flush_interval=60, max_queue_size=10, retry_delay=0
+        )
+        sample = "weather_history_dropped_total"
+        before = REGISTRY.get_sample_value(sample) or 0
+        patcher, calls = self._failing_bulk_create(failures=2)
+
+        with patcher:
+            writer._write(self._rows(3))
+
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(WeatherQuery.objects.exists())
+        self.assertEqual(REGISTRY.get_sample_value(sample), before + 3)
+
+    @override_settings(HISTORY_WRITE_BEHIND=True)
+    @patch("weather.services.history_writer")
+    def test_cache_hit_does_not_write_to_db(self, mock_writer):
+        WeatherCache.set_cached_weather(
+            "London",
+            "metric",
+            {
+                "city_name": "London",
+                "temperature": 12.0,
+                "weather_description": "rain",
+                "units": "metric",
+                "timestamp": timezone.now(),
+            },
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            result = WeatherService().get_weather("London", "metric")
+
+        self.assertEqual(len(queries), 0)
+        self.assertTrue(result["served_from_cache"])
+        mock_writer.submit.assert_called_once()
+
+    @override_settings(HISTORY_WRITE_BEHIND=True)
+    def test_async_path_writes_through_when_queue_is_full(self):
+        writer = HistoryWriter(batch_size=10, flush_interval=60, max_queue_size=1)
+        writer._queue.put_nowait(
+            WeatherQuery(
+                city_name="Queued",
+                temperature=1.0,
+                weather_description="test",
+                units="metric",
+            )
+        )
+        row = WeatherQuery(
+            city_name="Overflow",
+            temperature=2.0,
+            weather_description="test",
+            units="metric",
+        )
+
+        with patch.object(writer, "_ensure_started"), patch(
+            "weather.services.history_writer", writer
+        ):
+            async_to_sync(AsyncWeatherService._persist)(row)
+
+        self.assertEqual(writer.pending(), 1)
+        self.assertEqual(
+            list(WeatherQuery.objects.values_list("city_name", flat=True)),
+            ["Overflow"],
+        )
+
+
+class TestHistoryFilters(TestCase):
+    def test_city_key_normalized_on_save_and_bulk_create(self):
+        WeatherQuery.objects.create(
+            city_name=" London ",
+            temperature=15.0,
+            weather_description="sunny",
+            units="metric",
+        )
+        WeatherQuery.objects.bulk_create(
+            [
+                WeatherQuery(
+                    city_name="LONDON",
+                    temperature=15.0,
+                    weather_description="sunny",
+                    units="metric",
+                )
+            ]
+        )
+
+        self.assertEqual(WeatherQuery.objects.filter(city_key="london").count(), 2)
+
+    def test_date_to_includes_whole_day(self):
+        for day, hour in ((14, 12), (15, 0), (15, 23), (16, 0)):
+            query = WeatherQuery.objects.create(
+                city_name="Test",
+                temperature=15.0,
+                weather_description="test",
+                units="metric",
+            )
+            query.timestamp = timezone.make_aware(datetime(2024, 1, day, hour))
+            query.save()
+
+        response = Client().get(
+            "/history/?city=test&date_from=2024-01-15&date_to=2024-01-15"
+        )
+
+        self.assertEqual(len(response.context["queries"]), 2)
+
+    def test_invalid_date_is_ignored(self):
+        response = Client().get("/history/?date_from=not-a-date")
+
+        self.assertEqual(response.status_code, 200)
+
+
+class TestExportCSV(TestCase):
+    def setUp(self):
+        for i in range(5):
+            WeatherQuery.objects.create(
+                city_name="London" if i % 2 else "Paris",
+                temperature=10.0 + i,
+                weather_description="test",
+                units="metric",
+                raw_data={"large": "x" * 1000},
+            )
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_streams_filtered_rows(self):
+        response = Client().get("/history/export/?city=london")
+
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            lines[0], "City,Temperature,Description,Units,Timestamp,From Cache"
+        )
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith("London,13.0,test,metric,"))
+
+    def test_gzip_export(self):
+        response = Client().get("/history/export/?gzip=1")
+
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertIn("weather_history.csv.gz", response["Content-Disposition"])
+        content = gzip.decompress(b"".join(response.streaming_content)).decode()
+        self.assertEqual(len(content.splitlines()), 6)
+
+
+class TestHistoryPagination(TestCase):
+    def setUp(self):
+        cache.clear()
+        city_facets.reset_local()
+        base = timezone.now()
+        for i in range(15):
+            WeatherQuery.objects.create(
+                city_name=f"City{i}",
+                temperature=10 + i,
+                weather_description="test",
+                units="metric",
+                # Ties on timestamp are broken by id.
+                timestamp=base - timedelta(minutes=i // 2),
+            )
+
+    def test_cursor_pages_cover_all_rows_once(self):
+        client = Client()
+        first = client.get("/history/")
+        page = first.context["page"]
+        self.assertEqual(len(page.rows), 10)
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_previous)
+
+        second = client.get(f"/history/?after={page.next_cursor}")
+        second_page = second.context["page"]
+        self.assertEqual(len(second_page.rows), 5)
+        self.assertFalse(second_page.has_next)
+        seen = {q.pk for q in page.rows} | {q.pk for q in second_page.rows}
+        self.assertEqual(len(seen), 15)
+
+        back = client.get(f"/history/?before={second_page.previous_cursor}")
+        self.assertEqual(
+            [q.pk for q in back.context["page"].rows], [q.pk for q in page.rows]
+        )
+
+    def test_count_is_cached(self):
+        Client().get("/history/")
+        WeatherQuery.objects.all().delete()
+
+        response = Client().get("/history/")
+
+        self.assertEqual(response.context["total_count"], 15)
+
+    def test_city_facets_rebuilt_then_updated_incrementally(self):
+        self.assertEqual(len(city_facets.all()), 15)
+
+        city_facets.record("Zanzibar")
+
+        self.assertIn("Zanzibar", city_facets.all())
+
+    def test_async_record_does_not_block_the_loop(self):
+        city_facets.all()
+
+        with patch.object(city_facets, "_redis", side_effect=AssertionError):
+            async_to_sync(city_facets.arecord)("Zanzibar")
+
+        self.assertIn("Zanzibar", city_facets.all())
+
+
+class TestHealthChecks(TestCase):
+    def _prober(self, **checks):
+        prober = HealthProber(
+            checks={"database": check_database, "redis": check_redis, **checks},
+            interval=60,
+        )
+        prober.probe()
+        # Results are driven by probe() here, not by the background thread.
+        prober._ensure_started = Mock()
+        return prober
+
+    def test_probe_records_results_without_writing_history(self):
+        upstream = Mock()
+        prober = self._prober(upstream=upstream)
+
+        results = prober._results
+        self.assertTrue(results["database"]["healthy"])
+        self.assertTrue(results["redis"]["healthy"])
+        self.assertTrue(results["upstream"]["healthy"])
+        self.assertGreaterEqual(results["database"]["latency_ms"], 0)
+        upstream.assert_called_once_with()
+        self.assertEqual(WeatherQuery.objects.count(), 0)
+
+    def test_readiness_reports_failed_dependency(self):
+        prober = self._prober(redis=Mock(side_effect=ConnectionError("down")))
+
+        with patch("weather.views.health_prober", prober):
+            ready = Client().get("/health/ready/")
+            live = Client().get("/health/live/")
+
+        self.assertEqual(ready.status_code, 503)
+        self.assertEqual(ready.json()["checks"]["redis"]["error"], "down")
+        self.assertEqual(live.status_code, 200)
+
+    def test_first_readiness_call_probes_critical_checks(self):
+        upstream = Mock()
+        prober = HealthProber(
+            checks={
+                "database": check_database,
+                "redis": check_redis,
+                "upstream": upstream,
+            },
+            interval=60,
+        )
+        prober._ensure_started = Mock()
+
+        with patch("weather.views.health_prober", prober):
+            response = Client().get("/health/ready/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()["checks"]), {"database", "redis"})
+        upstream.assert_not_called()
+
+    def test_first_legacy_health_call_reports_the_database(self):
+        prober = HealthProber(
+            checks={"database": check_database, "redis": check_redis}, interval=60
+        )
+        prober._ensure_started = Mock()
+
+        with patch("weather.views.health_prober", prober):
+            response = Client().get("/health/")
+
+        self.assertEqual(response.json()["database"], "healthy")
+
+    def test_redis_check_gives_up_after_the_probe_timeout(self):
+        # Accepts connections (via the backlog) but never answers.
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        self.addCleanup(server.close)
+        caches = {
+            "default": settings.CACHES["default"]
+            | {"LOCATION": f"redis://127.0.0.1:{server.getsockname()[1]}/0"}
+        }
+
+        with override_settings(CACHES=caches, HEALTH_PROBE_TIMEOUT=0.2), patch(
+            "weather.health._probe_redis", None
+        ):
+            start = time.perf_counter()
+            with self.assertRaises(RedisError):
+                check_redis()
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 1)
+
+    def test_health_serves_cached_results(self):
+        upstream = Mock()
+        prober = self._prober(upstream=upstream)
+
+        with patch("weather.views.health_prober", prober):
+            start = time.perf_counter()
+            response = Client().get("/health/")
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(response.json()["status"], "ok")
+        self.assertEqual(upstream.call_count, 1)
+        self.assertLess(elapsed, 1)
+
+
+class TestHotCityRefresher(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _api_data(self, city, units):
+        return {
+            "name": city,
+            "main": {"temp": 20.0, "humidity": 50, "pressure": 1012},
+            "weather": [{"description": "clear sky"}],
+        }
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_requests_are_ranked(self, MockAPIClient):
+        MockAPIClient.return_value.get_weather.side_effect = self._api_data
+        service = WeatherService()
+        for city in ["Paris", "paris ", "London"]:
+            service.get_weather(city, "metric")
+
+        self.assertEqual(
+            hot_keys.top(5), [("paris", "metric", 2.0), ("london", "metric", 1.0)]
+        )
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_unknown_cities_are_not_ranked(self, MockAPIClient):
+        MockAPIClient.return_value.get_weather.return_value = None
+
+        WeatherService().get_weather("asdfgh", "metric")
+        WeatherService().get_weather_batch(["qwerty", "zxcvbn"], "metric")
+
+        self.assertEqual(hot_keys.top(5), [])
+
+    @override_settings(HOT_CITIES_MAX_TRACKED=2)
+    def test_set_is_trimmed_to_the_coldest_members(self):
+        for city, hits in [("Paris", 3), ("London", 2), ("Oslo", 1), ("Rome", 1)]:
+            for _ in range(hits):
+                hot_keys.record(city, "metric")
+
+        self.assertEqual(
+            hot_keys.top(5), [("paris", "metric", 3.0), ("london", "metric", 2.0)]
+        )
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_refreshes_expiring_hot_keys_within_budget(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        mock_client.get_weather.side_effect = self._api_data
+        for city, hits in [("Paris", 3), ("London", 2), ("Oslo", 1)]:
+            for _ in range(hits):
+                hot_keys.record(city, "metric")
+        # London is fresh; Paris is about to expire; Oslo is missing.
+        WeatherCache.set_cached_weather("paris", "metric", {"city_name": "Paris"}, 30)
+        WeatherCache.set_cached_weather("london", "metric", {"city_name": "London"})
+
+        call_command("refresh_hot_cities", budget=1, refresh_ahead=60, stdout=Mock())
+
+        mock_client.get_weather.assert_called_once_with("paris", "metric")
+        self.assertGreater(WeatherCache.ttl("paris", "metric"), 60)
+        self.assertEqual(WeatherCache.ttl("oslo", "metric"), 0)
+        self.assertEqual(WeatherQuery.objects.count(), 0)
+        # Scores were decayed for the next run.
+        self.assertEqual(hot_keys.top(1), [("paris", "metric", 1.5)])
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_redis_error_on_one_key_skips_only_that_key(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        mock_client.get_weather.side_effect = self._api_data
+        hot_keys.record("Paris", "metric")
+        hot_keys.record("Paris", "metric")
+        hot_keys.record("London", "metric")
+
+        with patch.object(
+            WeatherCache, "ttl", side_effect=[RedisError("timeout"), 0]
+        ), patch.object(hot_keys, "decay", side_effect=RedisError("timeout")):
+            call_command(
+                "refresh_hot_cities", budget=5, refresh_ahead=60, stdout=Mock()
+            )
+
+        mock_client.get_weather.assert_called_once_with("london", "metric")
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_history_fallback_refreshes_the_canonical_entry(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        mock_client.get_weather.side_effect = self._api_data
+        for _ in range(3):
+            WeatherQuery.objects.create(
+                city_name="London",
+                temperature=59.0,
+                weather_description="clear sky",
+                units="imperial",
+            )
+
+        call_command("refresh_hot_cities", budget=5, refresh_ahead=60, stdout=Mock())
+
+        mock_client.get_weather.assert_called_once_with("london", "metric")
+        self.assertGreater(WeatherCache.ttl("london", "metric"), 60)
+        self.assertEqual(WeatherCache.ttl("london", "imperial"), 0)
+
+
+class TestStaleServing(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _row(self, age):
+        return WeatherQuery.objects.create(
+            city_name="London",
+            temperature=15.0,
+            weather_description="old_weather",
+            units="metric",
+            served_from_cache=False,
+            timestamp=timezone.now() - age,
+        )
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_stale_entry_served_while_refreshing(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        mock_client.get_weather.return_value = {
+            "name": "London",
+            "main": {"temp": 20.0, "humidity": 65, "pressure": 1012},
+            "weather": [{"description": "sunny"}],
+        }
+        WeatherCache.set_cached_weather(
+            "London",
+            "metric",
+            {
+                "city_name": "London",
+                "temperature": 15.0,
+                "weather_description": "old_weather",
+                "units": "metric",
+                "timestamp": timezone.now() - timedelta(minutes=10),
+            },
+        )
+
+        result = WeatherService().get_weather("London", "metric")
+
+        self.assertEqual(result["temperature"], 15.0)
+        self.assertTrue(result["stale"])
+        deadline = time.monotonic() + 5
+        while not WeatherCache.ttl("London", "metric") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        mock_client.get_weather.assert_called_once_with("London", "metric")
+        refreshed = WeatherCache.get_cached_weather("London", "metric")
+        self.assertEqual(refreshed["temperature"], 20.0)
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_stale_if_error_up_to_hard_ttl(self, MockAPIClient):
+        MockAPIClient.return_value.get_weather.return_value = None
+        row = self._row(timedelta(minutes=20))
+
+        result = WeatherService().get_weather("London", "metric")
+
+        self.assertEqual(result["temperature"], 15.0)
+        self.assertTrue(result["served_from_cache"])
+        self.assertTrue(result["stale"])
+
+        row.timestamp = timezone.now() - timedelta(hours=2)
+        row.save()
+        self.assertIsNone(WeatherService().get_weather("London", "metric"))
+
+
+class TestWeatherSerializer(TestCase):
+    entry = {
+        "city_name": "London",
+        "temperature": 12.5,
+        "weather_description": "light rain",
+        "units": "metric",
+        "timestamp": timezone.now(),
+    }
+
+    def test_weather_entry_round_trip_is_compact(self):
+        cache.set("codec_test", self.entry)
+
+        raw = cache.client.get_client().get(cache.make_key("codec_test"))
+        self.assertTrue(raw.startswith(b"W"))
+        self.assertLess(len(raw), 80)
+        self.assertEqual(cache.get("codec_test"), self.entry)
+
+    def test_other_values_and_legacy_pickles(self):
+        serializer = WeatherSerializer({})
+        for value in [{"a": 1}, "text", [1, 2], {**self.entry, "extra": True}]:
+            self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+        self.assertEqual(serializer.loads(pickle.dumps(self.entry, -1)), self.entry)
+
+    def test_compression_threshold(self):
+        entry = {**self.entry, "weather_description": "rain " * 100}
+        serializer = WeatherSerializer({"COMPRESS_MIN_BYTES": 128})
+
+        payload = serializer.dumps(entry)
+
+        self.assertTrue(payload[1] & 0x80)
+        self.assertLess(len(payload), 128)
+        self.assertEqual(serializer.loads(payload), entry)
+
+
+class TestCityIndex(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.index = CityIndex(
+            [
+                (City(2643743, "London", "GB", 51.51, -0.13), 0),
+                (City(6058560, "London", "CA", 42.98, -81.23), 0),
+                (City(2988507, "Paris", "FR", 48.85, 2.35), 0),
+                (City(2950159, "Berlin", "DE", 52.52, 13.41), 0),
+                (City(3117735, "Málaga", "ES", 36.72, -4.42), 0),
+            ],
+            fuzzy_cutoff=0.85,
+            max_aliases=100,
+        )
+        patcher = patch("weather.cities._city_index", self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_spellings_share_one_cache_key(self):
+        keys = {
+            WeatherCache.make_key(city, "metric")
+            for city in ["London", " london ", "LONDON,GB", "Lonndon"]
+        }
+        self.assertEqual(keys, {"weather_id2643743_metric"})
+        self.assertEqual(self.index.resolve("London,CA"), 6058560)
+        self.assertEqual(self.index.resolve("malaga"), 3117735)
+        self.assertIsNone(self.index.resolve("Atlantis"))
+
+    def test_fuzzy_lookups_are_memoized(self):
+        with patch.object(self.index, "_closest", wraps=self.index._closest) as closest:
+            self.index.resolve.cache_clear()
+            for _ in range(3):
+                WeatherCache.make_key("Lonndon", "metric")
+                WeatherCache.history_key("Lonndon")
+
+        self.assertEqual(closest.call_count, 1)
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_db_fallback_finds_rows_under_the_resolved_name(self, MockAPIClient):
+        MockAPIClient.return_value.get_weather.return_value = None
+        WeatherQuery.objects.create(
+            city_name="Málaga",
+            temperature=21.0,
+            weather_description="clear sky",
+            units="metric",
+            served_from_cache=False,
+            timestamp=timezone.now() - timedelta(minutes=20),
+        )
+
+        results = [
+            WeatherService().get_weather(city, "metric")
+            for city in ["malaga", "Malaga,ES", "Málaga"]
+        ]
+
+        self.assertTrue(all(result["temperature"] == 21.0 for result in results))
+        self.assertEqual(WeatherCache.history_key("Atlantis, XX"), "atlantis")
+
+    def test_load_bulk_city_list(self):
+        entries = [
+            {"id": 1, "name": "Oslo", "country": "NO", "coord": {"lat": 0, "lon": 0}},
+            {"id": 2, "name": "Osaka", "country": "JP", "coord": {"lat": 0, "lon": 0}},
+        ]
+        with tempfile.NamedTemporaryFile(suffix=".json.gz") as f:
+            with gzip.open(f.name, "wt") as out:
+                json.dump(entries, out)
+            index = CityIndex.from_file(f.name)
+
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.resolve("osaka"), 2)
+
+    def test_prefix_search(self):
+        self.assertEqual(
+            [city.id for city in self.index.search("lo")], [2643743, 6058560]
+        )
+        response = Client().get("/api/cities/?q=ber")
+        self.assertEqual(response.json()["cities"][0]["name"], "Berlin")
+
+    @patch("weather.api_client.get_session")
+    def test_upstream_queried_by_id_and_aliases_learned(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value = Mock(
+            status_code=200, json=Mock(return_value={"id": 2643743, "name": "London"})
+        )
+        client = WeatherAPIClient()
+
+        client.get_weather("london", "metric")
+        self.assertEqual(mock_get.call_args.kwargs["params"]["id"], 2643743)
+
+        client.get_weather("Londres", "metric")
+        self.assertEqual(mock_get.call_args.kwargs["params"]["q"], "Londres")
+        self.assertEqual(
+            WeatherCache.make_key("Londres", "metric"), "weather_id2643743_metric"
+        )
+
+
+class TestUnitConversion(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_conversions_match_upstream_values(self):
+        # Values OpenWeatherMap returns for the same observation.
+        for metric, imperial, standard in [
+            (15.5, 59.9, 288.65),
+            (-40.0, -40.0, 233.15),
+            (0.0, 32.0, 273.15),
+            (21.37, 70.47, 294.52),
+        ]:
+            self.assertEqual(
+                convert_temperature(metric, "metric", "imperial"), imperial
+            )
+            self.assertEqual(
+                convert_temperature(metric, "metric", "standard"), standard
+            )
+            self.assertEqual(
+                convert_temperature(imperial, "imperial", "metric"), metric
+            )
+            self.assertEqual(
+                convert_temperature(standard, "standard", "metric"), metric
+            )
+        self.assertEqual(convert_speed(5.0, "metric", "imperial"), 11.18)
+        self.assertEqual(convert_speed(11.18, "imperial", "standard"), 5.0)
+
+    def test_payload_conversion_leaves_other_fields(self):
+        payload = {
+            "name": "London",
+            "main": {"temp": 15.5, "feels_like": 14.0, "humidity": 65},
+            "wind": {"speed": 5.0},
+        }
+
+        converted = convert_payload(payload, "metric", "imperial")
+
+        self.assertEqual(
+            converted["main"], {"temp": 59.9, "feels_like": 57.2, "humidity": 65}
+        )
+        self.assertEqual(converted["wind"], {"speed": 11.18})
+        self.assertEqual(payload["main"]["temp"], 15.5)
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_one_upstream_call_serves_all_unit_systems(self, MockAPIClient):
+        mock_client = MockAPIClient.return_value
+        mock_client.get_weather.return_value = {
+            "name": "London",
+            "main": {"temp": 15.5, "humidity": 65, "pressure": 1012},
+            "weather": [{"description": "sunny"}],
+        }
+        service = WeatherService()
+
+        imperial = service.get_weather("London", "imperial")
+        metric = service.get_weather("London", "metric")
+        standard = service.get_weather("London", "standard")
+
+        mock_client.get_weather.assert_called_once_with("London", "metric")
+        self.assertEqual(imperial["temperature"], 59.9)
+        self.assertEqual(metric["temperature"], 15.5)
+        self.assertEqual(standard["temperature"], 288.65)
+        row = WeatherQuery.objects.get(served_from_cache=False)
+        self.assertEqual((row.units, row.raw_data["main"]["temp"]), ("imperial", 59.9))
+
+    @patch("weather.services.WeatherAPIClient")
+    def test_db_fallback_converts_rows_in_other_units(self, MockAPIClient):
+        WeatherQuery.objects.create(
+            city_name="London",
+            temperature=59.9,
+            weather_description="sunny",
+            units="imperial",
+            served_from_cache=False,
+        )
+
+        result = WeatherService().get_weather("London", "metric")
+
+        MockAPIClient.return_value.get_weather.assert_not_called()
+        self.assertEqual(result["temperature"], 15.5)
+
+
+class TestUpstreamGuards(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_circuit_opens_then_recovers_after_trial(self):
+        breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=0.2)
+        for _ in range(3):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state()["state"], "open")
+
+        time.sleep(0.25)
+        self.assertTrue(breaker.allow())
+        # Only one trial call while half-open.
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state(), {"state": "closed", "failures": 0})
+        self.assertTrue(breaker.allow())
+
+    def test_success_on_a_clean_circuit_writes_nothing(self):
+        breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=60)
+        self.assertTrue(breaker.allow())
+
+        with patch("weather.resilience.get_redis_connection") as redis_connection:
+            breaker.record_success()
+        redis_connection.assert_not_called()
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state(), {"state": "closed", "failures": 0})
+
+    def test_falls_back_to_process_state_without_redis(self):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+        bucket = TokenBucket("test", rate_per_minute=0.001, capacity=2)
+        with patch(
+            "weather.resilience.get_redis_connection",
+            side_effect=ConnectionError("down"),
+        ):
+            breaker.record_failure()
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+            self.assertEqual([bucket.acquire() for _ in range(3)], [True, True, False])
+
+    def test_token_bucket_is_shared(self):
+        first = TokenBucket("test", rate_per_minute=0.001, capacity=3)
+        second = TokenBucket("test", rate_per_minute=0.001, capacity=3)
+
+        granted = [first.acquire(), second.acquire(), first.acquire(), second.acquire()]
+
+        self.assertEqual(granted, [True, True, True, False])
+        self.assertLess(first.tokens(), 1)
+
+    @patch("weather.api_client.get_session")
+    def test_client_fails_fast_when_circuit_open(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
+        mock_get.side_effect = requests.ConnectionError("timed out")
+        client = WeatherAPIClient()
+
+        for _ in range(settings.UPSTREAM_CIRCUIT_FAILURE_THRESHOLD + 3):
+            self.assertIsNone(client.get_weather("London", "metric"))
+
+        self.assertEqual(
+            mock_get.call_count, settings.UPSTREAM_CIRCUIT_FAILURE_THRESHOLD
+        )
+
+
+class TestMetricsEndpoint(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_exposes_view_and_db_write_metrics(self):
+        WeatherService._persist(
+            WeatherQuery(
+                city_name="London",
+                temperature=15.0,
+                weather_description="sunny",
+                units="metric",
+            )
+        )
+        Client().get("/health/live/")
+
+        response = Client().get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn(
+            'weather_http_request_seconds_count{method="GET",status="200",'
+            'view="weather:health_live"}',
+            body,
+        )
+        self.assertIn('weather_db_writes_total{mode="save"}', body)
+
+    def test_counts_rate_limited_requests(self):
+        def limited_view(request):
+            request.limited = True
+            return JsonResponse({}, status=429)
+
+        before = (
+            REGISTRY.get_sample_value(
+                "weather_ratelimited_total", {"view": "unmatched"}
+            )
+            or 0
+        )
+
+        MetricsMiddleware(limited_view)(RequestFactory().get("/api/"))
+
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "weather_ratelimited_total", {"view": "unmatched"}
+            ),
+            before + 1,
+        )
+
+    def test_multiprocess_registry(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            with patch.dict("os.environ", {"PROMETHEUS_MULTIPROC_DIR": metrics_dir}):
+                response = Client().get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+
+
+class TestStructuredLogging(TestCase):
+    def test_request_id_is_echoed_or_generated(self):
+        response = Client().get("/health/live/", HTTP_X_REQUEST_ID="abc-123")
+        self.assertEqual(response["X-Request-ID"], "abc-123")
+
+        response = Client().get("/health/live/", HTTP_X_REQUEST_ID="bad id\n")
+        self.assertNotEqual(response["X-Request-ID"], "bad id\n")
+        self.assertEqual(len(response["X-Request-ID"]), 32)
+
+    def test_request_lines_carry_request_id(self):
+        with self.assertLogs("weather", "INFO") as logs:
+            Client().get("/api/", HTTP_X_REQUEST_ID="req-1")
+
+        self.assertTrue(logs.records)
+        self.assertEqual({r.request_id for r in logs.records}, {"req-1"})
+
+    def test_worker_threads_inherit_request_id(self):
+        seen = []
+        token = log.request_id.set("req-2")
+        try:
+            job = log.in_request_context(lambda: seen.append(log.request_id.get()))
+        finally:
+            log.request_id.reset(token)
+        thread = threading.Thread(target=job)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(seen, ["req-2"])
+
+    @override_settings(LOG_SAMPLE_RATE=0)
+    def test_unsampled_requests_keep_only_warnings(self):
+        with self.assertNoLogs("weather", "INFO"):
+            Client().get("/api/")
+
+        with self.assertLogs("weather", "WARNING"):
+            token = log.sampled.set(False)
+            try:
+                logging.getLogger("weather").warning("still_logged")
+            finally:
+                log.sampled.reset(token)
+
+    def test_sampling_is_stable_per_request_id(self):
+        decisions = {log.should_sample(f"req-{i}", 0.25) for i in range(5)}
+        self.assertEqual(
+            decisions, {log.should_sample(f"req-{i}", 0.25) for i in range(5)}
+        )
+        kept = sum(log.should_sample(f"req-{i}", 0.25) for i in range(4000))
+        self.assertAlmostEqual(kept / 4000, 0.25, delta=0.05)
+
+    def test_json_formatter(self):
+        record = logging.LogRecord(
+            "weather", logging.INFO, __file__, 1, "cache_hit city=%s", ("Paris",), None
+        )
+        record.request_id = "req-3"
+
+        entry = json.loads(log.JsonFormatter().format(record))
+
+        self.assertEqual(entry["event"], "cache_hit")
+        self.assertEqual(entry["message"], "cache_hit city=Paris")
+        self.assertEqual(entry["request_id"], "req-3")
+        self.assertEqual(entry["level"], "INFO")
+
+    def test_handlers_sit_behind_the_queue(self):
+        handlers = logging.getLogger("weather").handlers
+        queued = [h for h in handlers if isinstance(h, log.LocalQueueHandler)]
+
+        self.assertEqual(len(queued), 1)
+        self.assertFalse(
+            any(type(h) is logging.StreamHandler for h in handlers),
+            "console handler should only be reached through the queue",
+        )
+
+
+class TestRateLimiting(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.service = patch("weather.views.WeatherService").start()
+        self.service.return_value.get_weather.return_value = {"city": "London"}
+        self.addCleanup(patch.stopall)
+
+    def test_gcra_allows_burst_then_rejects(self):
+        rate = Rate(3, 60)
+        decisions = [rate_limiter.hit("test", rate) for _ in range(4)]
+
+        self.assertEqual([d.allowed for d in decisions], [True, True, True, False])
+        self.assertEqual([d.remaining for d in decisions[:3]], [2, 1, 0])
+        self.assertAlmostEqual(decisions[3].retry_after, 20, delta=1)
+
+    def test_async_hit_shares_the_bucket(self):
+        rate = Rate(1, 60)
+        self.assertTrue(rate_limiter.hit("shared", rate).allowed)
+
+        decision = async_to_sync(rate_limiter.ahit)("shared", rate)
+
+        self.assertFalse(decision.allowed)
+
+    @override_settings(RATE_LIMIT_REQUESTS=2)
+    def test_middleware_rejects_over_limit(self):
+        client = Client()
+        responses = [client.get("/api/", {"city": "London"}) for _ in range(3)]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429])
+        self.assertEqual(responses[0]["X-RateLimit-Limit"], "2")
+        self.assertEqual(responses[1]["X-RateLimit-Remaining"], "0")
+        self.assertIn("Retry-After", responses[2])
+        self.assertIn("2 requests per 60 seconds", responses[2].json()["message"])
+        self.assertEqual(self.service.return_value.get_weather.call_count, 2)
+
+    @override_settings(RATE_LIMIT_REQUESTS=2)
+    def test_rotating_forwarded_for_is_still_limited(self):
+        client = Client()
+        responses = [
+            client.get("/api/", {"city": "London"}, HTTP_X_FORWARDED_FOR=f"10.0.0.{i}")
+            for i in range(5)
+        ]
+
+        self.assertEqual([r.status_code for r in responses], [200, 200, 429, 429, 429])
+
+    @override_settings(RATE_LIMIT_REQUESTS=1, TRUSTED_PROXY_COUNT=1)
+    def test_trusted_proxy_entry_identifies_the_client(self):
+        client = Client()
+        first = client.get(
+            "/api/", {"city": "London"}, HTTP_X_FORWARDED_FOR="1.1.1.1, 10.0.0.1"
+        )
+        spoofed = client.get(
+            "/api/", {"city": "London"}, HTTP_X_FORWARDED_FOR="2.2.2.2, 10.0.0.1"
+        )
+        other = client.get("/api/", {"city": "London"}, HTTP_X_FORWARDED_FOR="10.0.0.2")
+
+        self.assertEqual(
+            [r.status_code for r in (first, spoofed, other)], [200, 429, 200]
+        )
+
+    @override_settings(RATE_LIMIT_REQUESTS=1)
+    def test_unlisted_methods_and_views_are_not_limited(self):
+        client = Client()
+        for _ in range(3):
+            self.assertEqual(client.get("/").status_code, 200)
+            response = client.get("/health/live/")
+            self.assertNotIn("X-RateLimit-Limit", response)
+
+    @override_settings(
+        RATE_LIMIT_REQUESTS=1,
+        RATE_LIMIT_ENDPOINTS={"weather:api": "3/60"},
+        RATE_LIMIT_TIERS={"pro": "10/60"},
+        RATE_LIMIT_API_KEYS={"secret": "pro"},
+    )
+    def test_endpoint_and_api_key_tiers(self):
+        client = Client()
+        anonymous = client.get("/api/", {"city": "London"})
+        keyed = client.get("/api/", {"city": "London"}, HTTP_X_API_KEY="secret")
+        unknown = client.get("/api/", {"city": "London"}, HTTP_X_API_KEY="nope")
+
+        self.assertEqual(anonymous["X-RateLimit-Limit"], "3")
+        self.assertEqual(keyed["X-RateLimit-Limit"], "10")
+        self.assertEqual(keyed["X-RateLimit-Remaining"], "9")
+        self.assertEqual(unknown["X-RateLimit-Remaining"], "1")
+
+    def test_falls_back_to_local_limits_without_redis(self):
+        limiter = RateLimiter()
+        rate = Rate(2, 60)
+        with patch(
+            "weather.ratelimit.get_redis_connection",
+            side_effect=ConnectionError("down"),
+        ):
+            allowed = [limiter.hit("offline", rate).allowed for _ in range(3)]
+
+        self.assertEqual(allowed, [True, True, False])
+
+
+class TestNegativeCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        unknown_cities.clear_local()
+
+    def _upstream(self, status_code):
+        patcher = patch("weather.api_client.get_session")
+        self.addCleanup(patcher.stop)
+        mock_get = patcher.start().return_value.get
+        mock_get.return_value = Mock(status_code=status_code)
+        return mock_get
+
+    def test_not_found_is_cached(self):
+        mock_get = self._upstream(404)
+
+        self.assertIsNone(WeatherService().get_weather("Atlantys", "metric"))
+        self.assertIsNone(WeatherService().get_weather(" atlantys ", "imperial"))
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertTrue(WeatherCache.is_not_found("ATLANTYS"))
+
+    @patch("weather.api_client._backoff", return_value=0)
+    def test_transient_errors_are_not_cached(self, _):
+        mock_get = self._upstream(503)
+
+        WeatherService().get_weather("Atlantys", "metric")
+        WeatherService().get_weather("Atlantys", "metric")
+
+        # Both requests went upstream, each with its retries.
+        self.assertEqual(
+            mock_get.call_count, 2 * (settings.WEATHER_API_MAX_RETRIES + 1)
+        )
+        self.assertFalse(WeatherCache.is_not_found("Atlantys"))
+
+    def test_bloom_false_positive_falls_through(self):
+        WeatherCache.set_not_found("Atlantys")
+        cache.clear()
+
+        self.assertFalse(WeatherCache.is_not_found("Atlantys"))
+
+    def test_batch_skips_unknown_cities(self):
+        WeatherCache.set_not_found("Atlantys")
+        with patch.object(WeatherService, "_resolve_miss_in_thread") as resolve:
+            resolve.return_value = (None, None)
+            results = WeatherService().get_weather_batch(
+                ["Atlantys", "Paris"], "metric"
+            )
+
+        resolve.assert_called_once_with("Paris", "metric")
+        self.assertIn("error", results[0])
+
+    def test_async_service_uses_negative_cache(self):
+        WeatherCache.set_not_found("Atlantys")
+        with patch("weather.services.AsyncWeatherAPIClient") as client:
+            result = async_to_sync(AsyncWeatherService().get_weather)(
+                "Atlantys", "metric"
+            )
+
+        self.assertIsNone(result)
+        client.return_value.get_weather.assert_not_called()
+
+    def test_bloom_filter_is_shared_and_accurate(self):
+        key = cache.make_key("test_bloom")
+        writer = BloomFilter(key, 1000, 0.01, refresh_interval=0, ttl=60)
+        reader = BloomFilter(key, 1000, 0.01, refresh_interval=0, ttl=60)
+        redis_client = get_redis_connection("default")
+        for i in range(1000):
+            writer.add(redis_client, f"bad-{i}")
+
+        self.assertTrue(reader.contains(redis_client, "bad-7"))
+        false_positives = sum(
+            reader.contains(redis_client, f"good-{i}") for i in range(5000)
+        )
+        self.assertLess(false_positives / 5000, 0.03)
+        self.assertGreater(redis_client.pttl(key), 0)
+
+
+class TestUpstreamBatching(TestCase):
+    CITIES = {"Paris": 2988507, "Berlin": 2950159, "Madrid": 3117735}
+
+    def setUp(self):
+        cache.clear()
+        index = CityIndex(
+            [(City(i, name, "EU", 0, 0), 0) for name, i in self.CITIES.items()],
+            fuzzy_cutoff=0.85,
+            max_aliases=100,
+        )
+        self.server = start_fake_server(latency=0.05)
+        self.addCleanup(self.server.shutdown)
+        for patcher in (
+            patch("weather.cities._city_index", index),
+            patch.object(api_client._group_batcher, "window", 0.1),
+            override_settings(
+                UPSTREAM_BATCH_WINDOW=0.1,
+                WEATHER_API_BASE_URL=self.server.base_url,
+                WEATHER_API_GROUP_URL=self.server.group_url,
+            ),
+        ):
+            patcher.enable() if hasattr(patcher, "enable") else patcher.start()
+            self.addCleanup(
+                patcher.disable if hasattr(patcher, "disable") else patcher.stop
+            )
+
+    def test_concurrent_misses_share_one_group_call(self):
+        results = {}
+
+        def fetch(city):
+            results[city] = WeatherAPIClient().get_weather(city, "metric")
+
+        threads = [
+            threading.Thread(target=fetch, args=(city,))
+            for city in [*self.CITIES, "Paris"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.calls, 1)
+        self.assertEqual(
+            {city: data["id"] for city, data in results.items()}, self.CITIES
+        )
+
+    def test_unknown_names_still_use_single_calls(self):
+        data = WeatherAPIClient().get_weather("Springfield", "metric")
+
+        self.assertEqual(data["name"], "Springfield")
+        self.assertEqual(self.server.calls, 1)
+
+    def test_async_misses_share_one_group_call(self):
+        async def fetch_all():
+            client = AsyncWeatherAPIClient()
+            return await asyncio.gather(
+                *(client.get_weather(city, "metric") for city in self.CITIES)
+            )
+
+        results = async_to_sync(fetch_all)()
+
+        self.assertEqual(self.server.calls, 1)
+        self.assertEqual([data["id"] for data in results], list(self.CITIES.values()))
+
+    def test_batches_split_at_max_size(self):
+        calls = []
+
+        def fetch_group(city_ids, units):
+            calls.append(sorted(city_ids))
+            return {city_id: {"id": city_id} for city_id in city_ids}
+
+        batcher = GroupBatcher(fetch_group, window=0.05, max_size=2)
+        futures = [batcher.submit(city_id, "metric") for city_id in (1, 2, 3, 1)]
+
+        self.assertEqual([f.result(1)["id"] for f in futures], [1, 2, 3, 1])
+        self.assertEqual(sorted(calls), [[1, 2], [3]])
+
+
+class TestHistoryRetention(TestCase):
+    def setUp(self):
+        self.now = (timezone.now() - timedelta(hours=3)).replace(
+            minute=30, second=0, microsecond=0
+        )
+        self.hour = self.now.replace(minute=0)
+        rows = [
+            ("Paris", 10.0, False, self.now),
+            ("paris ", 14.0, True, self.now + timedelta(minutes=5)),
+            ("Paris", 20.0, True, self.now - timedelta(hours=1)),
+            ("Berlin", 5.0, False, self.now - timedelta(days=40)),
+        ]
+        WeatherQuery.objects.bulk_create(
+            WeatherQuery(
+                city_name=city,
+                temperature=temperature,
+                weather_description="clear sky",
+                units="metric",
+                served_from_cache=served_from_cache,
+                timestamp=timestamp,
+                raw_data={"name": city},
+            )
+            for city, temperature, served_from_cache, timestamp in rows
+        )
+
+    def create(self, timestamp, temperature=-2.0):
+        return WeatherQuery.objects.create(
+            city_name="Paris",
+            temperature=temperature,
+            weather_description="snow",
+            units="metric",
+            timestamp=timestamp,
+        )
+
+    def test_rollup_aggregates_per_city_and_hour(self):
+        call_command("rollup_history", stdout=Mock())
+
+        rollup = HourlyRollup.objects.get(city_key="paris", hour=self.hour)
+        self.assertEqual(rollup.requests, 2)
+        self.assertEqual(rollup.cache_hit_ratio, 0.5)
+        self.assertEqual(
+            (rollup.temperature_min, rollup.temperature_max, rollup.temperature_avg),
+            (10.0, 14.0, 12.0),
+        )
+        self.assertEqual(HourlyRollup.objects.count(), 3)
+
+    def test_open_hours_wait_for_the_lag(self):
+        self.create(timezone.now())
+        call_command("rollup_history", stdout=Mock())
+        self.assertEqual(HourlyRollup.objects.filter(requests__gt=0).count(), 3)
+
+        with override_settings(HISTORY_ROLLUP_LAG=-7200):
+            call_command("rollup_history", stdout=Mock())
+
+        self.assertEqual(HourlyRollup.objects.count(), 4)
+        self.assertEqual(
+            RollupCheckpoint.objects.get().rolled_up_to,
+            (timezone.now() + timedelta(hours=2)).replace(
+                minute=0, second=0, microsecond=0
+            ),
+        )
+
+    def test_rows_written_out_of_order_land_in_their_hour(self):
+        # Write-behind: an older row gets a higher id than a newer one.
+        self.create(self.now + timedelta(hours=1))
+        self.create(self.now + timedelta(minutes=10))
+
+        call_command("rollup_history", stdout=Mock())
+        call_command("rollup_history", stdout=Mock())
+
+        rollup = HourlyRollup.objects.get(city_key="paris", hour=self.hour)
+        self.assertEqual((rollup.requests, rollup.temperature_min), (3, -2.0))
+        later = self.hour + timedelta(hours=1)
+        self.assertEqual(
+            HourlyRollup.objects.get(city_key="paris", hour=later).requests, 1
+        )
+
+    def test_prune_keeps_rows_of_open_hours(self):
+        recent = self.create(timezone.now())
+
+        call_command("prune_history", "--delete", days=0, stdout=Mock())
+
+        self.assertEqual(
+            list(WeatherQuery.objects.values_list("pk", flat=True)), [recent.pk]
+        )
+
+    def test_prune_archives_old_rows_in_batches(self):
+        call_command("prune_history", days=30, batch_size=1, pause=0, stdout=Mock())
+
+        self.assertFalse(WeatherQuery.objects.filter(city_key="berlin").exists())
+        archived = ArchivedWeatherQuery.objects.get()
+        self.assertEqual(
+            (archived.city_name, archived.raw_data), ("Berlin", {"name": "Berlin"})
+        )
+        self.assertEqual(WeatherQuery.objects.count(), 3)
+        self.assertEqual(HourlyRollup.objects.get(city_key="berlin").requests, 1)
+
+    @override_settings(RAW_PAYLOAD_GRACE_PERIOD=0)
+    def test_archived_rows_dropped_after_archive_retention(self):
+        call_command("prune_history", days=30, archive_days=0, stdout=Mock())
+        self.assertEqual(ArchivedWeatherQuery.objects.count(), 1)
+
+        call_command("prune_history", days=30, archive_days=35, stdout=Mock())
+
+        self.assertFalse(ArchivedWeatherQuery.objects.exists())
+        self.assertFalse(
+            RawPayload.objects.exclude(
+                pk__in=WeatherQuery.objects.values("payload_id")
+            ).exists()
+        )
+        self.assertEqual(HourlyRollup.objects.get(city_key="berlin").requests, 1)
+
+    def test_prune_delete_skips_rows_not_rolled_up(self):
+        with patch("weather.management.commands.prune_history.roll_up"):
+            call_command("prune_history", "--delete", days=30, stdout=Mock())
+        self.assertEqual(WeatherQuery.objects.count(), 4)
+
+        call_command("prune_history", "--delete", days=30, stdout=Mock())
+        self.assertEqual(WeatherQuery.objects.count(), 3)
+        self.assertFalse(ArchivedWeatherQuery.objects.exists())
+
+
+class TestRawPayloads(TestCase):
+    PAYLOAD = {"name": "Paris", "main": {"temp": 12.5}, "filler": "x" * 2000}
+
+    def create(self, raw_data, **kwargs):
+        return WeatherQuery.objects.create(
+            city_name="Paris",
+            temperature=12.5,
+            weather_description="clear sky",
+            units="metric",
+            raw_data=raw_data,
+            **kwargs,
+        )
+
+    def test_identical_payloads_are_stored_once_compressed(self):
+        self.create(self.PAYLOAD)
+        self.create(dict(reversed(self.PAYLOAD.items())))
+        WeatherQuery.objects.bulk_create(
+            [
+                WeatherQuery(
+                    city_name="Paris",
+                    temperature=12.5,
+                    weather_description="clear sky",
+                    units="metric",
+                    raw_data=self.PAYLOAD,
+                )
+            ]
+        )
+
+        payload = RawPayload.objects.get()
+        self.assertLess(len(payload.data), len(json.dumps(self.PAYLOAD)) / 10)
+        self.assertEqual(
+            set(WeatherQuery.objects.values_list("payload", flat=True)),
+            {payload.digest},
+        )
+        self.assertEqual(WeatherQuery.objects.first().raw_data, self.PAYLOAD)
+
+    def test_rows_without_payload(self):
+        row = self.create({})
+
+        self.assertIsNone(row.payload_id)
+        self.assertEqual(WeatherQuery.objects.get(pk=row.pk).raw_data, {})
+
+    def test_history_and_export_never_read_payloads(self):
+        self.create(self.PAYLOAD)
+
+        with CaptureQueriesContext(connection) as queries:
+            Client().get("/history/")
+            b"".join(Client().get("/history/export/").streaming_content)
+
+        self.assertFalse(
+            [q["sql"] for q in queries if RawPayload._meta.db_table in q["sql"]]
+        )
+
+    @override_settings(RAW_PAYLOAD_GRACE_PERIOD=0)
+    def test_deleting_old_rows_drops_unused_payloads(self):
+        old = timezone.now() - timedelta(days=60)
+        self.create({"name": "old"}, timestamp=old)
+        self.create(self.PAYLOAD, timestamp=old)
+        self.create(self.PAYLOAD)
+
+        call_command("prune_history", "--delete", days=30, stdout=Mock())
+
+        self.assertEqual(
+            list(RawPayload.objects.values_list("digest", flat=True)),
+            [WeatherQuery.objects.get().payload_id],
+        )
+
+    def test_unreferenced_check_and_delete_are_one_query(self):
+        used = self.create(self.PAYLOAD).payload_id
+        unused = self.create({"name": "gone"})
+        unused.delete()
+        RawPayload.objects.update(last_used_at=timezone.now() - timedelta(hours=2))
+
+        with self.assertNumQueries(1):
+            deleted = RawPayload.delete_unreferenced(
+                [used, unused.payload_id], timedelta(hours=1)
+            )
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(list(RawPayload.objects.values_list("pk", flat=True)), [used])
+
+    def test_recently_used_payloads_are_kept(self):
+        row = self.create({"name": "fresh"})
+        row.delete()
+
+        deleted = RawPayload.delete_unreferenced([row.payload_id], timedelta(hours=1))
+
+        self.assertEqual(deleted, 0)
+        self.assertTrue(RawPayload.objects.filter(pk=row.payload_id).exists())
+
+
+class TestStatsAPI(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.hour = timezone.make_aware(datetime(2024, 1, 15, 10))
+        rows = [
+            (10.0, "metric", True, 0),
+            (68.0, "imperial", False, 10),
+            (303.15, "standard", True, 20),
+            (40.0, "metric", True, 30),
+            (-5.0, "metric", False, 70),
+        ]
+        WeatherQuery.objects.bulk_create(
+            WeatherQuery(
+                city_name="Paris",
+                temperature=temperature,
+                weather_description="clear sky",
+                units=units,
+                served_from_cache=served_from_cache,
+                timestamp=self.hour + timedelta(minutes=minutes),
+            )
+            for temperature, units, served_from_cache, minutes in rows
+        )
+
+    def get(self, **params):
+        return Client().get(
+            "/api/stats/",
+            {"city": "paris", "date_from": "2024-01-15", "date_to": "2024-01-15"}
+            | params,
+        )
+
+    def test_hourly_buckets_in_celsius(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        first, second = response.json()["buckets"]
+        self.assertEqual(first["start"], self.hour.isoformat())
+        self.assertEqual((first["requests"], first["cache_hit_ratio"]), (4, 0.75))
+        self.assertEqual(
+            first["temperature"],
+            {
+                "min": 10.0,
+                "max": 40.0,
+                "mean": 25.0,
+                "p50": 25.0,
+                "p90": 37.0,
+                "p95": 38.5,
+                "p99": 39.7,
+            },
+        )
+        self.assertEqual(second["temperature"]["p99"], -5.0)
+        self.assertFalse(first["from_rollups"])
+
+    def test_daily_buckets_converted_to_requested_units(self):
+        response = self.get(bucket="day", units="imperial")
+
+        (bucket,) = response.json()["buckets"]
+        self.assertEqual(bucket["requests"], 5)
+        self.assertEqual(bucket["temperature"]["min"], 23.0)
+        self.assertEqual(bucket["temperature"]["p50"], 68.0)
+
+    def test_results_are_cached(self):
+        self.get()
+
+        with self.assertNumQueries(0):
+            response = self.get()
+        self.assertEqual(len(response.json()["buckets"]), 2)
+
+    def test_country_suffix_finds_the_history(self):
+        response = self.get(city="Paris,FR")
+
+        self.assertEqual(
+            [bucket["requests"] for bucket in response.json()["buckets"]], [4, 1]
+        )
+
+    def test_pruned_hours_come_from_rollups(self):
+        call_command("rollup_history", stdout=Mock())
+        call_command("prune_history", "--delete", days=30, stdout=Mock())
+        self.assertFalse(WeatherQuery.objects.exists())
+
+        first, second = self.get().json()["buckets"]
+
+        self.assertEqual((first["requests"], first["cache_hit_ratio"]), (4, 0.75))
+        self.assertTrue(first["from_rollups"])
+        self.assertEqual(
+            first["temperature"],
+            {
+                "min": 10.0,
+                "max": 40.0,
+                "mean": 25.0,
+                "p50": None,
+                "p90": None,
+                "p95": None,
+                "p99": None,
+            },
+        )
+        self.assertEqual(second["temperature"]["max"], -5.0)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.get(city="").status_code, 400)
+        self.assertEqual(self.get(bucket="week").status_code, 400)
+        self.assertEqual(self.get(date_from="2024-01-16").status_code, 400)
+        with override_settings(STATS_MAX_BUCKETS=24):
+            self.assertEqual(self.get(date_from="2024-01-14").status_code, 400)
+
+    def test_bucket_percentiles_match_numpy(self):
+        rng = np.random.default_rng(0)
+        counts = [1, 2, 7, 50]
+        values = rng.normal(size=sum(counts))
+
+        result = bucket_percentiles(values, counts)
+
+        expected = [
+            np.percentile(segment, PERCENTILES)
+            for segment in np.split(values, np.cumsum(counts)[:-1])
+        ]
+        np.testing.assert_allclose(result, expected)
@@ -0,0 +1,61 @@
+import copy
+
+# Weather is fetched and cached once, in metric, and converted per request.
+# OpenWeatherMap treats any other ``units`` value as standard (Kelvin).
+CANONICAL_UNITS = "metric"
+UNIT_SYSTEMS = ("metric", "imperial", "standard")
+
+MPS_TO_MPH = 3600 / 1609.344
+
+TEMPERATURE_FIELDS = ("temp", "feels_like", "temp_min", "temp_max")
+SPEED_FIELDS = ("speed", "gust")
+
+
+def _system(units: str):
+    return units if units in UNIT_SYSTEMS else "standard"
+
+
+def convert_temperature(value, from_units: str, to_units: str):
+    from_units, to_units = _system(from_units), _system(to_units)
+    if value is None or from_units == to_units:
+        return value
+    if from_units == "imperial":
+        celsius = (value - 32) * 5 / 9
+    elif from_units == "standard":
+        celsius = value - 273.15
+    else:
+        celsius = value
+    if to_units == "imperial":
+        converted = celsius * 9 / 5 + 32
+    elif to_units == "standard":
+        converted = celsius + 273.15
+    else:
+        converted = celsius
+    # OpenWeatherMap reports two decimals.
+    return round(converted, 2)
+
+
+def convert_speed(value, from_units: str, to_units: str):
+    # metric and standard both use m/s; imperial uses mph.
+    from_imperial = _system(from_units) == "imperial"
+    to_imperial = _system(to_units) == "imperial"
+    if value is None or from_imperial == to_imperial:
+        return value
+    factor = MPS_TO_MPH if to_imperial else 1 / MPS_TO_MPH
+    return round(value * factor, 2)
+
+
+def convert_payload(api_data: dict, from_units: str, to_units: str):
+    """Return a copy of an OpenWeatherMap current-weather payload in ``to_units``."""
+    if _system(from_units) == _system(to_units):
+        return api_data
+    converted = copy.deepcopy(api_data)
+    main = converted.get("main") or {}
+    for field in TEMPERATURE_FIELDS:
+        if field in main:
+            main[field] = convert_temperature(main[field], from_units, to_units)
+    wind = converted.get("wind") or {}
+    for field in SPEED_FIELDS:
+        if field in wind:
+            wind[field] = convert_speed(wind[field], from_units, to_units)
+    return converted
@@ -1,12 +1,24 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+if settings.WEATHER_ASYNC_VIEWS:
+    query_view, api_view = views.weather_query_async, views.weather_api_async
+else:
+    query_view, api_view = views.weather_query, views.weather_api
+
 app_name = "weather"
 urlpatterns = [
-    path("", views.weather_query, name="query"),
-    path("api/", views.weather_api, name="api"),
+    path("", query_view, name="query"),
+    path("api/", api_view, name="api"),
+    path("api/batch/", views.weather_batch_api, name="api_batch"),
+    path("api/cities/", views.city_search, name="api_cities"),
+    path("api/stats/", views.weather_stats, name="api_stats"),
     path("history/", views.query_history, name="history"),
     path("history/export/", views.export_csv, name="export"),
     path("health/", views.health_check, name="health"),
+    path("health/live/", views.liveness, name="health_live"),
+    path("health/ready/", views.readiness_check, name="health_ready"),
+    path("metrics", views.metrics, name="metrics"),
 ]
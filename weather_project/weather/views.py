@@ -1,31 +1,63 @@
 import csv
+import io
+import json
 import logging
-import time
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
 
-from django.core.paginator import Paginator
-from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from django_ratelimit.decorators import ratelimit
-
-from .models import WeatherQuery
-from .services import WeatherService
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.views.decorators.csrf import csrf_exempt
+
+from .cities import get_city_index
+from .health import CRITICAL_CHECKS, health_prober, readiness
+from .history import HistoryPage, approximate_count, city_facets, keyset_page
+from .metrics import render_metrics
+from .models import WeatherQuery, normalize_city
+from .services import AsyncWeatherService, WeatherService
+from .stats import BUCKETS, city_stats
 
 logger = logging.getLogger("weather")
 
+HISTORY_PAGE_SIZE = 10
+
 
 def get_client_ip(request):
+    # X-Forwarded-For is set by the client as much as by proxies; only the
+    # entry added by the outermost of TRUSTED_PROXY_COUNT proxies is used.
+    remote_addr = request.META.get("REMOTE_ADDR", "unknown")
+    proxies = settings.TRUSTED_PROXY_COUNT
     x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(",")[0].strip()
-    else:
-        ip = request.META.get("REMOTE_ADDR", "unknown")
-    return ip
+    if not proxies or not x_forwarded_for:
+        return remote_addr
+    addresses = [address.strip() for address in x_forwarded_for.split(",")]
+    if len(addresses) < proxies:
+        return remote_addr
+    return addresses[-proxies] or remote_addr
+
+
+def _rate_limit_exceeded(request):
+    # RateLimitMiddleware sets request.limited and the rate that applied.
+    rate = getattr(request, "rate_limit", None)
+    return JsonResponse(
+        {
+            "error": "Rate limit exceeded",
+            "message": (
+                f"Maximum {rate.requests} requests per {rate.window} seconds"
+                if rate
+                else "Too many requests"
+            ),
+        },
+        status=429,
+    )
 
 
-@ratelimit(key="ip", rate="30/m", method="POST")
 def weather_query(request):
-    logger.info(f"request_start method={request.method} path={request.path} ")
+    logger.info("request_start method=%s path=%s", request.method, request.path)
     if getattr(request, "limited", False):
         return render(
             request,
@@ -49,21 +81,137 @@ def weather_query(request):
             return render(
                 request, "weather/query.html", {"error": "City not found or API error"}
             )
-    logger.info(f"request_end method={request.method} path={request.path} ")
+    logger.info("request_end method=%s path=%s", request.method, request.path)
     return render(request, "weather/query.html")
 
 
-@ratelimit(key="ip", rate="30/m", method="GET")
 def weather_api(request):
-    logger.info(f"request_start method={request.method} path={request.path} ")
+    logger.info("request_start method=%s path=%s", request.method, request.path)
     if getattr(request, "limited", False):
+        return _rate_limit_exceeded(request)
+
+    if request.method == "GET":
+        city = request.GET.get("city")
+        units = request.GET.get("units", "metric")
+
+        if not city:
+            return JsonResponse(
+                {
+                    "error": "Missing city parameter",
+                }
+            )
+        ip_address = get_client_ip(request)
+        weather_data = WeatherService().get_weather(city, units, ip_address)
+
+        if weather_data:
+            return JsonResponse(weather_data)
+        else:
+            return JsonResponse({"error": "City not found or API error"}, status=404)
+    logger.info("request_end method=%s path=%s", request.method, request.path)
+    return JsonResponse({"error": "Method not allowed"}, status=405)
+
+
+def city_search(request):
+    prefix = request.GET.get("q", "")
+    cities = get_city_index().search(prefix, limit=10)
+    return JsonResponse(
+        {
+            "cities": [
+                {
+                    "id": city.id,
+                    "name": city.name,
+                    "country": city.country,
+                    "lat": city.lat,
+                    "lon": city.lon,
+                }
+                for city in cities
+            ]
+        }
+    )
+
+
+def _parse_batch_request(request):
+    if request.method == "POST":
+        try:
+            payload = json.loads(request.body or b"{}")
+        except ValueError:
+            return None, None, "Invalid JSON body"
+        if not isinstance(payload, dict) or not isinstance(
+            payload.get("cities", []), list
+        ):
+            return None, None, "Expected a JSON object with a 'cities' list"
+        cities = payload.get("cities", [])
+        units = payload.get("units", "metric")
+    else:
+        cities = request.GET.getlist("city")
+        units = request.GET.get("units", "metric")
+
+    unique_cities = {}
+    for city in cities:
+        if isinstance(city, str) and city.strip():
+            unique_cities.setdefault(city.strip().lower(), city.strip())
+    return list(unique_cities.values()), units, None
+
+
+@csrf_exempt
+def weather_batch_api(request):
+    logger.info("request_start method=%s path=%s", request.method, request.path)
+    if getattr(request, "limited", False):
+        return _rate_limit_exceeded(request)
+    if request.method not in ("GET", "POST"):
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    cities, units, error = _parse_batch_request(request)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+    if not cities:
+        return JsonResponse({"error": "Missing city parameter"}, status=400)
+    if len(cities) > settings.BATCH_MAX_CITIES:
         return JsonResponse(
-            {
-                "error": "Rate limit exceeded",
-                "message": "Maximum 30 requests per minute",
-            },
-            status=429,
+            {"error": f"At most {settings.BATCH_MAX_CITIES} cities per request"},
+            status=400,
+        )
+
+    ip_address = get_client_ip(request)
+    results = WeatherService().get_weather_batch(cities, units, ip_address)
+
+    logger.info("request_end method=%s path=%s", request.method, request.path)
+    return JsonResponse({"units": units, "results": results})
+
+
+async def weather_query_async(request):
+    logger.info("request_start method=%s path=%s", request.method, request.path)
+    if getattr(request, "limited", False):
+        return render(
+            request,
+            "weather/query.html",
+            {"error": "Rate limit exceeded. Please wait a minute."},
         )
+    if request.method == "POST":
+        city = request.POST.get("city")
+        units = request.POST.get("units", "metric")
+        ip_address = get_client_ip(request)
+
+        weather_data = await AsyncWeatherService().get_weather(city, units, ip_address)
+
+        if weather_data:
+            return render(
+                request,
+                "weather/result.html",
+                {"weather_data": weather_data, "city": city},
+            )
+        else:
+            return render(
+                request, "weather/query.html", {"error": "City not found or API error"}
+            )
+    logger.info("request_end method=%s path=%s", request.method, request.path)
+    return render(request, "weather/query.html")
+
+
+async def weather_api_async(request):
+    logger.info("request_start method=%s path=%s", request.method, request.path)
+    if getattr(request, "limited", False):
+        return _rate_limit_exceeded(request)
 
     if request.method == "GET":
         city = request.GET.get("city")
@@ -76,46 +224,124 @@ def weather_api(request):
                 }
             )
         ip_address = get_client_ip(request)
-        weather_data = WeatherService().get_weather(city, units, ip_address)
+        weather_data = await AsyncWeatherService().get_weather(city, units, ip_address)
 
         if weather_data:
             return JsonResponse(weather_data)
         else:
             return JsonResponse({"error": "City not found or API error"}, status=404)
-    logger.info(f"request_end method={request.method} path={request.path} ")
+    logger.info("request_end method=%s path=%s", request.method, request.path)
     return JsonResponse({"error": "Method not allowed"}, status=405)
 
 
-def query_history(request):
-    logger.info(f"request_start method={request.method} path={request.path} ")
+def _day_start(value: str):
+    day = parse_date(value) if value else None
+    if day is None:
+        return None
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
 
-    queries = WeatherQuery.objects.all().order_by("-timestamp")
+
+def _filtered_history(request):
+    # Filters on the normalized city key and a half-open timestamp range so
+    # the (city_key, timestamp) and (timestamp) indexes can be used.
+    queries = WeatherQuery.objects.all().order_by("-timestamp", "-pk")
 
     city_filter = request.GET.get("city", "")
-    if city_filter:
-        queries = queries.filter(city_name__icontains=city_filter)
+    if city_filter.strip():
+        queries = queries.filter(city_key=normalize_city(city_filter))
 
     date_from = request.GET.get("date_from", "")
     date_to = request.GET.get("date_to", "")
-    if date_from:
-        queries = queries.filter(timestamp__date__gte=date_from)
-    if date_to:
-        queries = queries.filter(timestamp__date__lte=date_to)
+    start = _day_start(date_from)
+    if start:
+        queries = queries.filter(timestamp__gte=start)
+    end = _day_start(date_to)
+    if end:
+        queries = queries.filter(timestamp__lt=end + timedelta(days=1))
+
+    return queries, city_filter, date_from, date_to
+
+
+def weather_stats(request):
+    logger.info("request_start method=%s path=%s", request.method, request.path)
+    if getattr(request, "limited", False):
+        return _rate_limit_exceeded(request)
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    city = request.GET.get("city", "").strip()
+    units = request.GET.get("units", "metric")
+    bucket = request.GET.get("bucket", "hour")
+    if not city:
+        return JsonResponse({"error": "Missing city parameter"}, status=400)
+    if bucket not in BUCKETS:
+        return JsonResponse(
+            {"error": f"bucket must be one of {', '.join(BUCKETS)}"}, status=400
+        )
 
-    paginator = Paginator(queries, 10)
-    page_number = request.GET.get("page", 1)
-    page_obj = paginator.get_page(page_number)
+    # date_to is inclusive, as on the history page; the default range is
+    # the last STATS_DEFAULT_DAYS days including today.
+    last_day = request.GET.get("date_to", "") or timezone.localdate().isoformat()
+    end = _day_start(last_day) or _day_start(timezone.localdate().isoformat())
+    end += timedelta(days=1)
+    start = _day_start(request.GET.get("date_from", "")) or end - timedelta(
+        days=settings.STATS_DEFAULT_DAYS
+    )
+    if start >= end:
+        return JsonResponse({"error": "date_from is after date_to"}, status=400)
+    if (end - start) / BUCKETS[bucket][1] > settings.STATS_MAX_BUCKETS:
+        return JsonResponse(
+            {"error": f"At most {settings.STATS_MAX_BUCKETS} buckets per request"},
+            status=400,
+        )
 
-    cities = WeatherQuery.objects.values_list("city_name", flat=True).distinct()
+    buckets = city_stats(city, start, end, bucket, units)
 
-    logger.info(f"request_end method={request.method} path={request.path} ")
+    logger.info("request_end method=%s path=%s", request.method, request.path)
+    return JsonResponse(
+        {
+            "city": city,
+            "units": units,
+            "bucket": bucket,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "buckets": buckets,
+        }
+    )
+
+
+def query_history(request):
+    logger.info("request_start method=%s path=%s", request.method, request.path)
+
+    queries, city_filter, date_from, date_to = _filtered_history(request)
+    filters = {"city": city_filter, "date_from": date_from, "date_to": date_to}
+
+    page_number = request.GET.get("page", "")
+    if page_number.isdigit() and int(page_number) > 1:
+        # Old ?page=N links keep working, at the cost of an OFFSET scan.
+        offset = (int(page_number) - 1) * HISTORY_PAGE_SIZE
+        rows = list(queries[offset : offset + HISTORY_PAGE_SIZE + 1])
+        page = HistoryPage(
+            rows[:HISTORY_PAGE_SIZE], len(rows) > HISTORY_PAGE_SIZE, True
+        )
+    else:
+        page = keyset_page(
+            queries,
+            HISTORY_PAGE_SIZE,
+            after=request.GET.get("after", ""),
+            before=request.GET.get("before", ""),
+        )
+
+    logger.info("request_end method=%s path=%s", request.method, request.path)
     return render(
         request,
         "weather/history.html",
         {
-            "page_obj": page_obj,
-            "queries": page_obj,
-            "cities": cities,
+            "page": page,
+            "queries": page.rows,
+            "total_count": approximate_count(queries, filters),
+            "cities": city_facets.all,
+            "filter_query": urlencode({k: v for k, v in filters.items() if v}),
             "city_filter": city_filter,
             "date_from": date_from,
             "date_to": date_to,
@@ -123,69 +349,115 @@ def query_history(request):
     )
 
 
+EXPORT_HEADER = [
+    "City",
+    "Temperature",
+    "Description",
+    "Units",
+    "Timestamp",
+    "From Cache",
+]
+EXPORT_COLUMNS = (
+    "city_name",
+    "temperature",
+    "weather_description",
+    "units",
+    "timestamp",
+    "served_from_cache",
+)
+
+
+def _export_rows(queries):
+    # Only the exported columns are fetched, through a server-side cursor,
+    # and rows are flushed in chunks so memory stays flat for any size.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADER)
+    rows = queries.values_list(*EXPORT_COLUMNS).iterator(
+        chunk_size=settings.EXPORT_CHUNK_SIZE
+    )
+    for count, row in enumerate(rows, start=1):
+        city_name, temperature, description, units, timestamp, cached = row
+        writer.writerow(
+            [
+                f"{city_name}",
+                f"{temperature}",
+                f"{description}",
+                f"{units}",
+                f"{timestamp.strftime('%Y-%m-%d %H:%M:%S')}",
+                f"Served from cache - {cached}",
+            ]
+        )
+        if count % settings.EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def export_csv(request):
-    logger.info(f"request_start method={request.method} path={request.path} ")
+    logger.info("request_start method=%s path=%s", request.method, request.path)
 
     if request.method == "GET":
-        queries = WeatherQuery.objects.all().order_by("-timestamp")
-        city_filter = request.GET.get("city", "")
-        if city_filter:
-            queries = queries.filter(city_name__icontains=city_filter)
-
-        date_from = request.GET.get("date_from", "")
-        date_to = request.GET.get("date_to", "")
-        if date_from:
-            queries = queries.filter(timestamp__date__gte=date_from)
-        if date_to:
-            queries = queries.filter(timestamp__date__lte=date_to)
-
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = 'attachment; filename="weather_history.csv"'
-        writer = csv.writer(response)
-        writer.writerow(
-            ["City", "Temperature", "Description", "Units", "Timestamp", "From Cache"]
-        )
-        for queri in queries:
-            timestamp = queri.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-            writer.writerow(
-                [
-                    f"{queri.city_name}",
-                    f"{timestamp}",
-                    f"{queri.temperature}",
-                    f"{queri.weather_description}",
-                    f"{queri.units}",
-                    f"Served from cache - {queri.served_from_cache}",
-                ]
+        queries, _, _, _ = _filtered_history(request)
+        rows = _export_rows(queries)
+
+        if request.GET.get("gzip") in ("1", "true"):
+            response = StreamingHttpResponse(
+                _gzip_stream(rows), content_type="application/gzip"
             )
+            filename = "weather_history.csv.gz"
+        else:
+            response = StreamingHttpResponse(rows, content_type="text/csv")
+            filename = "weather_history.csv"
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
 
-        logger.info(f"request_end method={request.method} path={request.path} ")
+        logger.info("request_end method=%s path=%s", request.method, request.path)
         return response
 
 
 def health_check(request):
-    logger.info(f"request_start method={request.method} path={request.path} ")
+    logger.info("request_start method=%s path=%s", request.method, request.path)
 
     if request.method == "GET":
-        try:
-            connection.ensure_connection()
-            db_healthy = True
-        except Exception as e:
-            logger.error(f"error message='{str(e)}'")
-            db_healthy = False
-        try:
-            data = WeatherService().get_weather("Paris", "metric")
-            time.sleep(5)
-            api_healthy = data is not None
-        except Exception as e:
-            api_healthy = False
-            logger.error(f"error message='{str(e)}' ")
-        overall_status = "ok" if (db_healthy and api_healthy) else "error"
-
-        logger.info(f"request_end method={request.method} path={request.path} ")
+        results = health_prober.snapshot(required=CRITICAL_CHECKS)
+        ready, checks = readiness(results)
+        db_healthy = checks.get("database", {}).get("status") == "healthy"
+        api_healthy = checks.get("upstream", {}).get("status") == "healthy"
+        overall_status = "ok" if (ready and api_healthy) else "error"
+
+        logger.info("request_end method=%s path=%s", request.method, request.path)
         return JsonResponse(
             {
                 "status": overall_status,
                 "database": "healthy" if db_healthy else "unhealthy",
                 "api": "healthy" if api_healthy else "unhealthy",
+                "checks": checks,
             }
         )
+
+
+def metrics(request):
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
+def liveness(request):
+    return JsonResponse({"status": "ok"})
+
+
+def readiness_check(request):
+    ready, checks = readiness(health_prober.snapshot(required=CRITICAL_CHECKS))
+    return JsonResponse(
+        {"status": "ok" if ready else "unavailable", "checks": checks},
+        status=200 if ready else 503,
+    )
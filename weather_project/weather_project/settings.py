@@ -25,11 +25,13 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
-    "django_ratelimit",
     "weather.apps.WeatherConfig",
 ]
 
 MIDDLEWARE = [
+    "weather.middleware.RequestIdMiddleware",
+    "weather.middleware.MetricsMiddleware",
+    "weather.middleware.RateLimitMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -61,6 +63,12 @@ WSGI_APPLICATION = "weather_project.wsgi.application"
 
 
 DATABASES = {"default": env.db("DATABASE_URL")}
+if DATABASES["default"]["ENGINE"] == "django.db.backends.postgresql":
+    # Without it a connection attempt to an unreachable server never gives
+    # up, stalling the request (or health probe) that opened it.
+    DATABASES["default"].setdefault("OPTIONS", {})["connect_timeout"] = env.int(
+        "DATABASE_CONNECT_TIMEOUT", default=5
+    )
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -85,8 +93,156 @@ USE_I18N = True
 USE_TZ = True
 
 
+# Per-client limits, RATE_LIMIT_REQUESTS per RATE_LIMIT_WINDOW seconds, on
+# the methods listed per URL name below. RATE_LIMIT_ENDPOINTS overrides the
+# rate per URL name ("weather:api_batch=10/60"). Requests with an X-API-Key
+# header listed in RATE_LIMIT_API_KEYS ("key=tier") are limited per key at
+# the tier's rate from RATE_LIMIT_TIERS ("pro=600/60").
+# Clients are identified by REMOTE_ADDR. Behind N reverse proxies, set
+# TRUSTED_PROXY_COUNT=N to use the Nth X-Forwarded-For entry from the right.
+TRUSTED_PROXY_COUNT = env.int("TRUSTED_PROXY_COUNT", default=0)
 RATE_LIMIT_REQUESTS = env.int("RATE_LIMIT_REQUESTS", default=30)
 RATE_LIMIT_WINDOW = env.int("RATE_LIMIT_WINDOW", default=60)
+RATE_LIMITED_VIEWS = {
+    "weather:query": ("POST",),
+    "weather:api": ("GET",),
+    "weather:api_batch": ("GET", "POST"),
+    "weather:api_stats": ("GET",),
+}
+RATE_LIMIT_ENDPOINTS = env.dict("RATE_LIMIT_ENDPOINTS", default={})
+RATE_LIMIT_TIERS = env.dict("RATE_LIMIT_TIERS", default={})
+RATE_LIMIT_API_KEYS = env.dict("RATE_LIMIT_API_KEYS", default={})
+
+WEATHER_API_BASE_URL = env(
+    "WEATHER_API_BASE_URL",
+    default="https://api.openweathermap.org/data/2.5/weather",
+)
+WEATHER_API_POOL_SIZE = env.int("WEATHER_API_POOL_SIZE", default=20)
+WEATHER_API_CONNECT_TIMEOUT = env.float("WEATHER_API_CONNECT_TIMEOUT", default=3.05)
+WEATHER_API_READ_TIMEOUT = env.float("WEATHER_API_READ_TIMEOUT", default=7)
+WEATHER_API_MAX_RETRIES = env.int("WEATHER_API_MAX_RETRIES", default=2)
+WEATHER_API_BACKOFF_FACTOR = env.float("WEATHER_API_BACKOFF_FACTOR", default=0.2)
+WEATHER_API_BACKOFF_JITTER = env.float("WEATHER_API_BACKOFF_JITTER", default=0.1)
+WEATHER_API_ASYNC_POOL_SIZE = env.int("WEATHER_API_ASYNC_POOL_SIZE", default=200)
+
+# Stop calling OpenWeatherMap for UPSTREAM_CIRCUIT_RESET_TIMEOUT seconds after
+# this many failures in a row (0 disables), and cap calls across all workers
+# at the API plan's per-minute limit (0 disables).
+UPSTREAM_CIRCUIT_FAILURE_THRESHOLD = env.int(
+    "UPSTREAM_CIRCUIT_FAILURE_THRESHOLD", default=5
+)
+UPSTREAM_CIRCUIT_RESET_TIMEOUT = env.float("UPSTREAM_CIRCUIT_RESET_TIMEOUT", default=30)
+UPSTREAM_CALLS_PER_MINUTE = env.float("UPSTREAM_CALLS_PER_MINUTE", default=60)
+UPSTREAM_BURST = env.int("UPSTREAM_BURST", default=20)
+
+# Misses for cities the index knows by ID wait up to UPSTREAM_BATCH_WINDOW
+# seconds (0 disables) and are fetched together, up to UPSTREAM_BATCH_MAX
+# IDs per call to OpenWeatherMap's group endpoint.
+UPSTREAM_BATCH_WINDOW = env.float("UPSTREAM_BATCH_WINDOW", default=0)
+UPSTREAM_BATCH_MAX = env.int("UPSTREAM_BATCH_MAX", default=20)
+WEATHER_API_GROUP_URL = env(
+    "WEATHER_API_GROUP_URL",
+    default=WEATHER_API_BASE_URL.rsplit("/", 1)[0] + "/group",
+)
+
+# Serve "/" and "/api/" with the async views; use together with the ASGI entry point.
+WEATHER_ASYNC_VIEWS = env.bool("WEATHER_ASYNC_VIEWS", default=False)
+
+RATELIMIT_ENABLE = env.bool("RATELIMIT_ENABLE", default=True)
+
+# Cached weather is fresh for WEATHER_CACHE_SOFT_TTL seconds. Past that it is
+# served flagged as stale while a background refresh runs, and during
+# upstream failures, until WEATHER_CACHE_HARD_TTL.
+WEATHER_CACHE_SOFT_TTL = env.int("WEATHER_CACHE_SOFT_TTL", default=300)
+WEATHER_CACHE_HARD_TTL = env.int("WEATHER_CACHE_HARD_TTL", default=3600)
+WEATHER_REVALIDATE_WORKERS = env.int("WEATHER_REVALIDATE_WORKERS", default=4)
+
+# OpenWeatherMap's bulk city list (city.list.json or .json.gz). When set,
+# input is resolved to a city ID, which keys the cache and upstream calls.
+CITY_LIST_PATH = env("CITY_LIST_PATH", default="")
+CITY_FUZZY_CUTOFF = env.float("CITY_FUZZY_CUTOFF", default=0.85)
+CITY_MAX_ALIASES = env.int("CITY_MAX_ALIASES", default=10000)
+CITY_RESOLVE_CACHE_SIZE = env.int("CITY_RESOLVE_CACHE_SIZE", default=4096)
+
+# Optional per-process cache in front of Redis; entries never outlive the
+# 5 minute freshness window.
+WEATHER_L1_ENABLED = env.bool("WEATHER_L1_ENABLED", default=False)
+WEATHER_L1_TTL = env.float("WEATHER_L1_TTL", default=10)
+WEATHER_L1_MAX_ENTRIES = env.int("WEATHER_L1_MAX_ENTRIES", default=2048)
+WEATHER_L1_MAX_BYTES = env.int("WEATHER_L1_MAX_BYTES", default=8 * 1024 * 1024)
+
+# Queue history rows and insert them in batches from a background thread
+# instead of writing one row per request.
+HISTORY_WRITE_BEHIND = env.bool("HISTORY_WRITE_BEHIND", default=False)
+HISTORY_BATCH_SIZE = env.int("HISTORY_BATCH_SIZE", default=200)
+HISTORY_FLUSH_INTERVAL = env.float("HISTORY_FLUSH_INTERVAL", default=1.0)
+HISTORY_QUEUE_SIZE = env.int("HISTORY_QUEUE_SIZE", default=10000)
+HISTORY_RETRY_DELAY = env.float("HISTORY_RETRY_DELAY", default=0.5)
+
+HISTORY_COUNT_CACHE_TTL = env.int("HISTORY_COUNT_CACHE_TTL", default=60)
+HISTORY_FACETS_TTL = env.int("HISTORY_FACETS_TTL", default=3600)
+
+# prune_history keeps this many days of WeatherQuery rows and moves older
+# ones to the archive table (or deletes them when HISTORY_ARCHIVE is off).
+HISTORY_RETENTION_DAYS = env.int("HISTORY_RETENTION_DAYS", default=30)
+HISTORY_RETENTION_BATCH_SIZE = env.int("HISTORY_RETENTION_BATCH_SIZE", default=1000)
+HISTORY_ARCHIVE = env.bool("HISTORY_ARCHIVE", default=True)
+# Archived rows are deleted by prune_history after this many days (0 keeps
+# them indefinitely); the hourly rollups keep their aggregates.
+ARCHIVE_RETENTION_DAYS = env.int("ARCHIVE_RETENTION_DAYS", default=365)
+# An hour is rolled up once it has been over this many seconds; keep it
+# well above HISTORY_FLUSH_INTERVAL so late write-behind rows are counted.
+HISTORY_ROLLUP_LAG = env.int("HISTORY_ROLLUP_LAG", default=300)
+# Deleting rows only drops raw payloads unused for this many seconds.
+RAW_PAYLOAD_GRACE_PERIOD = env.int("RAW_PAYLOAD_GRACE_PERIOD", default=3600)
+
+EXPORT_CHUNK_SIZE = env.int("EXPORT_CHUNK_SIZE", default=2000)
+
+# /api/stats/: results are cached per (city, range, bucket, units).
+STATS_CACHE_TTL = env.int("STATS_CACHE_TTL", default=300)
+STATS_DEFAULT_DAYS = env.int("STATS_DEFAULT_DAYS", default=7)
+STATS_MAX_BUCKETS = env.int("STATS_MAX_BUCKETS", default=2000)
+
+BATCH_MAX_CITIES = env.int("BATCH_MAX_CITIES", default=20)
+BATCH_MAX_WORKERS = env.int("BATCH_MAX_WORKERS", default=8)
+
+SINGLE_FLIGHT_ENABLED = env.bool("SINGLE_FLIGHT_ENABLED", default=True)
+SINGLE_FLIGHT_LOCK_TIMEOUT = env.int("SINGLE_FLIGHT_LOCK_TIMEOUT", default=15)
+SINGLE_FLIGHT_WAIT_TIMEOUT = env.int("SINGLE_FLIGHT_WAIT_TIMEOUT", default=10)
+
+# Per-(city, units) request counter used by the refresh_hot_cities command,
+# which re-fetches the hottest keys shortly before their cache entry expires.
+HOT_CITIES_TRACKING = env.bool("HOT_CITIES_TRACKING", default=True)
+HOT_CITIES_TOP = env.int("HOT_CITIES_TOP", default=50)
+HOT_CITIES_REFRESH_AHEAD = env.int("HOT_CITIES_REFRESH_AHEAD", default=60)
+HOT_CITIES_REFRESH_BUDGET = env.int("HOT_CITIES_REFRESH_BUDGET", default=20)
+HOT_CITIES_DECAY = env.float("HOT_CITIES_DECAY", default=0.5)
+HOT_CITIES_MAX_TRACKED = env.int("HOT_CITIES_MAX_TRACKED", default=1000)
+
+# Cities upstream answered 404 for are refused without a lookup for
+# NEGATIVE_CACHE_TTL seconds (0 disables). A Bloom filter of those names,
+# checked locally and re-read from Redis every CITY_BLOOM_REFRESH_INTERVAL
+# seconds, keeps the check off the path of every other city.
+NEGATIVE_CACHE_TTL = env.int("NEGATIVE_CACHE_TTL", default=300)
+CITY_BLOOM_CAPACITY = env.int("CITY_BLOOM_CAPACITY", default=100_000)
+CITY_BLOOM_ERROR_RATE = env.float("CITY_BLOOM_ERROR_RATE", default=0.01)
+CITY_BLOOM_REFRESH_INTERVAL = env.float("CITY_BLOOM_REFRESH_INTERVAL", default=30)
+CITY_BLOOM_TTL = env.int("CITY_BLOOM_TTL", default=86_400)
+
+# Background dependency checks behind /health/; readiness fails when the
+# last database or Redis result is older than HEALTH_STALE_AFTER. Each check
+# gives up after HEALTH_PROBE_TIMEOUT seconds (database connections after
+# DATABASE_CONNECT_TIMEOUT).
+HEALTH_PROBE_INTERVAL = env.float("HEALTH_PROBE_INTERVAL", default=15)
+HEALTH_PROBE_TIMEOUT = env.float("HEALTH_PROBE_TIMEOUT", default=2)
+HEALTH_STALE_AFTER = env.float("HEALTH_STALE_AFTER", default=60)
+
+# Logging: "text" or "json" lines, written from a background thread when
+# LOG_QUEUE is on. LOG_SAMPLE_RATE keeps that fraction of requests' INFO
+# lines (whole requests, chosen by request ID); warnings are never sampled.
+LOG_FORMAT = env("LOG_FORMAT", default="text")
+LOG_QUEUE = env.bool("LOG_QUEUE", default=True)
+LOG_SAMPLE_RATE = env.float("LOG_SAMPLE_RATE", default=1.0)
 
 
 STATIC_URL = "static/"
@@ -102,6 +258,12 @@ CACHES = {
         "LOCATION": env("REDIS_URL", default="redis://redis:6379/0"),
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # Weather entries use a compact msgpack format; other values
+            # stay pickled. See weather/codec.py.
+            "SERIALIZER": "weather.codec.WeatherSerializer",
+            "COMPRESS_MIN_BYTES": env.int(
+                "WEATHER_CACHE_COMPRESS_MIN_BYTES", default=512
+            ),
         },
         "KEY_PREFIX": "weather",
     }
@@ -112,31 +274,39 @@ LOGGING = {
     "disable_existing_loggers": False,
     "formatters": {
         "verbose": {
-            "format": "levelname={levelname} timestamp={asctime} module={module} message={message}",
+            "format": "levelname={levelname} timestamp={asctime} module={module} request_id={request_id} message={message}",
             "style": "{",
         },
+        "json": {
+            "()": "weather.log.JsonFormatter",
+        },
         "simple": {
             "format": "{levelname} {message}",
             "style": "{",
         },
     },
+    "filters": {
+        "request_id": {"()": "weather.log.RequestIdFilter"},
+        "sampling": {"()": "weather.log.SamplingFilter"},
+    },
     "handlers": {
         "file": {
             "level": "INFO",
             "class": "logging.FileHandler",
             "filename": "weather.log",
-            "formatter": "verbose",
+            "formatter": "json" if LOG_FORMAT == "json" else "verbose",
         },
         "console": {
             "level": "INFO",
             "class": "logging.StreamHandler",
             "stream": sys.stdout,
-            "formatter": "verbose",
+            "formatter": "json" if LOG_FORMAT == "json" else "verbose",
         },
     },
     "loggers": {
         "weather": {
             "handlers": ["file", "console"],
+            "filters": ["request_id", "sampling"],
             "level": "INFO",
             "propagate": False,
         },